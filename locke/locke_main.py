@@ -1,51 +1,58 @@
 #!/usr/bin/python3
-from locke.patterns import PatternPlugin
-from locke.patterns.manager import Manager
-import locke.patterns.plugins  # noqa - needed for module loading
-import locke.transforms.plugins  # noqa - needed for module loading
-import locke.transforms.utils as utils
-from locke.transforms.transformer import select_transformers, run_transformations, \
-    write_to_disk, TransformChar, TransformString, test_transforms
-from locke.transforms.utils import generate_database, print_table
-
 import csv as csvlib
+import sys
+from contextlib import redirect_stdout
 from os import path, makedirs
 import click
 
+from locke.registry import load_transforms
+
+# Commands import the modules they use when run, so starting Locke (and
+# --help) doesn't import every plugin, pool and database module up front
+
 # Nest array. One for each level
 TRANSFORMERS = ([], [], [])
 
 
-def load_all_transformers():
+def parse_address(address):
+    """
+    Split a HOST:PORT string into a tuple(host, port)
+    """
+    host, _, port = address.rpartition(':')
+    if not host or not port.isdigit():
+        raise click.BadParameter('expected HOST:PORT, not "%s"' % address)
+    return host, int(port)
+
+
+def load_rule_files(rule_files):
+    from locke.patterns.rules import load_rules
+    for rule_file in rule_files:
+        try:
+            load_rules(rule_file)
+        except ValueError as e:
+            raise click.BadParameter('%s: %s' % (rule_file, e),
+                                     param_hint='--rules')
+
+
+def load_all_transformers(level=3, names=None):
+    """
+    Sort the transformers of the given level and below (or the named
+    ones, given as comma separated names) into TRANSFORMERS, importing
+    their modules first
+    """
+    from locke.transforms.transformer import TransformChar, TransformString
+    load_transforms(level, names.split(',') if names else None)
     for cls in (TransformChar, TransformString):
         for trans in cls.__subclasses__():
             if 0 < trans.class_level() < 4:
                 TRANSFORMERS[trans.class_level() - 1].append(trans)
             elif trans.class_level() == -1:
-                print("!! %s is disabled" % trans.__name__)
+                print("!! %s is disabled" % trans.__name__, file=sys.stderr)
             elif trans.class_level() == 0:
                 pass
             else:
                 print('%s has an invalid class level (1-3 | -1 --> disable\n)'
-                      % trans.__name__)
-
-
-def search_data(data):
-    mgr = Manager(stage=2, raw=data)
-    msgs = []
-    for pat, matches in mgr.run():
-        if not matches:
-            continue
-
-        match_hash = {}
-        for match in matches:
-            match_hash[match.offset] = match.data
-
-        msgs.append([pat.Description.encode(), pat.Weight, match_hash])
-
-    del mgr
-
-    return msgs
+                      % trans.__name__, file=sys.stderr)
 
 
 @click.group()
@@ -55,42 +62,102 @@ def cli(ctx, verbose):
     ctx.obj['verbose'] = verbose
 
 
+def read_inputs(filename, zip_file=False, password=None, members=None):
+    """
+    Generate tuple(name, data) for a file, or for each member of it (see
+    archive.iter_members) if it's a zip
+    """
+    from locke.transforms.archive import iter_members
+    from locke.transforms.transformer import read_data
+    if not zip_file:
+        if password is not None or members is not None:
+            raise click.UsageError('--password and --members only work '
+                                   'with -z')
+        yield filename, read_data(filename)
+        return
+    for member in iter_members(filename, members, password):
+        yield '%s/%s' % (filename, member.name), member.data
+
+
 @cli.command()
 @click.option('--csv', default=None, help='output results as CSV')
-@click.argument('files', type=click.File('rb'), nargs=-1)
+@click.option('-z', '--zip_file', is_flag=True,
+              help='Search each member of the files, which are zips')
+@click.option('--password', default=None,
+              help='Only works if -z is set. The password of the zips')
+@click.option('--members', default=None, metavar='GLOB',
+              help='Only works if -z is set. Only search the members '
+                   'matching GLOB')
+@click.option('--json', 'json_output', is_flag=True,
+              help='Write each match to stdout as a line of JSON, once its '
+                   'file has been searched')
+@click.option('--rules', type=click.Path(exists=True), multiple=True,
+              help='Also look for the patterns of this rule file (may be '
+                   'given more than once)')
+@click.argument('files', type=click.Path(exists=True), nargs=-1)
 @click.pass_context
-def search(ctx, csv, files):
+def search(ctx, csv, zip_file, password, members, json_output, rules,
+           files):
     """
     Search for patterns of interest in the supplied files.
     """
+    from locke.transforms.records import RecordWriter, match_records
+    from locke.transforms.shards import shard_count
+    from locke.transforms.transformer import search_data, search_shards
+    from locke.transforms.utils import prettyhex
+    load_rule_files(rules)
+    records = RecordWriter(sys.stdout) if json_output else None
 
     if csv:
-        click.echo('Writing CSV results to %s' % csv)
+        click.echo('Writing CSV results to %s' % csv, err=json_output)
         csvfile = open(csv, 'w')
         csv_writer = csvlib.writer(csvfile)
         csv_writer.writerow(['Filename', 'Index', 'Pattern name', 'Match',
                              'Length'])
 
-    # TODO: Could Pool the searches
-    for f in files:
-        click.echo("=" * 79)
-        click.echo("File: %s\n" % f.name)
+    # Files big enough to split are searched in shards across a pool,
+    # started on the first one
+    pool = None
+    for filename in files:
+        for name, file_data in read_inputs(filename, zip_file, password,
+                                           members):
+            if shard_count(len(file_data)) > 1:
+                if pool is None:
+                    from multiprocessing import Pool
+                    pool = Pool()
+                msgs = search_shards(file_data, pool)
+            else:
+                msgs = search_data(file_data)
+            if records:
+                # Written out file by file, rather than once buffered
+                records.write_all(match_records(name, msgs))
+                records.flush()
+                if not csv:
+                    continue
+            else:
+                click.echo("=" * 79)
+                click.echo("File: %s\n" % name)
 
-        for description, weight, hsh in search_data(f.read()):
-            desc = description.decode()
-            for offset, data in hsh.items():
-                mstr = utils.prettyhex(data)
-                if len(mstr) > 50:
-                    mstr = mstr[:24] + '...' + mstr[-23:]
+            for desc, weight, hsh in msgs:
+                for offset, data in hsh.items():
+                    mstr = prettyhex(data)
+                    if len(mstr) > 50:
+                        mstr = mstr[:24] + '...' + mstr[-23:]
 
-                click.echo('at %08X: %s - %s' % (offset, desc, mstr))
+                    if not records:
+                        click.echo('at %08X: %s - %s' % (offset, desc, mstr))
 
-                if csv:
-                    csv_writer.writerow([f.name, '0x%08X' % offset,
-                                         desc, mstr, len(data)])
+                    if csv:
+                        csv_writer.writerow([name, '0x%08X' % offset,
+                                             desc, mstr, len(data)])
 
+    if pool is not None:
+        pool.close()
+        pool.join()
     if csv:
         csvfile.close()
+    if records:
+        records.flush()
 
 
 @cli.command()
@@ -108,14 +175,63 @@ def search(ctx, csv, files):
 @click.option('-z',
               '--zip_file',
               is_flag=True,
-              help='Mark this file'
-                   'as a zip file. Use --password to enter zip password')
+              help='Mark this file '
+                   'as a zip file and crack each member. Use --password to '
+                   'enter zip password')
 @click.option('--password',
               nargs=1,
               default=None,
               help='Only works if -z is '
                    'set. Allows input of password for zip file')
+@click.option('--members', default=None, metavar='GLOB',
+              help='Only works if -z is set. Only crack the members '
+                   'matching GLOB')
 @click.option('--no-save', is_flag=True, help="Don't save result to disk")
+@click.option('--threads', is_flag=True, help='Use a thread pool instead of '
+                                              'a process pool')
+@click.option('--progress', is_flag=True, help='Show progress on stderr')
+@click.option('--events', type=click.File('w'), default=None,
+              help='Write progress events as JSON lines to this file')
+@click.option('--cascade', default=None, metavar='SPEC',
+              help='The stages to run as comma separated STAGE[:KEEP] '
+                   'items, where STAGE is a pattern stage or histogram '
+                   '(default = 1:KEEP,2)')
+@click.option('--budget', type=float, default=None, metavar='SECONDS',
+              help='How long each transform may be scored for by each '
+                   'stage, after which its matches so far are reported as '
+                   'truncated (default = no limit)')
+@click.option('--checkpoint', is_flag=True,
+              help='Save the progress of the crack to a checkpoint in the '
+                   'output directory, so it can be carried on with --resume')
+@click.option('--resume', is_flag=True,
+              help='Carry on from where a crack of the same file and '
+                   'options was stopped, from its checkpoint in the output '
+                   'directory')
+@click.option('--depth', type=int, default=1,
+              help='Chain up to this many layers of transforms, with a beam '
+                   'search')
+@click.option('--width', type=int, default=None,
+              help='How many chains of a layer the next builds on '
+                   '(default = KEEP)')
+@click.option('--regions', is_flag=True,
+              help='Only crack the regions of the file that look encoded, '
+                   'found from its entropy map')
+@click.option('--entropy-map', type=click.File('w'), default=None,
+              help='Write the entropy map of the file as CSV to this file')
+@click.option('--segment', default=None, metavar='SIZE|auto',
+              help='Find the best transform for each block of SIZE bytes '
+                   '(or of blocks split by entropy with auto), scored by the '
+                   'first stage only. Every segment is printed and saved, '
+                   'so --keep and --save don\'t apply')
+@click.option('--serve', default=None, metavar='HOST:PORT',
+              help='Hand stage 1 out to workers connecting to HOST:PORT')
+@click.option('--authkey', envvar='LOCKE_AUTHKEY', default=None,
+              help='The key workers must authenticate with '
+                   '(or set LOCKE_AUTHKEY)')
+@click.option('--json', 'json_output', is_flag=True,
+              help='Write the ranked transforms (and their matches with -v '
+                   '1 or more) to stdout as lines of JSON once each file is '
+                   'cracked, and everything else to stderr')
 @click.option('-v',
               '--verbose',
               type=int,
@@ -123,42 +239,182 @@ def search(ctx, csv, files):
               help='Set the verbose level '
                    'Valid inputs are 0 - 2 (lowest output to highest). '
                    'Note that -v 2 is not human friendly')
+@click.option('--rules', type=click.Path(exists=True), multiple=True,
+              help='Also look for the patterns of this rule file (may be '
+                   'given more than once)')
 @click.argument('filename', nargs=1, type=click.Path(exists=True))
 @click.pass_context
 def crack(ctx, level, output, name, keep, save, zip_file, password,
-          no_save, verbose, filename):
+          members, no_save, threads, progress, events, cascade, budget,
+          checkpoint, resume, depth, width, regions, entropy_map, segment,
+          serve, authkey, json_output, verbose, rules, filename):
     """
     Use patterns and transformations of interest to crack the supplied files.
     """
-    if not path.exists(locke.transforms.utils.DBFILE):
+    from locke.transforms.cascade import default_cascade, parse_cascade
+    from locke.transforms.events import JSONEventWriter, TerminalProgress
+    from locke.transforms.records import RecordWriter, segment_records, \
+        transform_records
+    from locke.transforms.regions import RegionMap, write_entropy_map, \
+        entropy_map as measure_entropy
+    from locke.transforms.segments import adaptive_bounds, best_per_block, \
+        fixed_bounds, merge_blocks, print_segments, write_segments
+    from locke.transforms.transformer import run_transformations, \
+        select_transformers, write_to_disk
+    from locke.transforms.utils import DBFILE
+
+    if not path.exists(DBFILE):
         print('Run generate to create a new transforms.db')
         return 1
     if path.exists(output) and path.isfile(output):
         return 1
     makedirs(output, exist_ok=True)
-    load_all_transformers()
+    load_all_transformers(level, name)
+    load_rule_files(rules)
     if not zip_file and password is not None:
         raise ValueError("Password field is set without zip enable")
+    if not zip_file and members is not None:
+        raise click.UsageError('--members only works with -z')
+    if cascade is not None:
+        try:
+            cascade = parse_cascade(cascade, budget)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint='--cascade')
+    elif budget is not None:
+        cascade = default_cascade(keep, budget)
+    if segment is not None:
+        if regions or serve or depth > 1 or checkpoint or resume or \
+                budget is not None:
+            raise click.UsageError('--segment can not be used with '
+                                   '--regions, --serve, --depth, '
+                                   '--checkpoint, --resume or --budget')
+        if cascade is not None and len(cascade) > 1:
+            raise click.BadParameter('--segment only runs one stage',
+                                     param_hint='--cascade')
+        if segment != 'auto' and not (segment.isdigit() and
+                                      int(segment) >= 1):
+            raise click.BadParameter('expected a size of at least 1, or '
+                                     'auto', param_hint='--segment')
+    if serve is not None:
+        if depth > 1:
+            raise click.UsageError('--serve does not shard chained cracks')
+        serve = parse_address(serve)
+        if not authkey:
+            raise click.UsageError('--serve requires an --authkey')
+        authkey = authkey.encode()
 
     trans_list = select_transformers(TRANSFORMERS, name, level=level)
-    results = run_transformations(trans_list, filename, keep,
-                                  zip_file, password, verbose)[:save]
+    listeners = []
+    if progress:
+        listeners.append(TerminalProgress())
+    if events:
+        listeners.append(JSONEventWriter(events))
+    backend = 'thread' if threads else 'process'
+    records = RecordWriter(sys.stdout) if json_output else None
+    # With --json, stdout only carries the records
+    with redirect_stdout(sys.stderr if json_output else sys.stdout):
+        for source, data in read_inputs(filename, zip_file, password, members):
+            if zip_file:
+                click.echo("=" * 79)
+                click.echo("File: %s\n" % source)
+            out_name = filename
+            if zip_file:
+                # Members are saved as <zip>_<path in the zip>
+                out_name = '%s_%s' % (
+                    path.splitext(path.basename(filename))[0],
+                    source[len(filename) + 1:].replace('/', '_'))
+            if segment is not None:
+                bounds = adaptive_bounds(data) if segment == 'auto' else \
+                    fixed_bounds(len(data), int(segment))
+                best = best_per_block(trans_list, data, bounds,
+                                      cascade[0] if cascade else None,
+                                      backend=backend, progress=listeners)
+                segments = merge_blocks(best, bounds, len(data))
+                print_segments(segments)
+                if records:
+                    records.write_all(segment_records(source, segments))
+                    records.flush()
+                if not no_save:
+                    write_segments(segments, output, out_name, data)
+                continue
+
+            region_map = None
+            if regions or entropy_map:
+                blocks = measure_entropy(data)
+                if entropy_map:
+                    write_entropy_map(blocks, entropy_map)
+                if regions:
+                    region_map = RegionMap.locate(data, blocks)
+                    for start, stop in region_map.regions:
+                        print('Region %08X-%08X (%i bytes)'
+                              % (start, stop, stop - start))
+                    data = region_map.data
+            results = run_transformations(
+                trans_list, source, keep, verbose=verbose, data=data,
+                backend=backend, progress=listeners, serve=serve,
+                authkey=authkey, cascade=cascade, depth=depth, width=width,
+                region_map=region_map, resume=resume,
+                checkpoint=path.join(output, '%s.checkpoint'
+                                     % path.basename(out_name))
+                if checkpoint or resume else None)[:save]
+            if records:
+                records.write_all(transform_records(source, results,
+                                                    verbose > 0))
+                records.flush()
+
+            # TODO
+            # Call on save to disk here? or Make run_transformation call write
+            # to disk?
+            if not no_save:
+                write_to_disk(results, output, out_name, data)
+
+    if records:
+        records.flush()
+
+
+@cli.command()
+@click.option('--authkey', envvar='LOCKE_AUTHKEY', required=True,
+              help='The key to authenticate with (or set LOCKE_AUTHKEY)')
+@click.option('--threads', is_flag=True, help='Use a thread pool instead of '
+                                              'a process pool')
+@click.option('--rules', type=click.Path(exists=True), multiple=True,
+              help='Also look for the patterns of this rule file (may be '
+                   'given more than once)')
+@click.argument('address', nargs=1)
+@click.pass_context
+def worker(ctx, authkey, threads, rules, address):
+    """
+    Work on stage 1 for a crack run with --serve at ADDRESS (HOST:PORT).
+    """
+    from locke.transforms.distributed import run_worker
+    from locke.transforms.utils import DBFILE
 
-    # TODO
-    # Call on save to disk here? or Make run_transformation call write to disk?
-    if not no_save:
-        write_to_disk(results, output, filename)
+    if not path.exists(DBFILE):
+        print('Run generate to create a new transforms.db')
+        return 1
+    load_rule_files(rules)
+    count = run_worker(parse_address(address), authkey.encode(),
+                       backend='thread' if threads else 'process')
+    print('Completed %i shards' % count)
 
 
 @cli.command()
+@click.option('--rules', type=click.Path(exists=True), multiple=True,
+              help='Also look for the patterns of this rule file (may be '
+                   'given more than once)')
 @click.pass_context
-def patterns(ctx):
+def patterns(ctx, rules):
     """
     List all patterns known by Locke.
     """
+    from locke.patterns import PatternPlugin
+    from locke.patterns.rules import rule_patterns
+    from locke.transforms.utils import print_table
+
+    load_rule_files(rules)
     headers = ['Stage','Description', 'Weight']
     values = [[pat.Stage, pat.Description, pat.Weight]
-              for pat in PatternPlugin.plugins()]
+              for pat in PatternPlugin.plugins() + rule_patterns()]
     print_table(headers, values)
 
 
@@ -180,7 +436,11 @@ def transforms(ctx, level, only, name, test, generate):
     List all transformations known by Locke. Also generate a new transforms.db
     and test algorithm duplications.
     """
-    load_all_transformers()
+    from locke.transforms.transformer import TransformChar, \
+        select_transformers, test_transforms
+    from locke.transforms.utils import generate_database, print_table
+
+    load_all_transformers(level if only is None else only, name)
     trans_list = select_transformers(TRANSFORMERS, name, only, level,
                                      listing=True)
     if test:
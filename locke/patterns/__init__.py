@@ -1,2 +1,3 @@
 from locke.patterns.manager import Manager
 from locke.patterns.pattern_plugin import PatternPlugin
+from locke.patterns.pattern_set import PatternSet
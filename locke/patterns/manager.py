@@ -1,18 +1,8 @@
-from typing import List, Tuple, Generator
-import locke.patterns.plugins  # needed for dynamic load
-from locke.patterns.utils import Match
+import time
+from typing import Callable, List, Tuple, Generator, Union
+from locke.patterns.utils import Match, ScanContext
 from locke.patterns.pattern_plugin import PatternPlugin
-
-"""
-These global variables contain the normal and lowercased data currently
-being processed.
-
-They're global to avoid excessive allocation, as most platforms will
-be clever enough to avoid duplicating them across multiple subprocess
-address spaces.
-"""
-data = None
-data_lower = None
+from locke.patterns.pattern_set import PatternSet
 
 """
 This is a type alias for the 2-tuple returned by Manager.run_pattern()
@@ -20,6 +10,11 @@ and generated by Manager.run().
 """
 PatternMatches = Tuple[PatternPlugin, List[Match]]
 
+"""
+This is a type alias for the 2-tuple generated by Manager.count().
+"""
+PatternCount = Tuple[PatternPlugin, int]
+
 
 class Manager(object):
     """
@@ -27,21 +22,34 @@ class Manager(object):
     of patterns in parallel.
     """
 
-    def __init__(self, file: str = None, raw: bytes = None, stage: int = 1):
-        global data
-        global data_lower
+    def __init__(self, file: str = None, raw: bytes = None, stage: int = 1,
+                 lower: Callable[[], bytes] = None,
+                 patterns: Union[List[type], PatternSet] = None):
+        """
+        The data is read from file, or taken from raw. If given, lower
+        is called to produce the lowercased data should it be needed,
+        rather than lowercasing the data.
+
+        The patterns of the given stage are used, unless a list of
+        pattern plugin classes (or a PatternSet) is given instead. They're
+        compiled once per process, and shared between managers (see
+        PatternSet).
+        """
         self.file = file
-        self.pats = [pat() for pat in PatternPlugin.plugins(stage=stage)]
+        if isinstance(patterns, PatternSet):
+            self.pattern_set = patterns
+        else:
+            self.pattern_set = PatternSet.get(stage, patterns)
+        self.pats = self.pattern_set.pats
         if file:
             with open(file, 'rb') as f:
                 data = f.read()
-        elif raw:
+        elif raw is not None:
             data = raw
         else:
             raise ValueError('expected either a filename or raw input')
 
-        # might as well memoize this
-        data_lower = data.lower()
+        self.ctx = ScanContext(data, lower)
 
     def run_pattern(self, pat: PatternPlugin) -> PatternMatches:
         """
@@ -49,14 +57,35 @@ class Manager(object):
 
         This method is private.
         """
-        return pat, pat.scan()
+        return pat, pat.scan(self.ctx)
 
-    def run(self) -> Generator[PatternMatches, None, None]:
+    def run(self, deadline: float = None) -> \
+            Generator[PatternMatches, None, None]:
         """
         This method runs all patterns against the data
 
         It returns a list of (PatternPlugin, List(Match)) tuples.
+
+        If a deadline (a time.monotonic() time) is given, no pattern is
+        run once it has passed, so fewer tuples than patterns are
+        generated.
         """
 
         for pat in self.pats:
+            if deadline is not None and time.monotonic() > deadline:
+                return
             yield self.run_pattern(pat)
+
+    def count(self, deadline: float = None) -> \
+            Generator[PatternCount, None, None]:
+        """
+        This method counts the matches of all patterns against the data,
+        without keeping the matches.
+
+        It generates (PatternPlugin, int) tuples, stopping at the
+        deadline like run does.
+        """
+        for pat in self.pats:
+            if deadline is not None and time.monotonic() > deadline:
+                return
+            yield pat, pat.count(self.ctx)
@@ -1,8 +1,11 @@
 import re
 from abc import ABC, abstractmethod
-from typing import List
+from heapq import merge
+from typing import Iterator, List
 
-from .utils import Match, find_matches
+from locke.registry import load_patterns
+from .utils import Match, MatchList, ScanContext, extract_anchor, \
+    find_matches, literal_regex, narrow, search_anchored, wide_regex, widen
 
 
 class PatternPlugin(ABC):
@@ -12,21 +15,34 @@ class PatternPlugin(ABC):
 
     Every pattern plugin has the following fields:
     * Stage (int) - A processing "level" that hints at the pattern's complexity
+      (stages of a cascade pick their patterns by it, see PatternStage)
     * Description (str) - A short, human friendly description
     * Weight (int) - The weight associated with the pattern
     * NoCase (bool) - Whether the pattern is case-sensitive
+    * Wide (bool) - Whether UTF-16LE (wide) copies of the pattern are
+      matched too, as Windows stores most strings
+    * WideBE (bool) - Whether UTF-16BE copies of the pattern are matched too
+
+    Wide copies are matched in the same pass over the data as the
+    pattern itself, and are only of its ASCII characters. That pass is
+    slower, so stage 1 plugins, which score every transform, leave them
+    off.
     """
 
     Stage = 1
     Description = None
     Weight = 1
     NoCase = False
+    Wide = False
+    WideBE = False
 
     @classmethod
     def plugins(cls, stage: int = 1) -> List[type]:
         """
-        This method provides a list of all concrete plugin classes.
+        This method provides a list of all concrete plugin classes,
+        importing the modules defining the plugins of the stage first.
         """
+        load_patterns(stage)
         plugins_ = []
         for sc in cls.__subclasses__():
             plugins_.extend(sc.__subclasses__())
@@ -46,14 +62,66 @@ class PatternPlugin(ABC):
         """
         return True
 
-    def scan(self) -> List[Match]:
+    def scan(self, ctx: ScanContext) -> List[Match]:
+        """
+        This method finds all matches for the pattern in the
+        data carried by the ScanContext, then filters them down
+        based on the filter method (if overridden).
+        """
+        data = ctx.lower if self.NoCase else ctx.data
+        matches = self.find_all(data)
+        if type(self).filter is PatternPlugin.filter:
+            return matches
+        keep = self._filter_narrow if self.wide else self.filter
+        if isinstance(matches, MatchList):
+            return matches.select(keep)
+        return [m for m in matches if keep(m)]
+
+    @property
+    def wide(self) -> bool:
+        """
+        Whether wide copies of the pattern are matched.
+        """
+        return self.Wide or self.WideBE
+
+    def _filter_narrow(self, match: Match) -> bool:
         """
-        This method finds all matches for the pattern, then filters
-        them down based on the filter method.
+        Filters matches of wide copies as the ASCII text they hold.
+        """
+        return self.filter(Match(match.offset, narrow(match.data)))
+
+    def variants(self, literal: bytes) -> List[bytes]:
+        """
+        This method returns the literal along with the wide copies of it
+        the plugin asks for.
+        """
+        literals = [literal]
+        if self.Wide:
+            literals.append(widen(literal))
+        if self.WideBE:
+            literals.append(widen(literal, big_endian=True))
+        return literals
+
+    def count(self, ctx: ScanContext) -> int:
+        """
+        This method counts the matches for the pattern in the data
+        carried by the ScanContext, giving the same result as
+        len(scan(ctx)) without keeping the matches around.
+
+        If filter is overridden, the matches have to be found
+        to filter them, so there is no saving.
         """
-        from locke.patterns import manager
-        data = manager.data_lower if self.NoCase else manager.data
-        return [m for m in self.find_all(data) if self.filter(m)]
+        if type(self).filter is not PatternPlugin.filter:
+            return len(self.scan(ctx))
+        return self.count_all(ctx.lower if self.NoCase else ctx.data)
+
+    def count_all(self, data: bytes) -> int:
+        """
+        This method returns the number of matches find_all would
+        return. It should be overridden by plugins able to count
+        matches faster than finding them.
+        """
+        return len(self.find_all(data))
 
     def validate(self) -> None:
         """
@@ -66,7 +134,7 @@ class PatternPlugin(ABC):
     def find_all(self, data: bytes) -> List[Match]:
         """
         This method, when overridden, should return a list of all
-        Match instances for the pattern.
+        Match instances for the pattern (preferably as a MatchList).
         """
         pass
 
@@ -92,13 +160,28 @@ class BytesPatternPlugin(PatternPlugin):
         elif not isinstance(self.Pattern, bytes):
             raise ValueError('unable to coerce pattern to bytes')
 
+        pat = self.Pattern.lower() if self.NoCase else self.Pattern
+        self.regex = literal_regex(self.variants(pat)) if self.wide else None
+
     def find_all(self, data: bytes) -> List[Match]:
         """
         See PatternPlugin.find_all.
         """
+        if self.regex is not None:
+            return _regex_matches(self.regex, data)
         pat = self.Pattern.lower() if self.NoCase else self.Pattern
         return find_matches(pat, data)
 
+    def count_all(self, data: bytes) -> int:
+        """
+        See PatternPlugin.count_all. Like find_matches, bytes.count
+        doesn't count overlapping matches.
+        """
+        if self.regex is not None:
+            return _regex_count(self.regex, data)
+        pat = self.Pattern.lower() if self.NoCase else self.Pattern
+        return data.count(pat)
+
 
 class BytesListPatternPlugin(PatternPlugin):
     """
@@ -126,17 +209,35 @@ class BytesListPatternPlugin(PatternPlugin):
         if self.NoCase:
             self.Patterns = [p.lower() for p in self.Patterns]
 
+        # Each literal is matched along with its wide copies, so asking
+        # for them doesn't add passes over the data
+        self.regexes = [literal_regex(self.variants(p))
+                        for p in self.Patterns] if self.wide else None
+
     def find_all(self, data: bytes) -> List[Match]:
         """
         See PatternPlugin.find_all.
         """
-        matches = []
+        matches = MatchList(data)
+
+        if self.regexes is not None:
+            for regex in self.regexes:
+                _regex_matches(regex, data, matches)
+            return matches
 
         for pat in self.Patterns:
-            matches.extend(find_matches(pat, data))
+            find_matches(pat, data, matches)
 
         return matches
 
+    def count_all(self, data: bytes) -> int:
+        """
+        See PatternPlugin.count_all.
+        """
+        if self.regexes is not None:
+            return sum(_regex_count(regex, data) for regex in self.regexes)
+        return sum(data.count(pat) for pat in self.Patterns)
+
 
 class REPatternPlugin(PatternPlugin):
     """
@@ -144,27 +245,130 @@ class REPatternPlugin(PatternPlugin):
     regular expression to match against in the data.
 
     In addition to the fields of PatternPlugin, REPatternPlugin
-    introduces the Pattern field.
+    introduces the following fields:
+    * Pattern (str) - The regular expression
+    * Anchors (list) - Literals, one of which every match must contain
+    * AnchorWindow (int) - How far ahead of an anchor a match may start;
+      matches starting further ahead may be missed
+
+    When Anchors isn't given, one is extracted from Pattern if possible,
+    in which case AnchorWindow is only needed if the extracted distance
+    is unbounded. Anchored patterns are only tried near anchor hits rather
+    than at every offset of the data.
     """
     Pattern = None
+    Anchors = None
+    AnchorWindow = None
 
     def validate(self) -> None:
         """
         For a REPatternPlugin, the validate method normalizes the
-        Pattern field into a bytes object. If this can't be done,
-        a ValueError is raised.
+        Pattern field into a bytes object, compiles it, and works out its
+        anchors. If this can't be done, a ValueError is raised.
         """
         if isinstance(self.Pattern, str):
             self.Pattern = self.Pattern.encode()
         elif not isinstance(self.Pattern, bytes):
             raise ValueError('unable to coerce pattern to bytes')
 
+        flags = re.IGNORECASE if self.NoCase else 0
+        self.regex = re.compile(self.Pattern, flags)
+        self.head = None
+        self.widened = None
+
+        if self.Anchors:
+            if self.AnchorWindow is None:
+                raise ValueError('anchors given without an anchor window')
+            self.Anchors = [a.encode() if isinstance(a, str) else a
+                            for a in self.Anchors]
+            if self.NoCase:
+                self.Anchors = [a.lower() for a in self.Anchors]
+        else:
+            anchor = extract_anchor(self.Pattern, flags,
+                                    folded=self.NoCase)
+            if anchor is not None:
+                literal, before, head = anchor
+                if before is None:
+                    before = self.AnchorWindow
+                if before is not None:
+                    self.Anchors = [literal]
+                    self.AnchorWindow = before
+                    self.head = head
+
+        if not self.wide:
+            return
+        if not self.Anchors:
+            # The pattern and its wide copies are matched in one pass
+            self.regex = wide_regex(self.Pattern, flags, self.Wide,
+                                    self.WideBE)
+            return
+        # Wide copies are searched for near the wide copies of the
+        # anchors, and may start up to twice as far ahead of them
+        self.widened = wide_regex(self.Pattern, flags, self.Wide,
+                                  self.WideBE, plain=False)
+        self.wide_anchors = [variant for a in self.Anchors
+                             for variant in self.variants(a)[1:]]
+
+    def find_iter(self, data: bytes) -> Iterator:
+        """
+        This method generates the regular expression match objects
+        for the pattern.
+        """
+        if not self.Anchors:
+            return self.regex.finditer(data)
+        found = search_anchored(self.regex, data, self.Anchors,
+                                self.AnchorWindow, self.head)
+        if self.widened is None:
+            return found
+        return _merge_iters(found, search_anchored(
+            self.widened, data, self.wide_anchors, self.AnchorWindow * 2 + 1))
+
     def find_all(self, data: bytes) -> List[Match]:
         """
         See PatternPlugin.find_all.
         """
-        flags = re.IGNORECASE if self.NoCase else 0
-        matches = []
-        for md in re.finditer(self.Pattern, data, flags):
-            matches.append(Match(md.start(), md.group(0)))
+        matches = MatchList(data)
+        for md in self.find_iter(data):
+            start, end = md.span()
+            matches.append(start, end - start)
         return matches
+
+    def count_all(self, data: bytes) -> int:
+        """
+        See PatternPlugin.count_all.
+        """
+        return sum(1 for _ in self.find_iter(data))
+
+
+def _regex_matches(regex, data: bytes, matches: MatchList = None) -> \
+        MatchList:
+    """
+    This method adds every match of a regular expression to a MatchList,
+    like find_matches does for a literal.
+    """
+    if matches is None:
+        matches = MatchList(data)
+    for md in regex.finditer(data):
+        start, end = md.span()
+        matches.append(start, end - start)
+    return matches
+
+
+def _regex_count(regex, data: bytes) -> int:
+    """
+    This method counts the matches of a regular expression, like
+    bytes.count does for a literal.
+    """
+    return sum(1 for _ in regex.finditer(data))
+
+
+def _merge_iters(*iters: Iterator) -> Iterator:
+    """
+    This method merges streams of regular expression match objects into
+    one, in order and without overlaps, like a single finditer.
+    """
+    pos = 0
+    for md in merge(*iters, key=lambda md: md.start()):
+        if md.start() >= pos:
+            yield md
+            pos = max(md.end(), md.start() + 1)
@@ -0,0 +1,58 @@
+from typing import Dict, List, Tuple, Union
+
+from locke.patterns.pattern_plugin import PatternPlugin
+from locke.patterns.rules import rule_patterns
+
+
+class PatternSet(object):
+    """
+    A compiled set of patterns. The plugins are instantiated, and so
+    validated (literals encoded, regular expressions compiled and anchors
+    extracted), once per process rather than once per scan.
+
+    Plugins keep no state between scans (see ScanContext), so a set is
+    shared by every Manager using the same patterns. Sets made in the
+    parent before a pool forks are inherited by its workers.
+    """
+
+    # Sets by stage number, or by tuple of plugin classes
+    _compiled: Dict[Union[int, Tuple[type, ...]], 'PatternSet'] = {}
+
+    def __init__(self, patterns: List[type],
+                 rules: List[PatternPlugin] = ()):
+        """
+        The plugin classes are instantiated, and the (already compiled)
+        rule patterns added after them.
+        """
+        self.pats = [pat() for pat in patterns] + list(rules)
+
+    def __len__(self) -> int:
+        return len(self.pats)
+
+    @classmethod
+    def get(cls, stage: int = 1, patterns: List[type] = None) -> 'PatternSet':
+        """
+        This method returns the compiled set of the patterns of the given
+        stage, including those of loaded rule files (see rules), or of
+        the given list of plugin classes. It's compiled the first time
+        it's asked for.
+        """
+        key = stage if patterns is None else tuple(patterns)
+        compiled = cls._compiled.get(key)
+        if compiled is None:
+            if patterns is None:
+                compiled = cls(PatternPlugin.plugins(stage=stage),
+                               rule_patterns(stage))
+            else:
+                compiled = cls(patterns)
+            cls._compiled[key] = compiled
+        return compiled
+
+    @classmethod
+    def clear(cls) -> None:
+        """
+        This method drops every compiled set. It must be called when
+        plugins are added after sets were compiled, for stages to pick
+        them up (loading a rule file calls it).
+        """
+        cls._compiled.clear()
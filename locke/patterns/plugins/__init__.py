@@ -1 +1 @@
-from locke.patterns.plugins import stage1_patterns, stage2_patterns
+# Plugin modules are imported when needed, see locke.registry
@@ -99,9 +99,11 @@ class EmailAddress(REPatternPlugin):
     """
     Stage = 2
     Description = 'Email address'
-    Pattern = r'(?i)\b[A-Z0-9._%+-]+@(?:[A-Z0-9-]+\.)+' \
+    # The local part is limited to 64 bytes (RFC 5321)
+    Pattern = r'(?i)\b[A-Z0-9._%+-]{1,64}@(?:[A-Z0-9-]+\.)+' \
               r'(?:[A-Z]{2,12}|XN--[A-Z0-9]{4,18})\b'
     Weight = 10
+    Wide = True
 
 
 class CommonURLs(REPatternPlugin):
@@ -118,6 +120,7 @@ class CommonURLs(REPatternPlugin):
               r'(:[a-zA-Z0-9]*)?/?([a-zA-Z0-9\-\._\?\,\'/\\\+&amp;%\$#\=~])' \
               r'*[^\.\,\)\(\s]'
     Weight = 10000
+    Wide = True
 
 
 class IRCStrings(BytesListPatternPlugin):
@@ -0,0 +1,480 @@
+import _sre
+import os
+import re
+import sys
+from array import array
+from typing import List, Optional, Tuple
+
+from locke.patterns.pattern_plugin import PatternPlugin, REPatternPlugin
+from locke.patterns.utils import MatchList, ScanContext, widen
+
+try:
+    from re import _compiler as sre_compile, _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_compile
+    import sre_parse
+
+# json, hashlib, marshal and tempfile are imported once rules are loaded,
+# as every search imports this module (for rule_patterns) whether or not
+# it loads any
+
+"""
+Patterns loaded from declarative rule files rather than written as plugin
+classes.
+
+A rule file is a JSON list of rules, each an object with the fields:
+* description (str) - A short, human friendly description
+* type (str) - "literal", "literals" or "regex"
+* pattern (str) - The literal or regular expression ("literal", "regex")
+* patterns (list) - The literals ("literals")
+* hex (str or list) - The literal(s) as hex, instead of pattern(s)
+* weight (int) - The weight of each match (default = 1)
+* stage (int) - The stage the rule belongs to (default = 1)
+* nocase (bool) - Whether to ignore case (default = false)
+* wide (bool) - Whether to match UTF-16LE copies too (default = false)
+
+For example:
+
+    [{"description": "C2 domain", "type": "literals", "stage": 2,
+      "weight": 1000, "nocase": true, "patterns": ["evil.example"]},
+     {"description": "Mutex", "type": "regex", "pattern": "mtx_[0-9]{4}"}]
+
+Literal rules sharing a description, weight, stage and case make up a
+single pattern, so feeds of indicators should share a few descriptions.
+All the literals of a pattern are compiled into one regular expression
+(a trie of alternatives), which finds them in a single pass over the data
+however many there are. Like bytes.count, it doesn't find overlapping
+matches of the pattern's literals, preferring the longest literal at each
+offset. Each pattern is matched on its own, so the literals of one never
+hide those of another.
+
+Compiling tens of thousands of literals takes seconds, so the compiled
+form is cached on disk, keyed by the hash of the rule file (and the
+version of Python, whose regular expression engine it's compiled for).
+The cache only holds plain data (marshalled, never pickled): the rules,
+and the code of each pattern's regular expression, which the engine
+checks before running it. Regular expression rules are compiled when
+loaded, like pattern plugins.
+
+Loaded rules are picked up by every Manager (see PatternSet) for their
+stage, in this process and in pool workers forked after loading.
+"""
+
+# Where compiled rule files are cached, unless LOCKE_CACHE is set
+CACHE_DIR = os.environ.get(
+    'LOCKE_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'locke'))
+# Bumped whenever the cached form changes
+CACHE_FORMAT = 3
+
+RULE_TYPES = ('literal', 'literals', 'regex')
+
+# The rule sets loaded so far, in order
+_loaded = []
+
+
+class Rule(object):
+    """
+    A rule read from a rule file.
+
+    Every rule has the following fields:
+    * description (str) - A short, human friendly description
+    * kind (str) - One of RULE_TYPES
+    * patterns (list) - The literals (as bytes), or the regular
+      expression as a single element
+    * weight (int) - The weight of each match
+    * stage (int) - The stage the rule belongs to
+    * nocase (bool) - Whether to ignore case
+    * wide (bool) - Whether to match UTF-16LE copies too; the wide
+      copies of literals are among the patterns
+    """
+    __slots__ = ('description', 'kind', 'patterns', 'weight', 'stage',
+                 'nocase', 'wide')
+
+    def __init__(self, description, kind, patterns, weight=1, stage=1,
+                 nocase=False, wide=False):
+        self.description = description
+        self.kind = kind
+        self.patterns = patterns
+        self.weight = weight
+        self.stage = stage
+        self.nocase = nocase
+        self.wide = wide
+
+    @classmethod
+    def parse(cls, number: int, fields: dict) -> 'Rule':
+        """
+        This method makes a rule of the fields of a rule file entry,
+        raising a ValueError if they don't describe a valid rule.
+        """
+        def invalid(reason):
+            return ValueError('rule %i: %s' % (number, reason))
+
+        if not isinstance(fields, dict):
+            raise invalid('expected an object')
+        kind = fields.get('type')
+        if kind not in RULE_TYPES:
+            raise invalid('type must be one of %s' % ', '.join(RULE_TYPES))
+        description = fields.get('description')
+        if not isinstance(description, str) or not description:
+            raise invalid('no description given')
+
+        if 'hex' in fields:
+            values = fields['hex']
+            decode = bytes.fromhex
+        else:
+            values = fields.get('patterns' if kind == 'literals'
+                                else 'pattern')
+            decode = str.encode
+        if kind != 'literals':
+            values = [values]
+        if not isinstance(values, list) or not values or \
+                not all(isinstance(value, str) and value
+                        for value in values):
+            raise invalid('no patterns given')
+        try:
+            patterns = [decode(value) for value in values]
+        except ValueError as e:
+            raise invalid(str(e))
+
+        weight = fields.get('weight', 1)
+        stage = fields.get('stage', 1)
+        nocase = fields.get('nocase', False)
+        if not isinstance(weight, int) or not isinstance(stage, int):
+            raise invalid('weight and stage must be integers')
+        wide = fields.get('wide', False)
+        if kind == 'regex':
+            try:
+                re.compile(patterns[0], re.IGNORECASE if nocase else 0)
+            except re.error as e:
+                raise invalid('bad regular expression: %s' % e)
+        if nocase:
+            patterns = [p if kind == 'regex' else p.lower()
+                        for p in patterns]
+        if wide and kind != 'regex':
+            patterns = patterns + [widen(p) for p in patterns]
+        return cls(description, kind, patterns, weight, stage, bool(nocase),
+                   bool(wide))
+
+
+def parse_rules(text: str) -> List[Rule]:
+    """
+    This method parses the JSON text of a rule file, raising a
+    ValueError if it isn't a valid one.
+    """
+    import json
+    entries = json.loads(text)
+    if not isinstance(entries, list):
+        raise ValueError('a rule file holds a list of rules')
+    return [Rule.parse(number, fields)
+            for number, fields in enumerate(entries, 1)]
+
+
+def _trie_pattern(literals: List[bytes]) -> bytes:
+    """
+    This method builds a regular expression matching any of the literals,
+    as a trie of alternatives so the engine never backtracks over a
+    shared prefix.
+    """
+    trie = {}
+    for literal in literals:
+        node = trie
+        for byte in literal:
+            node = node.setdefault(byte, {})
+        node[None] = True
+
+    def build(node):
+        alternatives = []
+        for byte in sorted(k for k in node if k is not None):
+            # Runs of single children are written out without recursing
+            run = bytearray([byte])
+            child = node[byte]
+            while len(child) == 1 and None not in child:
+                byte, child = next(iter(child.items()))
+                run.append(byte)
+            alternatives.append(re.escape(bytes(run)) + build(child))
+        if not alternatives:
+            return b''
+        body = alternatives[0] if len(alternatives) == 1 else \
+            b'(?:' + b'|'.join(alternatives) + b')'
+        if None in node:
+            body = b'(?:' + body + b')?'
+        return body
+
+    return build(trie)
+
+
+_CODE_TYPE = {2: 'H', 4: 'I'}.get(_sre.CODESIZE)
+
+
+def _compile(pattern: bytes) -> Tuple[re.Pattern, Optional[tuple]]:
+    """
+    This method compiles a regular expression, returning it along with
+    the state it can be rebuilt from without compiling it again (None if
+    this version of Python doesn't allow it).
+    """
+    try:
+        parsed = sre_parse.parse(pattern, 0)
+        code = sre_compile._code(parsed, 0)
+        state = parsed.state
+        indexgroup = [None] * state.groups
+        for name, i in state.groupdict.items():
+            indexgroup[i] = name
+        compiled = (pattern, state.flags, array(_CODE_TYPE, code).tobytes(),
+                    state.groups - 1, dict(state.groupdict),
+                    tuple(indexgroup))
+        return _rebuild(compiled), compiled
+    except (AttributeError, TypeError):
+        return re.compile(pattern), None
+
+
+def _rebuild(compiled: tuple) -> re.Pattern:
+    """
+    This method rebuilds a regular expression from the state _compile()
+    returned.
+    """
+    pattern, flags, code, groups, groupindex, indexgroup = compiled
+    words = array(_CODE_TYPE)
+    words.frombytes(code)
+    return _sre.compile(pattern, flags, words.tolist(), groups, groupindex,
+                        indexgroup)
+
+
+class LiteralMatcher(object):
+    """
+    Finds every literal of a group of literal rules in one pass.
+    """
+
+    def __init__(self, regex: re.Pattern):
+        self.regex = regex
+
+    @classmethod
+    def build(cls, literals: List[bytes]) -> \
+            Tuple['LiteralMatcher', Optional[tuple]]:
+        regex, compiled = _compile(_trie_pattern(sorted(literals)))
+        return cls(regex), compiled
+
+    def scan(self, data: bytes) -> MatchList:
+        """
+        This method returns the matches of the literals, the longest at
+        each offset, without overlaps.
+        """
+        matches = MatchList(data)
+        for md in self.regex.finditer(data):
+            start, end = md.span()
+            matches.append(start, end - start)
+        return matches
+
+
+class LiteralRulePattern(PatternPlugin):
+    """
+    The pattern of a group of literal rules, whose matches are found by
+    the group's LiteralMatcher.
+    """
+    Stage = None
+
+    def __init__(self, matcher: LiteralMatcher, description: str,
+                 weight: int, stage: int, nocase: bool):
+        self.matcher = matcher
+        self.Description = description
+        self.Weight = weight
+        self.Stage = stage
+        self.NoCase = nocase
+        super().__init__()
+
+    def scan(self, ctx: ScanContext) -> MatchList:
+        return self.matcher.scan(ctx.lower if self.NoCase else ctx.data)
+
+    def count(self, ctx: ScanContext) -> int:
+        return len(self.scan(ctx))
+
+    def find_all(self, data: bytes) -> MatchList:
+        return self.matcher.scan(data)
+
+
+class RegexRulePattern(REPatternPlugin):
+    """
+    The pattern of a regular expression rule.
+    """
+    # Set per rule, so the class itself is never picked as a plugin
+    Stage = None
+
+    def __init__(self, rule: Rule):
+        self.Description = rule.description
+        self.Weight = rule.weight
+        self.Stage = rule.stage
+        self.NoCase = rule.nocase
+        self.Wide = rule.wide
+        self.Pattern = rule.patterns[0]
+        super().__init__()
+
+
+class RuleSet(object):
+    """
+    The compiled rules of a rule file.
+    """
+
+    def __init__(self, path: str, digest: str, groups: List[tuple],
+                 matchers: List[LiteralMatcher], regex_rules: List[Rule]):
+        """
+        Each group is a tuple(stage, nocase, description, weight) of
+        literal rules, matched by the matcher of the same index.
+        """
+        self.path = path
+        self.digest = digest
+        self.groups = groups
+        self.matchers = matchers
+        self.pats = []
+        for matcher, (stage, nocase, description, weight) in \
+                zip(matchers, groups):
+            self.pats.append(LiteralRulePattern(
+                matcher, description, weight, stage, nocase))
+        self.pats.extend(RegexRulePattern(rule) for rule in regex_rules)
+
+    def patterns(self, stage: int = 1) -> List[PatternPlugin]:
+        """
+        This method returns the patterns of the given stage.
+        """
+        return [pat for pat in self.pats if pat.Stage == stage]
+
+    @classmethod
+    def compile(cls, path: str, digest: str, rules: List[Rule]) -> \
+            Tuple['RuleSet', dict]:
+        """
+        This method compiles the rules, returning the rule set along with
+        its cacheable form (of plain data only, see from_cache).
+        """
+        groups = {}
+        regex_rules = []
+        for rule in rules:
+            if rule.kind == 'regex':
+                regex_rules.append(rule)
+                continue
+            key = (rule.stage, rule.nocase, rule.description, rule.weight)
+            literals = groups.setdefault(key, [])
+            literals.extend(literal for literal in rule.patterns
+                            if literal not in literals)
+
+        group_list = list(groups)
+        matchers = []
+        cached = []
+        for key in group_list:
+            matcher, compiled = LiteralMatcher.build(groups[key])
+            matchers.append(matcher)
+            cached.append(compiled)
+        form = {'groups': group_list,
+                'literals': [groups[key] for key in group_list],
+                'compiled': cached,
+                'regex_rules': [tuple(getattr(rule, field)
+                                      for field in Rule.__slots__)
+                                for rule in regex_rules]}
+        return cls(path, digest, group_list, matchers, regex_rules), form
+
+    @classmethod
+    def from_cache(cls, path: str, digest: str, form: dict) -> 'RuleSet':
+        """
+        This method rebuilds a rule set from its cacheable form, raising
+        a ValueError if the form isn't a valid one.
+        """
+        try:
+            groups = [tuple(group) for group in form['groups']]
+            matchers = []
+            for literals, compiled in zip(form['literals'],
+                                          form['compiled']):
+                if compiled is None:
+                    matchers.append(LiteralMatcher.build(literals)[0])
+                else:
+                    # The engine refuses code it can't run safely
+                    matchers.append(LiteralMatcher(_rebuild(compiled)))
+            regex_rules = [Rule(*fields) for fields in form['regex_rules']]
+        except (KeyError, TypeError, ValueError, RuntimeError) as e:
+            raise ValueError('invalid compiled rules: %s' % e)
+        if len(matchers) != len(groups):
+            raise ValueError('invalid compiled rules: %i groups, %i matchers'
+                             % (len(groups), len(matchers)))
+        return cls(path, digest, groups, matchers, regex_rules)
+
+
+def _cache_file(cache_dir: str, digest: str) -> str:
+    tag = '%s-%i-%i' % (sys.implementation.cache_tag, _sre.MAGIC,
+                        CACHE_FORMAT)
+    return os.path.join(cache_dir, '%s-%s.marshal' % (digest, tag))
+
+
+def _read_cache(cache_file: str) -> Optional[dict]:
+    import marshal
+    try:
+        with open(cache_file, 'rb') as f:
+            form = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    return form if isinstance(form, dict) else None
+
+
+def _write_cache(cache_file: str, form: dict) -> None:
+    """
+    This method writes the cacheable form of a rule set. Concurrent
+    writers each write their own file, then swap it in.
+    """
+    import marshal
+    import tempfile
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(cache_file))
+        with os.fdopen(fd, 'wb') as f:
+            marshal.dump(form, f)
+        os.replace(temp, cache_file)
+    except OSError:
+        # The cache is only an optimization
+        pass
+
+
+def load_rules(path: str, cache_dir: str = CACHE_DIR) -> RuleSet:
+    """
+    This method loads a rule file, from its compiled form in cache_dir if
+    it's been compiled before (cache_dir None disables the cache), and
+    adds its patterns to those of their stages.
+    """
+    import hashlib
+    with open(path, 'rb') as f:
+        raw = f.read()
+    digest = hashlib.sha256(raw).hexdigest()
+
+    cache_file = None if cache_dir is None else \
+        _cache_file(cache_dir, digest)
+    form = None if cache_file is None else _read_cache(cache_file)
+    rule_set = None
+    if form is not None:
+        try:
+            rule_set = RuleSet.from_cache(path, digest, form)
+        except ValueError:
+            # Compiled again, and the cache overwritten
+            pass
+    if rule_set is None:
+        rules = parse_rules(raw.decode('utf-8'))
+        rule_set, form = RuleSet.compile(path, digest, rules)
+        if cache_file is not None:
+            _write_cache(cache_file, form)
+
+    _loaded.append(rule_set)
+    # Imported here, as pattern sets are made of the loaded rules
+    from locke.patterns.pattern_set import PatternSet
+    PatternSet.clear()
+    return rule_set
+
+
+def rule_patterns(stage: int = None) -> List[PatternPlugin]:
+    """
+    This method returns the patterns of the given stage (default = all
+    stages) of every loaded rule file.
+    """
+    return [pat for rule_set in _loaded for pat in rule_set.pats
+            if stage is None or pat.Stage == stage]
+
+
+def unload_rules() -> None:
+    """
+    This method forgets every loaded rule file.
+    """
+    del _loaded[:]
+    from locke.patterns.pattern_set import PatternSet
+    PatternSet.clear()
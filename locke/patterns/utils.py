@@ -1,4 +1,16 @@
-from typing import List
+import re
+from array import array
+from functools import lru_cache
+from typing import Callable, Iterable, Iterator, List, Optional, Pattern, \
+    Tuple
+
+try:
+    from re import _compiler as sre_compile, _constants as sre_constants, \
+        _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_compile
+    import sre_constants
+    import sre_parse
 
 
 class Match(object):
@@ -6,31 +18,433 @@ class Match(object):
     Represents the offset of and the data captured
     by a pattern during the scanning of some (larger)
     data.
+
+    A Match either owns its data, or is a view into the scanned data
+    (see MatchList), in which case the data is only copied out if asked
+    for.
     """
+    __slots__ = ('offset', '_data', '_view')
 
-    def __init__(self, offset: int, data: bytes):
+    def __init__(self, offset: int, data: bytes = None,
+                 view: memoryview = None):
         super().__init__()
         self.offset = offset
+        self._data = data
+        self._view = view
+
+    @property
+    def data(self) -> bytes:
+        """
+        The data captured by the pattern.
+        """
+        if self._data is None:
+            self._data = bytes(self._view)
+        return self._data
+
+    @property
+    def view(self) -> memoryview:
+        """
+        A memoryview of the captured data, without copying it.
+        """
+        if self._view is None:
+            self._view = memoryview(self._data)
+        return self._view
+
+
+class MatchList(object):
+    """
+    A compact list of the matches of a pattern, stored as parallel
+    arrays of offsets and lengths into the scanned data (the source).
+    Match objects are only created when the list is indexed or iterated.
+
+    A list can also be packed (see pack()), so that its source only holds
+    the data captured by the matches, laid out at the given starts.
+    """
+    __slots__ = ('source', 'offsets', 'lengths', 'starts')
+
+    def __init__(self, source: bytes, offsets: array = None,
+                 lengths: array = None, starts: array = None):
+        super().__init__()
+        self.source = memoryview(source)
+        self.offsets = array('q') if offsets is None else offsets
+        self.lengths = array('q') if lengths is None else lengths
+        self.starts = starts
+
+    def append(self, offset: int, length: int) -> None:
+        """
+        Adds the match of length bytes at offset in the source.
+        """
+        self.offsets.append(offset)
+        self.lengths.append(length)
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __getitem__(self, i: int) -> Match:
+        start = self.offsets[i] if self.starts is None else self.starts[i]
+        return Match(self.offsets[i],
+                     view=self.source[start:start + self.lengths[i]])
+
+    def __iter__(self) -> Iterator[Match]:
+        for i in range(len(self.offsets)):
+            yield self[i]
+
+    def __reduce__(self):
+        packed = self.pack()
+        return (MatchList, (packed.source.tobytes(), packed.offsets,
+                            packed.lengths, packed.starts))
+
+    def items(self) -> Iterator[Tuple[int, bytes]]:
+        """
+        Generates (offset, data) tuples for each match.
+        """
+        for match in self:
+            yield match.offset, match.data
+
+    def select(self, keep: Callable[[Match], bool]) -> 'MatchList':
+        """
+        Returns a new MatchList holding only the matches for
+        which keep returns True.
+        """
+        selected = MatchList(self.source)
+        if self.starts is not None:
+            selected.starts = array('q')
+        for i, match in enumerate(self):
+            if keep(match):
+                selected.append(match.offset, self.lengths[i])
+                if self.starts is not None:
+                    selected.starts.append(self.starts[i])
+        return selected
+
+    def pack(self) -> 'MatchList':
+        """
+        Returns a MatchList whose source only holds the data captured
+        by the matches, so it no longer refers to the scanned data.
+        """
+        if self.starts is not None:
+            return self
+        starts = array('q')
+        pos = 0
+        for length in self.lengths:
+            starts.append(pos)
+            pos += length
+        source = b''.join([m.view for m in self])
+        return MatchList(source, self.offsets, self.lengths, starts)
+
+
+def pack_matches(matches: Iterable[Match]) -> MatchList:
+    """
+    This method packs the matches returned by a pattern (be they
+    a MatchList or any other sequence of Match objects) into a MatchList
+    that doesn't refer to the scanned data.
+    """
+    if isinstance(matches, MatchList):
+        return matches.pack()
+    matches = list(matches)
+    packed = MatchList(b''.join([m.data for m in matches]))
+    packed.starts = array('q')
+    pos = 0
+    for match in matches:
+        packed.append(match.offset, len(match.data))
+        packed.starts.append(pos)
+        pos += len(match.data)
+    return packed
+
+
+class ScanContext(object):
+    """
+    Carries the data being scanned by a set of patterns, along with
+    the lowercased data that case-insensitive patterns need, produced
+    only the first time it's asked for.
+
+    Each scan gets its own context, so any number of scans can run at
+    once (e.g., in different threads).
+    """
+
+    def __init__(self, data: bytes, lower: Callable[[], bytes] = None):
+        """
+        If given, lower is called to produce the lowercased data should
+        it be needed, rather than lowercasing the data.
+        """
+        super().__init__()
         self.data = data
+        self._fold = lower
+        self._lower = None
 
+    @property
+    def lower(self) -> bytes:
+        """
+        The lowercased data.
+        """
+        if self._lower is None:
+            self._lower = self._fold() if self._fold else self.data.lower()
+        return self._lower
 
-def find_matches(pat: bytes, data: bytes) -> List[Match]:
+
+def find_matches(pat: bytes, data: bytes,
+                 matches: MatchList = None) -> MatchList:
     """
     This method finds all instances of pat (a bytes object)
     inside data (a larger bytes object), returning them
-    as a list of Match objects.
+    as a MatchList (matches, if given, is added to instead).
 
     If no matches are found, an empty list is returned.
     """
-    matches = []
+    if matches is None:
+        matches = MatchList(data)
+    offsets = matches.offsets.append
+    lengths = matches.lengths.append
+    index = data.index
+    size = len(pat)
 
     try:
-        i = data.index(pat)
+        i = index(pat)
 
         while True:
-            matches.append(Match(i, data[i:i + len(pat)]))
-            i = data.index(pat, i + len(pat))
+            offsets(i)
+            lengths(size)
+            i = index(pat, i + size)
     except ValueError:
         return matches
 
     return matches
+
+
+"""
+This is a type alias for the (anchor, before, head) triple returned by
+extract_anchor(). See extract_anchor() for the meaning of each field.
+"""
+Anchor = Tuple[bytes, Optional[int], Pattern]
+
+"""
+Anchored searches fall back to a full scan when there is more than one
+anchor hit per this many bytes, as the windows would then cover most of
+the data anyway.
+"""
+ANCHOR_SPARSITY = 128
+
+
+def _is_unbounded(width: int) -> bool:
+    return width >= sre_constants.MAXREPEAT
+
+
+@lru_cache(maxsize=None)
+def extract_anchor(pattern: bytes, flags: int = 0,
+                   folded: bool = False) -> Optional[Anchor]:
+    """
+    This method looks for a literal that every match of the regular
+    expression pattern must contain, so that the pattern only has to be
+    tried near the places that literal occurs.
+
+    It returns an (anchor, before, head) triple where before is the
+    furthest a match can start ahead of the anchor (None if that is
+    unbounded), and head is the compiled part of the pattern up to and
+    including the anchor. If the pattern has no top-level literal,
+    None is returned.
+
+    If folded is set, the data being searched is lowercased, so cased
+    literals are usable (in lowercase form) even when ignoring case.
+    """
+    parsed = sre_parse.parse(pattern, flags)
+    state = getattr(parsed, 'state', None) or parsed.pattern
+    nocase = not folded and state.flags & sre_constants.SRE_FLAG_IGNORECASE
+    items = list(parsed)
+
+    candidates = []
+    run = bytearray()
+    start = 0
+    offset = 0
+    for i, (op, av) in enumerate(items + [(None, None)]):
+        literal = (str(op) == 'LITERAL' and
+                   not (nocase and bytes([av]).isalpha()))
+        if literal:
+            if not run:
+                start = offset
+            run.append(av)
+        elif run:
+            candidates.append((bytes(run), start, i))
+            run = bytearray()
+        if i < len(items):
+            offset += sre_parse.SubPattern(state, [(op, av)]).getwidth()[1]
+
+    if not candidates:
+        return None
+
+    # Longer literals are rarer, and closer literals need smaller windows
+    anchor, before, end = max(candidates, key=lambda c: (len(c[0]), -c[1]))
+    head = sre_compile.compile(sre_parse.SubPattern(state, items[:end]),
+                               flags)
+    if _is_unbounded(before):
+        before = None
+    if folded:
+        anchor = anchor.lower()
+    return anchor, before, head
+
+
+def find_anchors(anchors: List[bytes], data: bytes,
+                 limit: int = None) -> Optional[List[Tuple[int, int]]]:
+    """
+    This method finds every (possibly overlapping) occurrence of each
+    anchor in data, returning a sorted list of (offset, length) tuples.
+
+    If more than limit occurrences are found, None is returned instead.
+    """
+    hits = []
+    for anchor in anchors:
+        find = data.find
+        size = len(anchor)
+        i = find(anchor)
+        while i != -1:
+            hits.append((i, size))
+            if limit is not None and len(hits) > limit:
+                return None
+            i = find(anchor, i + 1)
+    if len(anchors) > 1:
+        hits.sort()
+    return hits
+
+
+def search_anchored(regex: Pattern, data: bytes, anchors: List[bytes],
+                    before: int, head: Pattern = None) -> Iterator:
+    """
+    This method yields the same match objects as regex.finditer(data)
+    would, provided every match contains one of the anchors starting
+    at most before bytes into the match.
+
+    Instead of trying the regex at every offset of data, it is only
+    tried in the windows ahead of anchor hits. If head (the part of the
+    regex up to the anchor) is given, it is used to find the offsets
+    worth trying within each window.
+    """
+    hits = find_anchors(anchors, data, len(data) // ANCHOR_SPARSITY)
+    if hits is None:
+        yield from regex.finditer(data)
+        return
+
+    pos = 0  # no match may start before this offset
+    tried = 0  # every start before this offset has already been tried
+    width = before + max(len(a) for a in anchors) + 1
+
+    for hit, _ in hits:
+        lo = max(pos, tried, hit - before)
+        if lo > hit:
+            continue
+        tried = hit + 1
+
+        md = None
+        if head is None:
+            for start in range(lo, hit + 1):
+                md = regex.match(data, start)
+                if md is not None:
+                    break
+        else:
+            # the extra byte of the window lets \b look past the anchor
+            probe = head.search(data, lo, hit + width)
+            while probe is not None and probe.start() <= hit:
+                md = regex.match(data, probe.start())
+                if md is not None:
+                    break
+                probe = head.search(data, probe.start() + 1, hit + width)
+
+        if md is not None:
+            yield md
+            pos = max(md.end(), md.start() + 1)
+
+
+def widen(literal: bytes, big_endian: bool = False) -> bytes:
+    """
+    This method returns the UTF-16 (wide) copy of an ASCII literal, as
+    Windows stores most strings: little-endian, unless big_endian is set.
+    """
+    wide = bytearray(len(literal) * 2)
+    wide[1 if big_endian else 0::2] = literal
+    return bytes(wide)
+
+
+def narrow(data: bytes) -> bytes:
+    """
+    This method returns the ASCII copy of data matched as a wide string,
+    or data itself if it doesn't look wide.
+    """
+    if data and len(data) % 2 == 0:
+        if not data[1::2].strip(b'\x00'):
+            return data[::2]
+        if not data[::2].strip(b'\x00'):
+            return data[1::2]
+    return data
+
+
+def literal_regex(literals: List[bytes]) -> Pattern:
+    """
+    This method compiles a regular expression matching any of the
+    literals (e.g., a literal and its wide copies) in a single pass.
+    """
+    return re.compile(b'|'.join(re.escape(literal) for literal in literals))
+
+
+def _widen_items(items: list, big_endian: bool) -> list:
+    """
+    This method rewrites the items of a parsed regular expression to
+    match its wide copy: every character is followed (or preceded, if
+    big_endian) by a zero byte.
+    """
+    c = sre_constants
+    widened = []
+    for op, av in items:
+        if op in (c.LITERAL, c.NOT_LITERAL, c.IN, c.ANY):
+            pair = [(op, av), (c.LITERAL, 0)]
+            widened.extend(reversed(pair) if big_endian else pair)
+        elif op in (c.MAX_REPEAT, c.MIN_REPEAT) or \
+                str(op) == 'POSSESSIVE_REPEAT':
+            low, high, sub = av
+            widened.append((op, (low, high, _widen(sub, big_endian))))
+        elif op is c.SUBPATTERN:
+            group, add_flags, del_flags, sub = av
+            widened.append((op, (group, add_flags, del_flags,
+                                 _widen(sub, big_endian))))
+        elif op is c.BRANCH:
+            widened.append((op, (av[0], [_widen(sub, big_endian)
+                                         for sub in av[1]])))
+        elif op in (c.ASSERT, c.ASSERT_NOT):
+            direction, sub = av
+            widened.append((op, (direction, _widen(sub, big_endian))))
+        elif str(op) == 'ATOMIC_GROUP':
+            widened.append((op, _widen(av, big_endian)))
+        elif op is c.AT:
+            # Between the bytes of a wide string, every offset is a word
+            # boundary, so word boundaries can't be checked
+            if av not in (c.AT_BOUNDARY, c.AT_NON_BOUNDARY):
+                widened.append((op, av))
+        else:
+            raise ValueError('unable to widen regular expressions using %s'
+                             % op)
+    return widened
+
+
+def _widen(sub, big_endian: bool):
+    return sre_parse.SubPattern(sub.state if hasattr(sub, 'state')
+                                else sub.pattern,
+                                _widen_items(list(sub), big_endian))
+
+
+def wide_regex(pattern: bytes, flags: int = 0, little: bool = True,
+               big: bool = False, plain: bool = True) -> Pattern:
+    """
+    This method compiles a regular expression matching what pattern
+    matches (unless plain is unset), as well as its wide (UTF-16)
+    copies: little-endian and/or big-endian, in a single pass over the
+    data.
+
+    Wide copies are only of ASCII characters, and word boundaries aren't
+    checked in them.
+    """
+    parsed = sre_parse.parse(pattern, flags)
+    state = getattr(parsed, 'state', None) or parsed.pattern
+    branches = [parsed] if plain else []
+    if little:
+        branches.append(_widen(parsed, False))
+    if big:
+        branches.append(_widen(parsed, True))
+    either = sre_parse.SubPattern(
+        state, [(sre_constants.BRANCH, (None, branches))])
+    return sre_compile.compile(either, flags)
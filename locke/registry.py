@@ -0,0 +1,204 @@
+import os
+import sys
+from importlib import import_module
+
+"""
+The plugins Locke knows of, and the modules they're defined in, so
+plugin modules are only imported once a command needs them rather than
+whenever Locke starts.
+
+The built-in plugins are listed in a static manifest below, which must
+be kept in step with the plugin modules (the tests check it is). Other
+packages add plugins through entry points, each naming a module (or an
+object in one) whose import defines plugin classes:
+
+    entry_points={
+        'locke.transforms': ['mine = mypackage.locke_transforms'],
+        'locke.patterns': ['mine = mypackage.locke_patterns'],
+    }
+
+Entry points are looked up the first time plugins of their kind are
+loaded. importlib.metadata takes longer to import than most commands take
+to start, so it's only used once a package is found declaring some.
+
+Once loaded, plugins are found as before, by walking the subclasses of
+the plugin base classes.
+"""
+
+TRANSFORM_GROUP = 'locke.transforms'
+PATTERN_GROUP = 'locke.patterns'
+
+_LEVEL1 = 'locke.transforms.plugins.level1_transformers'
+_LEVEL2 = 'locke.transforms.plugins.level2_transformers'
+_LEVEL3 = 'locke.transforms.plugins.level3_transformers'
+_STAGE1 = 'locke.patterns.plugins.stage1_patterns'
+_STAGE2 = 'locke.patterns.plugins.stage2_patterns'
+
+# The built-in transformers: name -> tuple(level, module)
+TRANSFORMS = {
+    'TransformIdentity': (1, _LEVEL1),
+    'TransformXOR': (1, _LEVEL1),
+    'TransformAdd': (1, _LEVEL1),
+    'TransformROL': (1, _LEVEL1),
+    'TransformXOR_ROL': (1, _LEVEL1),
+    'TransformAdd_ROL': (1, _LEVEL1),
+    'TransformAdd_XOR': (1, _LEVEL1),
+    'TransformROL_Add': (1, _LEVEL1),
+    'TransformXOR_Add': (1, _LEVEL1),
+    'TransformOutlookPST': (-1, _LEVEL1),
+    'TransformXORInc': (2, _LEVEL2),
+    'TransformXORDec': (2, _LEVEL2),
+    'TransformSubInc': (2, _LEVEL2),
+    'TransformXORLChained': (2, _LEVEL2),
+    'TransformXORRChained': (2, _LEVEL2),
+    'TransformXORKey': (2, _LEVEL2),
+    'TransformXORInc_ROL': (3, _LEVEL3),
+    'TransformXORRChainedAll': (3, _LEVEL3),
+}
+
+# The built-in pattern plugins: name -> tuple(stage, module)
+PATTERNS = {
+    'OLE2Header': (1, _STAGE1),
+    'VBAMacros': (1, _STAGE1),
+    'FlashOLESignatures': (1, _STAGE1),
+    'PDFSignatures': (1, _STAGE1),
+    'RTFSignatures': (1, _STAGE1),
+    'DOSMessage': (1, _STAGE1),
+    'PEHeader': (1, _STAGE1),
+    'MZHeaders': (1, _STAGE1),
+    'PESectionNames': (1, _STAGE1),
+    'EXECommand': (1, _STAGE1),
+    'CommonWin32Functions': (1, _STAGE1),
+    'InterestingWin32Functions': (1, _STAGE1),
+    'InterestingWinSockFunctions': (1, _STAGE1),
+    'InterestingDLLs': (1, _STAGE1),
+    'InterestingRegKeys': (1, _STAGE1),
+    'CompiledWithMSVC': (1, _STAGE1),
+    'IPv4Address': (2, _STAGE2),
+    'EmailAddress': (2, _STAGE2),
+    'CommonURLs': (2, _STAGE2),
+    'IRCStrings': (1, _STAGE2),
+    'HexBlob': (2, _STAGE2),
+    'Base64Blob': (2, _STAGE2),
+    'WordLongerThan6': (2, _STAGE2),
+    'Sentence3Words': (2, _STAGE2),
+    'CamelCaseWord': (2, _STAGE2),
+    'MZFollowedByPE': (2, _STAGE2),
+}
+
+# The entry point groups looked up so far
+_discovered = set()
+
+
+def _declared(group):
+    """
+    Return:
+        Whether an installed package may declare entry points of the
+        group, from a quick read of the packages' entry_points.txt
+    """
+    header = '[%s]' % group
+    for directory in sys.path:
+        try:
+            entries = os.scandir(directory or os.curdir)
+        except NotADirectoryError:
+            return True  # A zip, which only importlib.metadata reads
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if not entry.name.endswith(('.dist-info', '.egg-info',
+                                            'EGG-INFO')):
+                    continue
+                try:
+                    with open(os.path.join(entry.path, 'entry_points.txt'),
+                              encoding='utf-8') as f:
+                        if header in f.read():
+                            return True
+                except (OSError, ValueError):
+                    pass
+    return False
+
+
+def _entry_points(group):
+    """
+    Return:
+        The entry points of the group, across installed packages
+    """
+    if not _declared(group):
+        return []
+    from importlib.metadata import entry_points
+    found = entry_points()
+    if hasattr(found, 'select'):
+        return list(found.select(group=group))
+    return list(found.get(group, ()))  # Python < 3.10
+
+
+def load_entry_points(group):
+    """
+    Import the plugins other packages declare for the group, once. A
+    plugin that fails to load is reported on stderr and skipped
+    Args:
+        group: TRANSFORM_GROUP or PATTERN_GROUP
+    """
+    if group in _discovered:
+        return
+    _discovered.add(group)
+    for entry_point in _entry_points(group):
+        try:
+            entry_point.load()
+        except Exception as e:
+            print('!! unable to load plugin %s: %s' % (entry_point.name, e),
+                  file=sys.stderr)
+
+
+def transform_modules(level=3, names=None):
+    """
+    Args:
+        level: The highest level of transformer needed (default = 3)
+        names: The names of the transformers needed, instead of a level
+            (case-insensitive, default = None)
+    Return:
+        The built-in modules to import for the transformers, or None if
+        a name isn't a built-in one
+    """
+    if names is None:
+        return sorted({module for trans_level, module in TRANSFORMS.values()
+                       if trans_level <= level})
+    lowered = {name.lower(): module
+               for name, (_, module) in TRANSFORMS.items()}
+    modules = set()
+    for name in names:
+        if name.strip().lower() not in lowered:
+            return None
+        modules.add(lowered[name.strip().lower()])
+    return sorted(modules)
+
+
+def load_transforms(level=3, names=None):
+    """
+    Import the modules defining the transformers needed, along with the
+    transformers of other packages
+    Args:
+        level: The highest level of transformer needed (default = 3)
+        names: The names of the transformers needed, instead of a level
+            (default = None)
+    """
+    modules = transform_modules(level, names)
+    if modules is None:
+        modules = transform_modules()
+    for module in modules:
+        import_module(module)
+    load_entry_points(TRANSFORM_GROUP)
+
+
+def load_patterns(stage=None):
+    """
+    Import the modules defining the pattern plugins of a stage (or of
+    every stage), along with the pattern plugins of other packages
+    Args:
+        stage: The stage of the pattern plugins needed (default = None)
+    """
+    for module in sorted({module for pat_stage, module in PATTERNS.values()
+                          if stage is None or pat_stage == stage}):
+        import_module(module)
+    load_entry_points(PATTERN_GROUP)
@@ -3,12 +3,14 @@ import sys
 
 from locke.transforms.transformer import _read_file
 from locke.transforms.transformer import TransformChar, TransformString
+from locke.registry import load_transforms
 
 # Nest array. One for each level
 TRANSFORMERS = [[], [], []]
 
 
 def load_all_transformers():
+    load_transforms()
     for cls in (TransformChar, TransformString):
         for trans in cls.__subclasses__():
             if 0 < trans.class_level() < 4:
@@ -0,0 +1,356 @@
+import json
+import marshal
+import os
+import pickle
+import re
+import tempfile
+import unittest
+
+from locke.patterns.manager import Manager
+from locke.patterns.pattern_plugin import BytesListPatternPlugin, \
+    REPatternPlugin
+from locke.patterns.pattern_set import PatternSet
+from locke.patterns.rules import load_rules, parse_rules, unload_rules
+from locke.patterns.utils import Match, MatchList, ScanContext, \
+    extract_anchor, find_matches, narrow, pack_matches, search_anchored, \
+    wide_regex, widen
+from locke.patterns.plugins.stage1_patterns import FlashOLESignatures
+from locke.patterns.plugins.stage2_patterns import IPv4Address, \
+    EmailAddress, CommonURLs, MZFollowedByPE
+
+
+class Unbounded(REPatternPlugin):
+    """
+    Email addresses of any length. Its stage is never scanned
+    """
+    Stage = 0
+    Description = 'Unbounded'
+    Pattern = rb'\b[a-z]+@[a-z.]+\b'
+    AnchorWindow = 64
+
+
+class TestingAnchors(unittest.TestCase):
+    def setUp(self):
+        # A little of everything, with plenty of near misses
+        self.data = (b'MZ' + b'\x90' * 40 + b'PE\x00\x00 MZ..PE\x00\x00 '
+                     b'10.0.0.1 1.2.3 999.1.1.1 a.b.c.d ftp:// '
+                     b'see http://example.com/a?b=c, mail bob@example.com '
+                     b'or @nobody. ' + b'x' * 70 + b'@toolong.com') * 3
+
+    def test_extract(self):
+        anchor, before, head = extract_anchor(MZFollowedByPE.Pattern.encode())
+        self.assertEqual(anchor, b'PE\x00\x00')
+        self.assertEqual(before, 2 + 1024)
+        self.assertIsNotNone(head)
+        anchor, before, _ = extract_anchor(CommonURLs.Pattern.encode())
+        self.assertEqual((anchor, before), (b'://', 5))
+        # The local part of an email address is up to 64 bytes...
+        anchor, before, _ = extract_anchor(EmailAddress.Pattern.encode())
+        self.assertEqual((anchor, before), (b'@', 64))
+        # ...and the distance to an anchor may be unbounded
+        anchor, before, _ = extract_anchor(Unbounded.Pattern)
+        self.assertEqual((anchor, before), (b'@', None))
+        # Cased literals can't anchor a case-insensitive pattern...
+        self.assertIsNone(extract_anchor(b'(?i)abc[0-9]'))
+        # ...unless the data is lowercased first
+        anchor, _, _ = extract_anchor(b'ABC[0-9]', re.IGNORECASE, True)
+        self.assertEqual(anchor, b'abc')
+        self.assertIsNone(extract_anchor(b'[a-z]+'))
+
+    def test_search(self):
+        for cls in (IPv4Address, CommonURLs, MZFollowedByPE, EmailAddress):
+            with self.subTest(cls=cls.__name__):
+                pat = cls()
+                self.assertTrue(pat.Anchors)
+                expected = [(m.start(), m.group())
+                            for m in pat.regex.finditer(self.data)]
+                self.assertTrue(expected)
+                self.assertEqual(expected, [(m.offset, m.data)
+                                            for m in pat.find_all(self.data)])
+
+    def test_window(self):
+        # Matches starting further ahead of the anchor than the declared
+        # window are given up when anchor hits are sparse
+        pat = Unbounded()
+        found = [m.data for m in pat.find_all(self.data + b'\x00' * 10000)]
+        self.assertIn(b'bob@example.com', found)
+        self.assertNotIn(b'x' * 70 + b'@toolong.com', found)
+        self.assertIn(b'x' * 70 + b'@toolong.com',
+                      [m.group() for m in pat.regex.finditer(self.data)])
+
+    def test_local_part(self):
+        # Local parts over 64 bytes aren't email addresses
+        found = [m.data for m in EmailAddress().find_all(self.data)]
+        self.assertEqual(found, [b'bob@example.com'] * 3)
+
+    def test_declared(self):
+        regex = re.compile(rb'\d+:\d+')
+        found = search_anchored(regex, b'a 12:34 b 5:6', [b':'], 8)
+        self.assertEqual([m.group() for m in found], [b'12:34', b'5:6'])
+
+
+class TestingCount(unittest.TestCase):
+    def test_count(self):
+        data = (b'MZ\x90\x00This program cannot be run in DOS mode PEPE '
+                b'kernel32 KERNEL32 http://a.example.com 1.2.3.4 999.9.9.9 '
+                b'PRIVMSG privmsg ABCDEF0123456789ABCDEF0123456789ab') * 4
+        for stage in (1, 2):
+            mgr = Manager(raw=data, stage=stage)
+            for (pat, matches), (_, count) in zip(mgr.run(), mgr.count()):
+                with self.subTest(pat=pat.Description):
+                    self.assertEqual(len(matches), count)
+
+
+class TestingMatchList(unittest.TestCase):
+    def setUp(self):
+        self.data = bytearray(b'xxPEyyPEzzPE')
+        self.matches = find_matches(b'PE', self.data)
+
+    def test_views(self):
+        self.assertIsInstance(self.matches, MatchList)
+        self.assertEqual(len(self.matches), 3)
+        self.assertEqual(list(self.matches.offsets), [2, 6, 10])
+        # Matches are views into the scanned data until copied out
+        self.data[6:8] = b'pe'
+        self.assertEqual(self.matches[1].view, b'pe')
+        self.assertEqual([m.data for m in self.matches], [b'PE', b'pe', b'PE'])
+
+    def test_pack(self):
+        packed = self.matches.pack()
+        self.assertEqual(bytes(packed.source), b'PEPEPE')
+        self.assertEqual(list(packed.items()), list(self.matches.items()))
+        unpickled = pickle.loads(pickle.dumps(self.matches))
+        self.assertEqual(list(unpickled.items()), list(self.matches.items()))
+        selected = packed.select(lambda m: m.offset > 2)
+        self.assertEqual(list(selected.items()), [(6, b'PE'), (10, b'PE')])
+        listed = pack_matches([Match(4, b'ab'), Match(9, b'cde')])
+        self.assertEqual(list(listed.items()), [(4, b'ab'), (9, b'cde')])
+
+
+class TestingScanContext(unittest.TestCase):
+    def test_lazy_lower(self):
+        folds = []
+
+        def lower():
+            folds.append(1)
+            return b'abc'
+
+        ctx = ScanContext(b'ABC', lower)
+        self.assertEqual(ctx.data, b'ABC')
+        self.assertFalse(folds)
+        self.assertEqual(ctx.lower, b'abc')
+        self.assertEqual(ctx.lower, b'abc')
+        self.assertEqual(len(folds), 1)
+
+    def test_independent(self):
+        # Interleaved scans mustn't see each other's data
+        first = Manager(raw=b'MZ this program', stage=1)
+        second = Manager(raw=b'PROGRAM PROGRAM', stage=1)
+        second_hits = {pat.Description: len(m) for pat, m in second.run()}
+        first_hits = {pat.Description: len(m) for pat, m in first.run()}
+        self.assertEqual(first_hits['EXE MZ header magics'], 1)
+        self.assertEqual(first_hits['Common EXE strings'], 1)
+        self.assertEqual(second_hits['EXE MZ header magics'], 0)
+        self.assertEqual(second_hits['Common EXE strings'], 2)
+
+
+class TestingPatternSet(unittest.TestCase):
+    def setUp(self):
+        self.compiled = dict(PatternSet._compiled)
+
+    def tearDown(self):
+        # Other tests' sets are left as they were, cleared or not
+        PatternSet._compiled.clear()
+        PatternSet._compiled.update(self.compiled)
+
+    def test_shared(self):
+        first = Manager(raw=b'MZ', stage=1)
+        second = Manager(raw=b'PE', stage=1)
+        self.assertIs(first.pattern_set, second.pattern_set)
+        self.assertIs(first.pats[0], second.pats[0])
+        self.assertIsNot(first.pattern_set,
+                         Manager(raw=b'', stage=2).pattern_set)
+        # Patterns are validated once, when the set is compiled
+        self.assertIsInstance(first.pats[0].Pattern, (bytes, list))
+
+    def test_patterns(self):
+        pats = [IPv4Address, EmailAddress]
+        compiled = PatternSet.get(patterns=pats)
+        self.assertIs(PatternSet.get(patterns=pats), compiled)
+        self.assertEqual([type(pat) for pat in compiled.pats], pats)
+        mgr = Manager(raw=b'a@example.com 10.0.0.1', patterns=compiled)
+        self.assertEqual([len(m) for _, m in mgr.run()], [1, 1])
+
+    def test_clear(self):
+        compiled = PatternSet.get(stage=2)
+        PatternSet.clear()
+        self.assertIsNot(PatternSet.get(stage=2), compiled)
+
+
+class TestingWide(unittest.TestCase):
+    def test_widen(self):
+        self.assertEqual(widen(b'ab'), b'a\x00b\x00')
+        self.assertEqual(widen(b'ab', big_endian=True), b'\x00a\x00b')
+        self.assertEqual(narrow(widen(b'abc')), b'abc')
+        self.assertEqual(narrow(widen(b'abc', True)), b'abc')
+        self.assertEqual(narrow(b'abcd'), b'abcd')
+
+    def test_literals(self):
+        class Functions(BytesListPatternPlugin):
+            Description = 'Functions'
+            Patterns = ['WinExec', 'CreateProcess']
+            NoCase = True
+            Wide = True
+
+        data = b'CreateProcessA ' + widen(b'WINEXEC') + b' winexec'
+        pat = Functions()
+        found = pat.scan(ScanContext(data))
+        self.assertEqual(sorted(found.items()),
+                         [(0, b'createprocess'), (15, widen(b'winexec')),
+                          (30, b'winexec')])
+        self.assertEqual(pat.count_all(data.lower()), 3)
+
+        # Any wide ShockwaveFlash, not only the wide ProgID
+        flash = FlashOLESignatures()
+        self.assertEqual(flash.count_all(widen(b'ShockwaveFlash.1')), 1)
+
+    def test_regex(self):
+        url = b'http://example.com/a'
+        data = b'x ' + url + b' ' + widen(url) + b' '
+        found = [narrow(m.data) for m in CommonURLs().find_all(data)]
+        self.assertEqual(found, [url, url])
+
+        data += widen(url, big_endian=True) + b' '
+
+        class BigEndianURLs(REPatternPlugin):
+            Description = 'URL'
+            Pattern = CommonURLs.Pattern
+            Wide = True
+            WideBE = True
+
+        found = [narrow(m.data) for m in BigEndianURLs().find_all(data)]
+        self.assertEqual(found, [url, url, url])
+
+        # Anchored patterns find wide copies near the wide anchors
+        data = b'\x00' * 10000 + widen(b'mail bob@example.com now')
+        found = [m.data for m in EmailAddress().find_all(data)]
+        self.assertEqual(found, [widen(b'bob@example.com')])
+
+    def test_one_pass(self):
+        regex = wide_regex(rb'ab+[^c]', little=True, big=True)
+        data = b'abbd ' + widen(b'abbd') + b' ' + widen(b'abd', True)
+        self.assertEqual([narrow(m.group()) for m in regex.finditer(data)],
+                         [b'abbd', b'abbd', b'abd'])
+        with self.assertRaises(ValueError):
+            wide_regex(rb'(a)\1')
+
+    def test_filter(self):
+        # Filters see the text of wide matches, not the wide bytes
+        class WideIPv4Address(IPv4Address):
+            Wide = True
+
+        data = widen(b' 10.0.0.1 and 999.1.1.1 ')
+        found = [narrow(m.data) for m in WideIPv4Address().scan(
+            ScanContext(data))]
+        self.assertEqual(found, [b'10.0.0.1'])
+
+
+class TestingRules(unittest.TestCase):
+    rules = [
+        {'description': 'Bad host', 'type': 'literals', 'stage': 2,
+         'weight': 1000, 'nocase': True,
+         'patterns': ['evil.example', 'evil.example.net', 'c2.test']},
+        # Merged with the rule above, into one pattern
+        {'description': 'Bad host', 'type': 'literal', 'stage': 2,
+         'weight': 1000, 'nocase': True, 'pattern': 'worse.example'},
+        {'description': 'Magic', 'type': 'literal', 'stage': 2,
+         'hex': 'deadbeef', 'weight': 50},
+        {'description': 'Mutex', 'type': 'regex', 'stage': 2,
+         'pattern': 'mtx_[0-9]{4}', 'weight': 500},
+    ]
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'rules.json')
+        with open(self.path, 'w') as f:
+            json.dump(self.rules, f)
+        self.data = (b'get EVIL.EXAMPLE.NET/x worse.example mtx_0042 '
+                     b'\xde\xad\xbe\xef c2.test')
+
+    def tearDown(self):
+        unload_rules()
+        self.tmp.cleanup()
+
+    def hits(self):
+        return {pat.Description: [m.data for m in matches] for pat, matches
+                in Manager(raw=self.data, stage=2).run() if matches}
+
+    def test_load(self):
+        cache = os.path.join(self.tmp.name, 'cache')
+        load_rules(self.path, cache)
+        hits = self.hits()
+        # The longest literal wins, whatever the case
+        self.assertEqual(hits['Bad host'], [b'evil.example.net',
+                                            b'worse.example', b'c2.test'])
+        self.assertEqual(hits['Magic'], [b'\xde\xad\xbe\xef'])
+        self.assertEqual(hits['Mutex'], [b'mtx_0042'])
+        self.assertEqual(len(os.listdir(cache)), 1)
+
+        # The second time around, the compiled rules come from the cache
+        unload_rules()
+        self.assertNotIn('Bad host', self.hits())
+        load_rules(self.path, cache)
+        self.assertEqual(self.hits(), hits)
+
+    def test_bad_cache(self):
+        cache = os.path.join(self.tmp.name, 'cache')
+        load_rules(self.path, cache)
+        hits = self.hits()
+        unload_rules()
+        # Regex code the engine can't run is never rebuilt from
+        cache_file = os.path.join(cache, os.listdir(cache)[0])
+        with open(cache_file, 'rb') as f:
+            form = marshal.load(f)
+        pattern, flags, code = form['compiled'][0][:3]
+        form['compiled'][0] = (pattern, flags, b'\xff' * len(code)) + \
+            form['compiled'][0][3:]
+        with open(cache_file, 'wb') as f:
+            marshal.dump(form, f)
+        load_rules(self.path, cache)
+        self.assertEqual(self.hits(), hits)
+
+    def test_groups(self):
+        # Literals of one pattern don't hide those of another
+        with open(self.path, 'w') as f:
+            json.dump([{'description': 'Long', 'type': 'literal',
+                        'pattern': 'evil.example.net'},
+                       {'description': 'Short', 'type': 'literals',
+                        'patterns': ['evil.example', 'example.net']}], f)
+        load_rules(self.path, None)
+        hits = {pat.Description: [m.data for m in matches] for pat, matches
+                in Manager(raw=b'evil.example.net', stage=1).run()
+                if matches}
+        self.assertEqual(hits['Long'], [b'evil.example.net'])
+        self.assertEqual(hits['Short'], [b'evil.example'])
+
+    def test_no_cache(self):
+        rule_set = load_rules(self.path, None)
+        self.assertEqual(len(rule_set.patterns(2)), 3)
+        self.assertEqual(rule_set.patterns(1), [])
+
+    def test_invalid(self):
+        for rule in ({'description': 'x', 'type': 'glob', 'pattern': 'a'},
+                     {'type': 'literal', 'pattern': 'a'},
+                     {'description': 'x', 'type': 'literals', 'patterns': []},
+                     {'description': 'x', 'type': 'literal', 'hex': 'zz'},
+                     {'description': 'x', 'type': 'literal', 'pattern': 'a',
+                      'weight': '1'},
+                     {'description': 'x', 'type': 'regex',
+                      'pattern': 'mtx_[0-9'}):
+            with self.subTest(rule=rule):
+                with self.assertRaises(ValueError):
+                    parse_rules(json.dumps([rule]))
+
+
+if __name__ == '__main__':
+    unittest.main()
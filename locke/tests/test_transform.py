@@ -1,16 +1,73 @@
+import asyncio
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import unittest.mock
+import zipfile
+from functools import partial
+from multiprocessing.connection import Client
+from multiprocessing.pool import ThreadPool
+from multiprocessing.shared_memory import SharedMemory
 
+from locke.registry import PATTERNS, TRANSFORMS, load_transforms
 from locke.transforms.transformer import TransformChar, TransformString, \
-    select_transformers, to_bytes, rol, _iteration_transformer
+    TransformAllStage1, select_transformers, to_bytes, rol, \
+    _iteration_transformer, _run_stage, _stage_tasks, _transform_data, \
+    rank_results, read_data, run_transformations, xor_chained
 from locke.transforms.plugins.level1_transformers import TransformIdentity, \
     TransformXOR, TransformROL, TransformAdd, TransformXOR_ROL, \
-    TransformROL_Add, TransformAdd_ROL
+    TransformROL_Add, TransformAdd_ROL, TransformXOR_Add
+from locke.transforms.plugins.level2_transformers import TransformXORInc, \
+    TransformXORKey, TransformXORDec, TransformSubInc, \
+    TransformXORLChained, TransformXORRChained
+from locke.transforms.plugins.level3_transformers import \
+    TransformXORInc_ROL, TransformXORRChainedAll
+from locke.transforms.keysolver import key_lengths, solve_keys
+from locke.transforms.utils import DBFILE
+from locke.transforms.records import RecordWriter, match_records, \
+    transform_records
+from locke.transforms.regions import RegionMap, entropy_map, \
+    write_entropy_map
+from locke.transforms.segments import best_per_block, fixed_bounds, \
+    merge_blocks
+from locke.patterns import PatternPlugin
+from locke.patterns.pattern_plugin import BytesListPatternPlugin, \
+    REPatternPlugin
+from locke.patterns.pattern_set import PatternSet
+from locke.patterns.utils import MatchList
+from locke.transforms.archive import iter_members
+from locke.transforms.budget import BudgetRunner, Truncated, is_truncated
+from locke.transforms.aio import crack_async, iter_crack_async, search_async
+from locke.transforms.cascade import HistogramStage, PatternStage, Stage, \
+    parse_cascade, scratch_buffer
+from locke.transforms.chain import TransformChain, _prefix_cache, \
+    beam_search
+from locke.transforms.checkpoint import Checkpoint, checkpoint_key, \
+    run_keyspace
+from locke.transforms.differential import FAMILIES, DeltaFamily, \
+    family_key, place_scored, score_families
+from locke.transforms.distributed import Coordinator, KeyspaceServer, \
+    partition, run_worker
+from locke.transforms.engine import Engine, default_transformers
+from locke.transforms.events import ProgressTracker
+from locke.transforms.shards import MIN_SHARD_SIZE, merge_shards, \
+    scan_shard, shard_bounds, shard_count
 
 # Nest array. One for each level
 TRANSFORMERS = [[], [], []]
 
 
 def load_all_transformers():
+    load_transforms()
     for cls in (TransformChar, TransformString):
         for trans in cls.__subclasses__():
             if 0 < trans.class_level() < 4:
@@ -151,6 +208,23 @@ class TestingBasicTransforms(unittest.TestCase):
         self.assertEqual(adata, tdata)
         self.assertEqual(self.data, t.transform(tdata, True))
 
+    def test_transform_lower(self):
+        # Folding case into the table should match lowercasing afterwards
+        data = bytes(range(256))
+        for t in (TransformIdentity(None), TransformXOR(self.genKey),
+                  TransformROL_Add((3, 7))):
+            with self.subTest(t=t.shortname()):
+                self.assertEqual(t.transform(data).lower(),
+                                 t.transform_lower(data))
+
+    def test_table_cached(self):
+        t = TransformXOR(self.genKey)
+        t.transform(self.data)
+        t.generate_trans_table = None
+        # The tables, lowercased or not, come from the first one generated
+        self.assertEqual(t.transform_lower(self.data),
+                         t.transform(self.data).lower())
+
     def test_add(self):
         # we need to test the limiter
         t = TransformAdd(250)
@@ -189,6 +263,972 @@ class TestingBasicTransforms(unittest.TestCase):
         self.assertEqual(adata, tdata)
         self.assertEqual(self.data, t.transform(tdata, True))
 
+    def test_string_transforms(self):
+        # Each string transform, worked out a byte at a time. The data is
+        # longer than the 256 bytes their keys cycle over
+        data = bytes(random.Random(1).randrange(256) for _ in range(600))
+        k, n = self.genKey, len(data)
+        expected = {
+            TransformXORInc(k): [data[i] ^ ((k + i) & 0xFF)
+                                 for i in range(n)],
+            TransformXORDec(k): [data[i] ^ ((k + 0xFF - i) & 0xFF)
+                                 for i in range(n)],
+            TransformSubInc(k): [(data[i] - k - i) & 0xFF
+                                 for i in range(n)],
+            TransformXORLChained(k): [data[0] ^ k] + [
+                data[i] ^ k ^ data[i - 1] for i in range(1, n)],
+            TransformXORRChained(k): [
+                data[i] ^ k ^ data[i + 1] for i in range(n - 1)] + [
+                data[-1] ^ k],
+            TransformXORInc_ROL((k, 3)): [rol(data[i] ^ ((k + i) & 0xFF), 3)
+                                          for i in range(n)],
+            TransformXORRChainedAll(k): [0] + [
+                data[i] ^ k ^ data[i + 1] for i in range(1, n - 1)] + [
+                data[-1] ^ k],
+        }
+        for t, adata in expected.items():
+            with self.subTest(t=t.shortname()):
+                self.assertEqual(bytes(adata), t.transform(data))
+                out = bytearray(n)
+                self.assertEqual(bytes(adata),
+                                 bytes(t.transform_into(data, out)))
+
+    def test_xor_chained_blocks(self):
+        # The neighbours of the bytes at the edges of each block are
+        # picked up from the next or previous block
+        data = bytes(random.Random(2).randrange(256) for _ in range(20))
+        for size in (0, 1, 2, 7, 8, 20):
+            padded = b'\0' + data[:size] + b'\0'
+            for step in (-1, 1):
+                adata = bytes(padded[i] ^ 0x5A ^ padded[i + step]
+                              for i in range(1, size + 1))
+                with self.subTest(size=size, step=step):
+                    self.assertEqual(
+                        adata, xor_chained(data[:size], bytearray(size),
+                                           0x5A, step, 7))
+
+
+class TestingEvents(unittest.TestCase):
+    def test_tracker(self):
+        events = []
+        tracker = ProgressTracker(1, 3, 100, [events.append], interval=0)
+        for score in (5, 9, 2):
+            tracker.update((None, score, []))
+        tracker.finish()
+        self.assertEqual([e.kind for e in events],
+                         ['start', 'progress', 'progress', 'progress', 'end'])
+        end = events[-1]
+        self.assertEqual((end.done, end.total, end.best), (3, 3, 9))
+        self.assertEqual(end.eta, 0)
+        self.assertAlmostEqual(end.byte_rate, end.rate * 100)
+
+
+class TestingRecords(unittest.TestCase):
+    def setUp(self):
+        matches = MatchList(b'xx10.0.0.1')
+        matches.append(2, 8)
+        self.msgs = [['IPv4 address', 100, matches]]
+
+    def test_writer(self):
+        stream = io.StringIO()
+        writer = RecordWriter(stream, buffer_size=60)
+        writer.write({'n': 1})
+        self.assertEqual(stream.getvalue(), '')
+        writer.write({'n': 'x' * 60})
+        self.assertEqual(stream.getvalue().count('\n'), 2)
+        writer.write({'n': 3})
+        writer.flush()
+        self.assertEqual([json.loads(line)['n'] for line in
+                          stream.getvalue().splitlines()], [1, 'x' * 60, 3])
+
+    def test_records(self):
+        self.assertEqual(list(match_records('f', self.msgs)),
+                         [{'type': 'match', 'file': 'f', 'offset': 2,
+                           'pattern': 'IPv4 address', 'weight': 100,
+                           'length': 8, 'data': b'10.0.0.1'.hex()}])
+        records = list(transform_records(
+            'f', [(TransformXOR(0x42), 800, self.msgs)], matches=True))
+        self.assertEqual(records[0]['name'], 'XOR 42')
+        self.assertEqual(records[0]['patterns'],
+                         [{'pattern': 'IPv4 address', 'weight': 100,
+                           'count': 1}])
+        self.assertEqual(records[1]['transform'], 'XOR 42')
+
+
+class TestingAsync(unittest.TestCase):
+    def setUp(self):
+        plain = b'This program cannot be run in DOS mode. kernel32.dll ' * 8
+        self.plain = plain
+        self.data = TransformXOR(0x2A).transform(plain, True)
+
+    def test_crack(self):
+        stages = []
+
+        async def crack():
+            async for stage, results in iter_crack_async(
+                    self.data, [TransformXOR, TransformAdd], keep=3):
+                stages.append((stage, len(results)))
+            return await crack_async(self.data, [TransformXOR], save=1)
+
+        results = asyncio.run(crack())
+        self.assertEqual(stages, [(1, 3), (2, 3)])
+        self.assertEqual(results[0][0].value, 0x2A)
+
+    def test_search(self):
+        msgs = asyncio.run(search_async(self.plain))
+        self.assertIn('Any word longer >= 6 characters', [m[0] for m in msgs])
+        # Run on the default executor, without starting a process
+        self.assertFalse(multiprocessing.active_children())
+        pool = ThreadPool(1)
+        self.assertEqual([m[0] for m in asyncio.run(search_async(self.plain,
+                                                                 pool))],
+                         [m[0] for m in msgs])
+        pool.close()
+
+    def test_cancel(self):
+        async def crack():
+            task = asyncio.ensure_future(crack_async(self.data * 64,
+                                                     [TransformXOR_Add]))
+            await asyncio.sleep(0.5)
+            task.cancel()
+            await task
+
+        with self.assertRaises(asyncio.CancelledError):
+            asyncio.run(crack())
+        # The pool's workers were stopped rather than left running
+        self.assertFalse(multiprocessing.active_children())
+
+
+class TestingXORKey(unittest.TestCase):
+    def setUp(self):
+        self.text = (
+            b'Multi-byte XOR keys are the most common encoding seen in the '
+            b'wild. Rather than trying every key, which is infeasible beyond '
+            b'a single byte, the length of the key is estimated from how '
+            b'often bytes repeat, and then each column of the data is solved '
+            b'as single byte XOR against the frequencies of plaintext. The '
+            b'best few keys go on to be scored by the patterns, just like '
+            b'any other transform. This keeps the cost linear in the size of '
+            b'the data and the number of key lengths tried.\r\n') * 2
+        self.key = b'S3cr3tK3y'
+
+    def test_transform(self):
+        trans = TransformXORKey(self.key)
+        self.assertEqual(trans.name(), 'XOR Key 5333637233744B3379')
+        data = trans.transform(self.text, True)
+        self.assertEqual(data[:9], bytes(a ^ b for a, b in
+                                         zip(self.text, self.key)))
+        self.assertEqual(trans.transform(data), self.text)
+
+    def test_solve(self):
+        data = TransformXORKey(self.key).transform(self.text, True)
+        self.assertEqual(key_lengths(data)[0], len(self.key))
+        self.assertEqual(solve_keys(data)[0], self.key)
+        tasks = list(_iteration_transformer([(TransformXORKey, 1)], data))
+        self.assertIn(self.key, [trans.value for trans, _ in tasks])
+        # Without the data, there is nothing to try
+        self.assertEqual(
+            list(_iteration_transformer([(TransformXORKey, 1)])), [])
+
+    def test_solve_binary(self):
+        plain = (b'MZ\x90\x00' + b'\x00' * 60 + self.text[:200] +
+                 b'\x00' * 300 + b'\xff' * 20) * 4
+        data = TransformXORKey(b'\x8a\x11\xd3').transform(plain, True)
+        self.assertIn(b'\x8a\x11\xd3', solve_keys(data))
+
+
+class TestingRegions(unittest.TestCase):
+    def setUp(self):
+        noise = random.Random(1).randbytes(16 * 1024)
+        plain = (b'This program cannot be run in DOS mode.\r\n' +
+                 b'\x00' * 64) * 30
+        self.payload = TransformXOR(0x42).transform(plain, True)
+        # Noise, the payload, zero padding and noise again
+        self.data = (noise[:8192] + self.payload + b'\x00' * 4096 +
+                     noise[8192:])
+
+    def test_locate(self):
+        region_map = RegionMap.locate(self.data)
+        self.assertEqual(len(region_map.regions), 1)
+        start, stop = region_map.regions[0]
+        # Whole blocks around the payload
+        self.assertLessEqual(start, 8192)
+        self.assertGreaterEqual(stop, 8192 + len(self.payload))
+        self.assertLess(stop - start, len(self.payload) + 2048)
+        self.assertEqual(region_map.data, self.data[start:stop])
+        self.assertEqual(region_map.to_file(10), start + 10)
+
+    def test_remap(self):
+        region_map = RegionMap(self.data, [(100, 200), (1000, 1100)])
+        matches = MatchList(region_map.data)
+        matches.append(5, 1)
+        matches.append(150, 2)
+        region_map.remap([(None, 1, [['desc', 1, matches]])])
+        self.assertEqual(list(matches.offsets), [105, 1050])
+
+    def test_whole_file(self):
+        region_map = RegionMap.locate(self.payload)
+        self.assertEqual(region_map.regions, [(0, len(self.payload))])
+
+    def test_export(self):
+        stream = io.StringIO()
+        write_entropy_map(entropy_map(self.data), stream)
+        rows = stream.getvalue().splitlines()
+        self.assertEqual(rows[0], 'Offset,Length,Entropy,Printable,Zeros,'
+                                  'Candidate')
+        self.assertEqual(len(rows), 1 + len(self.data) // 1024 + 1)
+
+
+class TestingSegments(unittest.TestCase):
+    def test_best_per_block(self):
+        noise = random.Random(1).randbytes(2048)
+        plain = (b'MZ\x90\x00This program cannot be run in DOS mode.\r\n'
+                 b'kernel32.dll GetProcAddress LoadLibraryA ' * 20)[:2048]
+        data = (noise + TransformXOR(0x2A).transform(plain, True) +
+                TransformAdd(0x17).transform(plain, True) + noise)
+        bounds = fixed_bounds(len(data), 1024)
+        self.assertEqual(bounds, [0, 1024, 2048, 3072, 4096, 5120, 6144,
+                                  7168])
+        with self.assertRaises(ValueError):
+            fixed_bounds(len(data), 0)
+        best = best_per_block([TransformXOR, TransformAdd], data, bounds,
+                              backend='thread')
+        self.assertEqual(len(best), len(bounds))
+        segments = merge_blocks(best, bounds, len(data))
+        found = {(start, stop): trans.name() for start, stop, trans, _
+                 in segments if trans is not None}
+        self.assertEqual(found[(2048, 4096)], 'XOR 2A')
+        self.assertEqual(found[(4096, 6144)], 'Add 17')
+
+    def test_merge(self):
+        xor, other = TransformXOR(1), TransformXOR(2)
+        best = [(xor, 1), (TransformXOR(1), 2), (None, 0), (other, 5)]
+        self.assertEqual(merge_blocks(best, [0, 10, 20, 30], 35),
+                         [(0, 20, xor, 3), (20, 30, None, 0),
+                          (30, 35, other, 5)])
+
+
+class TestingCascade(unittest.TestCase):
+    def setUp(self):
+        plain = b'This program cannot be run in DOS mode. kernel32.dll ' * 8
+        self.data = TransformXOR(0x2A).transform(plain, True)
+
+    def test_parse(self):
+        cascade = parse_cascade('histogram:100, 1:20,2')
+        self.assertEqual([type(s) for s in cascade],
+                         [HistogramStage, PatternStage, PatternStage])
+        self.assertEqual([s.keep for s in cascade], [100, 20, None])
+        self.assertEqual(cascade[2].patterns, 2)
+        with self.assertRaises(ValueError):
+            parse_cascade('regex:5')
+
+    def test_histogram(self):
+        data = TransformXOR(0x2A).transform(b'ab C1', True)
+        _, score, msgs = HistogramStage().score(TransformXOR(0x2A), data)
+        self.assertEqual((score, msgs), (3, []))
+
+    def test_abstract(self):
+        with self.assertRaises(TypeError):
+            Stage()
+
+        class Length(Stage):
+            def score(self, transformer, data, details=True):
+                return transformer, len(data), []
+
+        # Only score is needed; the hooks are gated on the stage's flags
+        stage = Length()
+        self.assertEqual(stage.score(TransformXOR(1), b'ab')[1], 2)
+        self.assertFalse(stage.shardable or stage.blockwise)
+        with self.assertRaises(ValueError):
+            best_per_block([TransformXOR], self.data, [0], stage,
+                           backend='thread')
+
+    def test_cascade(self):
+        stages = []
+        cascade = [HistogramStage(16), PatternStage(1, 4), PatternStage(2)]
+
+        async def crack():
+            async for stage, results in iter_crack_async(
+                    self.data, [TransformXOR, TransformAdd],
+                    backend='thread', cascade=cascade):
+                stages.append((stage, len(results)))
+            return results
+
+        results = asyncio.run(crack())
+        self.assertEqual(stages, [(1, 16), (2, 4), (3, 4)])
+        self.assertEqual(results[0][0].value, 0x2A)
+        self.assertTrue(results[0][2])
+
+    def test_last_keep(self):
+        # The last stage is cut to what it keeps before being printed
+        cascade = [HistogramStage(16), PatternStage(1, 5), PatternStage(2, 3)]
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            results = run_transformations(
+                [TransformXOR, TransformAdd], None, 5, data=self.data,
+                backend='thread', cascade=cascade)
+        self.assertEqual(len(results), 3)
+        self.assertEqual(out.getvalue().count('Transform: '), 3)
+
+    def test_scratch(self):
+        # Transforms written into the scratch buffer don't disturb the
+        # matches kept from the transforms before them
+        self.assertIs(scratch_buffer(10), scratch_buffer(10))
+        pool = ThreadPool(1)
+        self.assertIsNot(pool.apply(scratch_buffer, (10,)),
+                         scratch_buffer(10))
+        pool.close()
+
+        stage = PatternStage(1)
+        plain = b'This program cannot be run in DOS mode. kernel32.dll ' * 8
+        data = TransformXORInc(0x2A).transform(plain, True)
+        _, score, msgs = stage.score(TransformXORInc(0x2A), data)
+        before = [(desc, list(matches.items())) for desc, _, matches in msgs]
+        self.assertTrue(score)
+        for key in (0x2B, 0x2C):
+            stage.score(TransformXORInc(key), data)
+        self.assertEqual(before, [(desc, list(matches.items()))
+                                  for desc, _, matches in msgs])
+
+
+class TestingShards(unittest.TestCase):
+    def setUp(self):
+        self.plain = (b'MZ This program cannot be run in DOS mode. Mail '
+                      b'admin@example.com or see http://www.example.com/ '
+                      + b'word ' * 100 + b'\x00\x01' * 40) * 12
+
+    def test_bounds(self):
+        self.assertEqual(shard_bounds(10, 3, 2),
+                         [(0, 4, 6), (4, 8, 10), (8, 10, 10)])
+        self.assertEqual(shard_count(1000, 1, 8), 1)
+        self.assertEqual(shard_count(MIN_SHARD_SIZE * 3, 1, 8), 3)
+        self.assertEqual(shard_count(MIN_SHARD_SIZE * 8, 2, 8), 4)
+        self.assertEqual(shard_count(MIN_SHARD_SIZE * 8, 20, 8), 1)
+
+    def test_transform_range(self):
+        for trans in (TransformXOR(0x2A), TransformXORInc(0x2A),
+                      TransformXORInc_ROL((0x2A, 3)), TransformXORKey(b'ab'),
+                      TransformChain((TransformAdd(3), TransformXOR(5)))):
+            data = trans.transform(self.plain, True)
+            self.assertEqual(trans.transform_range(data, 300, 1000),
+                             trans.transform(data)[300:1000], trans.name())
+
+    def test_merge(self):
+        # Shards scored and merged give the score and matches of the
+        # whole data, when no match is longer than the overlap
+        stage = PatternStage(2)
+        trans = TransformXORInc(0x2A)
+        data = trans.transform(self.plain, True)
+        _, score, msgs = stage.score(trans, data)
+        whole = {desc: sorted(matches.items()) for desc, _, matches in msgs}
+        for count in (2, 5, 13):
+            bounds = shard_bounds(len(data), count, 1024)
+            results = [_transform_data(data, (trans, stage, shard))
+                       for shard in bounds]
+            merged = stage.merge_shards(results)
+            self.assertEqual(merged[1], score)
+            self.assertEqual({desc: sorted(matches.items())
+                              for desc, _, matches in merged[2]}, whole)
+
+    def test_merge_cut(self):
+        # A match cut short by its shard's end is joined to its rest
+        data = b'0' * 10 + b'a' * 300 + b'0' * 10
+        pattern_set = PatternSet([Letters])
+        bounds = shard_bounds(len(data), 5, 16)
+        parts = [scan_shard(data[start:end], (start, stop, end),
+                            pattern_set)
+                 for start, stop, end in bounds]
+        merged = merge_shards(parts, bounds, pattern_set.pats)
+        self.assertEqual(list(merged[0].items()), [(10, b'a' * 300)])
+
+    def test_merge_literals(self):
+        # Matches of different literals overlapping across a shard's stop
+        # are kept apart, as a scan of the whole data finds both
+        data = b'x' * 10 + b'abcdef' + b'x' * 10
+        pattern_set = PatternSet([Overlapping])
+        bounds = [(0, 12, 20), (12, 26, 26)]
+        parts = [scan_shard(data[start:end], (start, stop, end),
+                            pattern_set)
+                 for start, stop, end in bounds]
+        merged = merge_shards(parts, bounds, pattern_set.pats)
+        self.assertEqual(list(merged[0].items()),
+                         [(10, b'abcd'), (12, b'cdef')])
+
+    def test_stage_tasks(self):
+        size = MIN_SHARD_SIZE * 4
+        trans = TransformXOR(1)
+        tasks, shards = _stage_tasks([trans], PatternStage(2), size, 8)
+        self.assertEqual(shards, 4)
+        self.assertEqual([task[2][:2] for task in tasks],
+                         [(start, start + MIN_SHARD_SIZE)
+                          for start in range(0, size, MIN_SHARD_SIZE)])
+        self.assertEqual(_stage_tasks([trans], HistogramStage(), size, 8)[1],
+                         1)
+
+
+def _exit_on_xor_7(task):
+    """
+    Kills the pool worker it runs in when given XOR 7
+    """
+    if task[0].value == 7:
+        os._exit(1)
+    return task[0], 1, []
+
+
+class Letters(REPatternPlugin):
+    """
+    Runs of lowercase letters. Its stage is never scanned
+    """
+    Stage = 0
+    Description = 'Letters'
+    Pattern = rb'[a-z]{4,}'
+
+
+class Overlapping(BytesListPatternPlugin):
+    """
+    Literals overlapping each other. Its stage is never scanned
+    """
+    Stage = 0
+    Description = 'Overlapping'
+    Patterns = ['abcd', 'cdef']
+
+
+class Backtracking(REPatternPlugin):
+    """
+    Takes exponential time on a run of a's not followed by a b. Its stage
+    is never scanned, so it's only used when asked for
+    """
+    Stage = 0
+    Description = 'Backtracking'
+    Pattern = rb'(a+)+b'
+
+
+class TestingBudget(unittest.TestCase):
+    def setUp(self):
+        self.data = b'a' * 40 + b' mail admin@example.com now'
+
+    def test_partial(self):
+        result = PatternStage(2, budget=0).score(TransformXOR(0), self.data)
+        self.assertTrue(is_truncated(result))
+        self.assertEqual(result[1], 0)
+        result = PatternStage(2, budget=60).score(TransformXOR(0), self.data)
+        self.assertFalse(is_truncated(result))
+        self.assertTrue(result[1])
+
+    def test_runner(self):
+        # The stuck task is given up on, and the others still run
+        runner = BudgetRunner(partial(multiprocessing.Pool, 1), workers=1)
+        stuck = PatternStage([Backtracking], budget=0.2)
+        tasks = [(TransformXOR(0), PatternStage(2, budget=5)),
+                 (TransformXOR(0), stuck),
+                 (TransformXOR(0), PatternStage(2, budget=5))]
+        results = runner.run(partial(_transform_data, self.data), tasks)
+        runner.pool.terminate()
+        self.assertEqual(runner.recycled, 1)
+        self.assertEqual([is_truncated(r) for r in results],
+                         [False, True, False])
+        self.assertEqual(results[0][1], results[2][1])
+        self.assertTrue(results[0][1])
+        records = list(transform_records('f', results[1:2]))
+        self.assertTrue(records[0]['truncated'])
+
+    def test_batches(self):
+        # A stuck task is found among a batch and given up on alone
+        runner = BudgetRunner(partial(multiprocessing.Pool, 1), workers=1)
+        stuck = PatternStage([Backtracking], budget=0.05)
+        quick = PatternStage(2, budget=0.5)
+        tasks = [(TransformXOR(0), quick)] * 4 + [(TransformXOR(0), stuck)] + \
+            [(TransformXOR(0), quick)] * 3
+        results = runner.run(partial(_transform_data, self.data), tasks)
+        runner.pool.terminate()
+        self.assertEqual([is_truncated(r) for r in results],
+                         [False] * 4 + [True] + [False] * 3)
+
+    def test_died(self):
+        # The task killing its worker is given up on, even without a
+        # budget, rather than hanging
+        runner = BudgetRunner(partial(multiprocessing.Pool, 2), workers=2)
+        tasks = [(TransformXOR(key), PatternStage(1)) for key in range(40)]
+        results = runner.run(_exit_on_xor_7, tasks)
+        runner.pool.terminate()
+        self.assertEqual([key for key, result in enumerate(results)
+                          if is_truncated(result)], [7])
+        self.assertEqual([result[1] for result in results],
+                         [0 if key == 7 else 1 for key in range(40)])
+
+    def test_errors(self):
+        # Errors raised by tasks are raised here rather than hanging
+        tasks = [(TransformXOR(None), PatternStage(1))]
+        pool = ThreadPool(1)
+        with self.assertRaises(TypeError):
+            _run_stage(pool, partial(_transform_data, self.data), tasks, 1,
+                       len(self.data))
+        with self.assertRaises(TypeError):
+            BudgetRunner(lambda: pool).run(
+                partial(_transform_data, self.data), tasks)
+        pool.close()
+
+    def test_shards(self):
+        stage = PatternStage(2)
+        shard = stage.timed_out(TransformXOR(0), (0, 10, 20))
+        merged = stage.merge_shards(
+            [stage.score_shard(TransformXOR(0), self.data, (0, 10, 20)),
+             shard])
+        self.assertIsInstance(merged, Truncated)
+
+
+class TestingDifferential(unittest.TestCase):
+    def setUp(self):
+        rand = random.Random(3)
+        words = [b'This program cannot be run in DOS mode', b'KeRnEl32',
+                 b'k\x00E\x00r\x00N\x00E\x00l\x003\x002\x00', b'MZMZM',
+                 b'%PDF-', b'WS2_32.DLL', b'pRoGrAm']
+        plain = b''.join(bytes(rand.randrange(256) for _ in range(20)) +
+                         rand.choice(words) for _ in range(100))
+        self.data = TransformAdd(0x33).transform(plain, True)
+
+    def test_image(self):
+        for family in FAMILIES:
+            self.assertEqual(family.image(self.data),
+                             bytes(family.delta(x, y) for x, y in
+                                   zip(self.data, self.data[1:])))
+        self.assertEqual(family_key(TransformXOR(0x80))[1], 0x80)
+        self.assertEqual(family_key(TransformAdd(0x80))[0].name, 'xor')
+        self.assertIsNone(family_key(TransformROL(1)))
+        with self.assertRaises(TypeError):
+            DeltaFamily('none', None, None, None)
+
+    def test_scores(self):
+        # Scored as a scan of each transformed data would
+        stage = PatternStage(1)
+        tasks = list(_iteration_transformer(
+            [(TransformXOR, stage), (TransformROL, stage),
+             (TransformAdd, stage)]))
+        for details in (False, True):
+            rest, scored = score_families(tasks, self.data, details)
+            self.assertEqual(len(scored), 255 * 2)
+            results = place_scored(
+                [_transform_data(self.data, task, details) for task in rest],
+                scored)
+            expected = [_transform_data(self.data, task, details)
+                        for task in tasks]
+            self.assertEqual(_listed(results), _listed(expected))
+        self.assertEqual(max(results, key=lambda r: r[1])[0].name(),
+                         'Add 33')
+
+    def test_unsupported(self):
+        # Patterns other than literals are scanned key by key
+        tasks = list(_iteration_transformer(
+            [(TransformXOR, PatternStage([Backtracking]))]))
+        self.assertEqual(score_families(tasks, self.data)[0], tasks)
+        self.assertEqual(score_families(tasks[:3], self.data)[0],
+                         tasks[:3])
+
+
+def _listed(results):
+    return [(r[0].name(), r[1], [(desc, weight, list(matches.items()))
+                                 for desc, weight, matches in r[2]])
+            for r in results]
+
+
+class TestingChain(unittest.TestCase):
+    def setUp(self):
+        self.plain = (b'This program cannot be run in DOS mode. '
+                      b'Visit http://example.com now. ') * 8
+        # Case flipped, then XORed with an incrementing key
+        self.data = TransformXORInc(7).transform(
+            TransformXOR(0x20).transform(self.plain, True), True)
+
+    def test_chain(self):
+        chain = TransformChain((TransformXORInc(7), TransformXOR(0x20),
+                                TransformAdd(1), TransformAdd(0xFF)))
+        self.assertEqual(chain.name(),
+                         'XOR 07 Increment > XOR 20 > Add 01 > Add FF')
+        self.assertEqual(chain.transform(self.data), self.plain)
+        self.assertEqual(chain.transform_lower(self.data),
+                         self.plain.lower())
+        self.assertEqual(chain.transform(self.plain, True), self.data)
+
+    def test_beam_search(self):
+        pool = ThreadPool()
+        worker = partial(_transform_data, self.data, details=False)
+        trans_list = [TransformXOR, TransformXORInc]
+        results, count = beam_search(pool, worker, trans_list,
+                                     PatternStage(2, 5), depth=2, width=4)
+        pool.terminate()
+        self.assertEqual(count, 511 + 4 * 511)
+        self.assertEqual(results[0][0].transform(self.data), self.plain)
+
+    def test_prefix_cache(self):
+        # Each thread keeps its own prefix outputs
+        _prefix_cache().clear()
+        chain = TransformChain((TransformXORInc(7), TransformXOR(0x20)))
+        chain.transform(self.data)
+        thread = threading.Thread(target=chain.transform, args=(self.data,))
+        thread.start()
+        thread.join()
+        self.assertEqual(len(_prefix_cache()), 1)
+
+    def test_resume(self):
+        pool = ThreadPool()
+        worker = partial(_transform_data, self.data, details=False)
+        trans_list = [TransformXOR, TransformXORInc]
+        states = []
+        results, count = beam_search(pool, worker, trans_list,
+                                     PatternStage(2, 5), 2, 4, self.data,
+                                     on_layer=states.append)
+        resumed = beam_search(pool, worker, trans_list, PatternStage(2, 5),
+                              2, 4, self.data, state=states[0])
+        pool.terminate()
+        self.assertEqual([state['layers'] for state in states], [1, 2])
+        self.assertEqual(resumed[1], count)
+        self.assertEqual([(r[0].name(), r[1]) for r in resumed[0]],
+                         [(r[0].name(), r[1]) for r in results])
+
+
+class _Slow(Stage):
+    def score(self, transformer, data, details=True):
+        time.sleep(0.5)
+        return transformer, 0, []
+
+
+class TestingDistributed(unittest.TestCase):
+    def setUp(self):
+        plain = b'This program cannot be run in DOS mode. kernel32.dll ' * 8
+        self.data = TransformXOR(0x2A).transform(plain, True)
+        self.trans_list = [TransformXOR, TransformAdd]
+
+    def test_partition(self):
+        shards = partition(self.trans_list, 100)
+        self.assertEqual(shards[:3], [(TransformXOR, 0, 100),
+                                      (TransformXOR, 100, 200),
+                                      (TransformXOR, 200, 255)])
+        self.assertEqual(shards[3][0], TransformAdd)
+
+    def test_lease_expiry(self):
+        coordinator = Coordinator(self.data, [(TransformXOR, 0, 1)], 1,
+                                  lease_timeout=0)
+        first, _ = coordinator.lease('dead')
+        self.assertFalse(coordinator.renew(first))
+        # The expired lease is handed out again
+        second, _ = coordinator.lease('alive')
+        coordinator.complete(second, [(None, 2, [])])
+        # Late results for a completed shard are ignored
+        coordinator.complete(first, [(None, 1, [])])
+        self.assertIsNone(coordinator.lease('alive'))
+        self.assertEqual(coordinator.results(), [(None, 2, [])])
+
+    def test_bad_calls(self):
+        server = KeyspaceServer(Coordinator(self.data, [], 5),
+                                ('127.0.0.1', 0), b'secret')
+        conn = Client(server.start(), authkey=b'secret')
+        try:
+            # Errors are sent back, and the connection still serves
+            for message in (('lease', ()), ('shutdown', ()), 'junk'):
+                conn.send(message)
+                self.assertIsInstance(conn.recv(), Exception)
+            conn.send(('lease', ('worker',)))
+            self.assertIsNone(conn.recv())
+        finally:
+            conn.close()
+            server.stop()
+
+    def test_workers(self):
+        shards = partition(self.trans_list, 64)
+        server = KeyspaceServer(Coordinator(self.data, shards, 5),
+                                ('127.0.0.1', 0), b'secret')
+        address = server.start()
+        workers = [multiprocessing.Process(target=run_worker,
+                                           args=(address, b'secret',
+                                                 'thread'))
+                   for _ in range(2)]
+        for worker in workers:
+            worker.start()
+        try:
+            results = server.wait(60)
+        finally:
+            server.stop()
+            for worker in workers:
+                worker.join(10)
+
+        stage1 = list(zip(self.trans_list, (1, 1)))
+        expected = rank_results([_transform_data(self.data, task, False)
+                                 for task in _iteration_transformer(stage1)],
+                                5)
+        self.assertEqual([(r[0].name(), r[1]) for r in results],
+                         [(r[0].name(), r[1]) for r in expected])
+
+    def test_renewal(self):
+        coordinator = Coordinator(self.data, [(TransformXOR, 0, 1)], 1,
+                                  lease_timeout=0.2, stage=_Slow())
+        renewed = []
+        renew = coordinator.renew
+        coordinator.renew = lambda lease_id: \
+            renewed.append(renew(lease_id)) or renewed[-1]
+        server = KeyspaceServer(coordinator, ('127.0.0.1', 0), b'secret')
+        address = server.start()
+        try:
+            # The task outlives the lease timeout, but the lease is
+            # renewed while it runs, so it's never handed out again
+            self.assertEqual(run_worker(address, b'secret', 'thread', 0.05),
+                             1)
+        finally:
+            server.stop()
+        self.assertTrue(renewed)
+        self.assertTrue(all(renewed))
+
+
+class TestingCheckpoint(unittest.TestCase):
+    def setUp(self):
+        plain = b'This program cannot be run in DOS mode. kernel32.dll ' * 8
+        self.data = TransformXOR(0x2A).transform(plain, True)
+        self.trans_list = [TransformXOR, TransformAdd]
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'crack.checkpoint')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def crack(self, resume=False):
+        return [(r[0].name(), r[1]) for r in run_transformations(
+            self.trans_list, None, 5, data=self.data, backend='thread',
+            checkpoint=self.path, resume=resume)]
+
+    def test_keyspace(self):
+        pool = ThreadPool()
+        worker = partial(_transform_data, self.data, details=False)
+        whole = Checkpoint(self.path, 'key')
+        expected, count = run_keyspace(pool, worker, self.trans_list,
+                                       PatternStage(1, 5), self.data, whole)
+        # Stopped after the XOR shard, and resumed
+        stopped = Checkpoint(self.path, 'key')
+        run_keyspace(pool, worker, self.trans_list[:1], PatternStage(1, 5),
+                     self.data, stopped)
+        stopped.save()
+        resumed = Checkpoint.open(self.path, 'key', resume=True)
+        self.assertEqual(resumed.keyspace[0], {0})
+        results, _ = run_keyspace(pool, worker, self.trans_list,
+                                  PatternStage(1, 5), self.data, resumed)
+        pool.terminate()
+        self.assertEqual(count, 255 * 2)
+        self.assertEqual(whole.keyspace[0], {0, 1})
+        self.assertEqual([(r[0].name(), r[1]) for r in results],
+                         [(r[0].name(), r[1]) for r in expected])
+
+    def test_progress(self):
+        events = []
+        pool = ThreadPool()
+        worker = partial(_transform_data, self.data, details=False)
+        run_keyspace(pool, worker, self.trans_list, PatternStage(1, 5),
+                     self.data, Checkpoint(self.path, 'key'),
+                     progress=[events.append])
+        pool.terminate()
+        # One start and end for the stage, not one per shard
+        kinds = [event.kind for event in events]
+        self.assertEqual(kinds.count('start'), 1)
+        self.assertEqual(kinds.count('end'), 1)
+        self.assertEqual(events[-1].done, 255 * 2)
+
+    def test_not_owned(self):
+        Checkpoint(self.path, 'key').finish_stage(1, [])
+        os.chmod(self.path, 0o666)
+        with contextlib.redirect_stderr(io.StringIO()) as err:
+            checkpoint = Checkpoint.open(self.path, 'key', resume=True)
+        self.assertEqual(checkpoint.stage, 1)
+        self.assertIn('not yours', err.getvalue())
+
+    def test_resume(self):
+        expected = self.crack()
+        self.assertFalse(os.path.exists(self.path))
+        # Stopped after stage 1: only stage 2 is run again
+        key = checkpoint_key(self.data, self.trans_list,
+                             [PatternStage(1, 5), PatternStage(2)])
+        checkpoint = Checkpoint(self.path, key)
+        checkpoint.finish_stage(1, [(TransformXOR(0x2A), 1, [])])
+        self.assertEqual(self.crack(resume=True), expected[:1])
+        self.assertFalse(os.path.exists(self.path))
+        # A checkpoint of other options is started over from
+        Checkpoint(self.path, 'other').finish_stage(1, [])
+        self.assertEqual(self.crack(resume=True), expected)
+
+
+class TestingArchive(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        inner = io.BytesIO()
+        with zipfile.ZipFile(inner, 'w') as z:
+            z.writestr('deep.bin', b'deep')
+        self.filename = os.path.join(self.tmp.name, 'test.zip')
+        with zipfile.ZipFile(self.filename, 'w', zipfile.ZIP_DEFLATED) as z:
+            z.writestr('a.txt', b'first')
+            z.writestr('dir/', b'')
+            z.writestr('dir/b.bin', b'\x00' * 1000)
+            z.writestr('inner.zip', inner.getvalue())
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def members(self, **kwargs):
+        return [(m.name, m.data) for m in
+                iter_members(self.filename, processes=2, **kwargs)]
+
+    def test_members(self):
+        self.assertEqual(self.members(),
+                         [('a.txt', b'first'), ('dir/b.bin', b'\x00' * 1000),
+                          ('inner.zip/deep.bin', b'deep')])
+
+    def test_glob(self):
+        self.assertEqual([name for name, _ in self.members(pattern='*.bin')],
+                         ['dir/b.bin', 'inner.zip/deep.bin'])
+
+    def test_depth(self):
+        names = [name for name, _ in self.members(max_depth=0)]
+        self.assertEqual(names, ['a.txt', 'dir/b.bin', 'inner.zip'])
+
+    def test_bomb(self):
+        # Members going over their share are reported and skipped
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            names = [m.name for m in iter_members(
+                self.filename, max_bytes=500, processes=1)]
+        self.assertEqual(names, ['a.txt', 'inner.zip/deep.bin'])
+        self.assertIn('"dir/b.bin": "dir/b.bin" decompresses to over 495 '
+                      'bytes', stderr.getvalue())
+        # Members in flight split what's left between them
+        with contextlib.redirect_stderr(io.StringIO()):
+            names = [name for name, _ in self.members(max_bytes=1200)]
+        self.assertNotIn('dir/b.bin', names)
+        self.assertIn('inner.zip/deep.bin', names)
+
+    def test_read_zip(self):
+        with self.assertRaises(ValueError):
+            read_data(self.filename, True)
+        self.assertEqual(read_data(self.filename, True, member='a.txt'),
+                         b'first')
+
+
+class TestingEngine(unittest.TestCase):
+    def setUp(self):
+        self.data = TransformXOR(0x42).transform(
+            b'This program cannot be run in DOS mode. http://www.example.com/ '
+            b'admin@example.com 10.0.0.1 ' * 4, encode=True)
+        self.engine = Engine([TransformXOR, TransformAdd], save=3,
+                             processes=2)
+
+    def tearDown(self):
+        self.engine.close()
+
+    def test_crack(self):
+        for _ in range(2):
+            results = self.engine.crack(self.data)
+            self.assertEqual(len(results), 3)
+            self.assertEqual(results[0].name, 'XOR 42')
+            self.assertTrue(results[0].hits)
+            self.assertEqual(results[0].decode(self.data)[:4], b'This')
+
+    def test_buffers(self):
+        # Workers pick up each new buffer
+        other = TransformXOR(0x42).transform(self.data, True)
+        other = TransformXOR(0x17).transform(other, True)
+        self.assertEqual(self.engine.crack(other)[0].name, 'XOR 17')
+        self.assertEqual(self.engine.crack(self.data)[0].name, 'XOR 42')
+        self.assertFalse(any(r.score for r in self.engine.crack(b'')))
+
+        # The shared memory the buffer was in is released after the call
+        created = []
+
+        class Recorded(SharedMemory):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                created.append(self.name)
+
+        with unittest.mock.patch('locke.transforms.engine.SharedMemory',
+                                 Recorded):
+            self.engine.crack(self.data)
+        self.assertEqual(len(created), 1)
+        with self.assertRaises(FileNotFoundError):
+            SharedMemory(created[0])
+
+    def test_search(self):
+        hits = self.engine.search(b'see http://www.example.com')
+        self.assertIn('Common URL (http/https/ftp)',
+                      [hit.description for hit in hits])
+        self.assertEqual(self.engine.search(b''), [])
+
+    @unittest.skipUnless(os.path.exists(DBFILE), 'no transforms.db')
+    def test_default(self):
+        # Level 1 is run as the alphabets of the database, as crack does
+        self.assertEqual(default_transformers(1), [TransformAllStage1])
+        names = [trans.__name__ for trans in default_transformers(2)]
+        self.assertEqual(names[0], 'TransformAllStage1')
+        self.assertIn('TransformXORKey', names)
+        self.assertNotIn('TransformXOR', names)
+
+    def test_close(self):
+        self.engine.crack(self.data)
+        self.engine.close()
+        self.assertIsNone(self.engine._pool)
+        self.assertEqual(self.engine.crack(self.data)[0].name, 'XOR 42')
+
+
+def _run_python(code, path=()):
+    # A fresh interpreter, so what it imports isn't hidden by the tests
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        list(path) + [os.path.dirname(os.path.dirname(
+            os.path.dirname(os.path.abspath(__file__))))]))
+    return subprocess.run([sys.executable, '-c', code], env=env,
+                          capture_output=True, text=True, check=True).stdout
+
+
+class TestingRegistry(unittest.TestCase):
+    def test_manifest(self):
+        # The manifest has to list every built-in plugin, where it is
+        load_transforms()
+        found = {trans.__name__: (trans.class_level(), trans.__module__)
+                 for cls in (TransformChar, TransformString)
+                 for trans in cls.__subclasses__()
+                 if trans.__module__.startswith('locke.transforms.plugins')}
+        self.assertEqual(found, TRANSFORMS)
+        found = {pat.__name__: (stage, pat.__module__)
+                 for stage in (1, 2, 3)
+                 for pat in PatternPlugin.plugins(stage)
+                 if pat.__module__.startswith('locke.patterns.plugins')}
+        self.assertEqual(found, PATTERNS)
+
+    def test_startup(self):
+        # Starting the command line doesn't import plugins or pools
+        modules = _run_python('import sys, locke.locke_main; '
+                              'print(" ".join(sys.modules))').split()
+        for module in ('multiprocessing', 'sqlite3', 'zipfile', 'ipaddress',
+                       'importlib.metadata', 'locke.transforms.transformer',
+                       'locke.transforms.plugins.level1_transformers',
+                       'locke.patterns.plugins.stage1_patterns'):
+            self.assertNotIn(module, modules)
+
+    def test_entry_points(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            info = os.path.join(tmp, 'extra-1.0.dist-info')
+            os.mkdir(info)
+            with open(os.path.join(info, 'METADATA'), 'w') as f:
+                f.write('Metadata-Version: 2.1\nName: extra\n'
+                        'Version: 1.0\n')
+            with open(os.path.join(info, 'entry_points.txt'), 'w') as f:
+                f.write('[locke.transforms]\nextra = extra_transforms\n')
+            with open(os.path.join(tmp, 'extra_transforms.py'), 'w') as f:
+                f.write('from locke.transforms.transformer import '
+                        'TransformChar\n'
+                        'class TransformExtra(TransformChar):\n'
+                        '    @staticmethod\n'
+                        '    def class_level():\n'
+                        '        return 2\n')
+            names = _run_python(
+                'from locke.transforms.engine import registered_transformers'
+                '\nprint(" ".join(t.__name__ for t in '
+                'registered_transformers(2)))', [tmp]).split()
+        self.assertIn('TransformExtra', names)
+        self.assertIn('TransformXORKey', names)
+        self.assertNotIn('TransformXORInc_ROL', names)
+
 
 if __name__ == '__main__':
     load_all_transformers()
@@ -1,3 +1,30 @@
-from locke.transforms.transformer import TransformString, TransformChar, \
-    to_bytes, rol, select_transformers, run_transformations, write_to_disk
-from locke.transforms.utils import prettyhex
+from importlib import import_module
+
+# The names exported by the package, and the modules defining them. They
+# are imported on first use, so importing one module of the package (say,
+# locke.transforms.utils) doesn't import the transformer and its pools
+_EXPORTS = {
+    'TransformString': 'locke.transforms.transformer',
+    'TransformChar': 'locke.transforms.transformer',
+    'to_bytes': 'locke.transforms.transformer',
+    'rol': 'locke.transforms.transformer',
+    'select_transformers': 'locke.transforms.transformer',
+    'run_transformations': 'locke.transforms.transformer',
+    'write_to_disk': 'locke.transforms.transformer',
+    'prettyhex': 'locke.transforms.utils',
+    'CrackResult': 'locke.transforms.engine',
+    'Engine': 'locke.transforms.engine',
+    'PatternHit': 'locke.transforms.engine',
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    if name in _EXPORTS:
+        return getattr(import_module(_EXPORTS[name]), name)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -0,0 +1,150 @@
+import asyncio
+from functools import partial
+
+from locke.transforms.cascade import default_cascade
+from locke.transforms.transformer import _iteration_transformer, \
+    _make_pool, rank_results, search_data
+
+"""
+Asyncio counterparts of run_transformations() and search_data().
+
+The work still runs on a process pool. These coroutines only wait on it,
+so the event loop is never blocked, and nothing is printed. Cancelling
+one of them terminates its pool, stopping any outstanding tasks (threads
+can't be stopped, so on a thread pool running tasks finish first).
+Searches without a pool of their own run on the event loop's default
+executor, rather than starting a process for each.
+"""
+
+
+def _bridge(loop):
+    """
+    Create an asyncio future along with the callbacks that settle it,
+    which may be called from the pool's result handler thread
+    Args:
+        loop: The event loop the future belongs to
+    Return:
+        A tuple(future, callback, error_callback)
+    """
+    future = loop.create_future()
+
+    def settle(result, error):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def callback(result):
+        loop.call_soon_threadsafe(settle, result, None)
+
+    def error_callback(error):
+        loop.call_soon_threadsafe(settle, None, error)
+
+    return future, callback, error_callback
+
+
+async def _map(pool, worker, tasks, chunksize=None):
+    """
+    Await pool.map(worker, tasks)
+    """
+    future, callback, error_callback = _bridge(asyncio.get_running_loop())
+    pool.map_async(worker, tasks, chunksize,
+                   callback=callback, error_callback=error_callback)
+    return await future
+
+
+async def _close(pool):
+    """
+    Close the pool, waiting for its workers to exit off the event loop
+    """
+    pool.close()
+    await asyncio.get_running_loop().run_in_executor(None, pool.join)
+
+
+async def iter_crack_async(data, trans_list, keep=20, backend='process',
+                           cascade=None):
+    """
+    Run all transformations on the data, generating the results of
+    each stage as it finishes
+    Args:
+        data: The bytestring to evaluate
+        trans_list: A list of transformer classes
+        keep: How many results to keep after stage 1 of the default
+            cascade (default = 20)
+        backend: Run on a 'process' (default) or 'thread' pool
+        cascade: A list of the stages to run (default = stage 1 and 2
+            patterns, see default_cascade)
+    Return:
+        Asynchronously generates tuple(stage_number, results), with
+        results sorted as by run_transformations()
+    """
+    if cascade is None:
+        cascade = default_cascade(keep)
+    pool, worker = _make_pool(data, backend)
+    try:
+        results = []
+        for number, stage in enumerate(cascade, 1):
+            last = number == len(cascade)
+            details = last if stage.details is None else stage.details
+            if number == 1:
+                tasks = _iteration_transformer(
+                    [(trans, stage) for trans in trans_list], data)
+                chunksize = None
+            else:
+                tasks = [(trans[0], stage) for trans in results]
+                chunksize = 1
+            results = await _map(pool, partial(worker, details=details),
+                                 tasks, chunksize)
+            results = rank_results(results, stage.keep)
+            yield number, results
+    except BaseException:
+        # Covers cancellation, and the generator being closed early
+        pool.terminate()
+        raise
+    await _close(pool)
+
+
+async def crack_async(data, trans_list, keep=20, save=10, backend='process',
+                      cascade=None):
+    """
+    The asyncio counterpart of run_transformations()
+    Args:
+        data: The bytestring to evaluate
+        trans_list: A list of transformer classes
+        keep: How many results to keep after stage 1 of the default
+            cascade (default = 20)
+        save: How many results to keep after the last stage (default = 10)
+        backend: Run on a 'process' (default) or 'thread' pool
+        cascade: A list of the stages to run (default = stage 1 and 2
+            patterns, see default_cascade)
+    Return:
+        A sorted list of tuple(trans_instance, score, msgs) up to
+        "save" size
+    """
+    results = []
+    async for _, results in iter_crack_async(data, trans_list, keep,
+                                             backend, cascade):
+        pass
+    return results[:save]
+
+
+async def search_async(data, pool=None):
+    """
+    The asyncio counterpart of search_data()
+    Args:
+        data: The bytestring to search
+        pool: A pool to run the search on (default = the event loop's
+            default executor). The search isn't stopped on cancellation
+    Return:
+        A list of [description, weight, MatchList] for each pattern
+        that matched
+    """
+    loop = asyncio.get_running_loop()
+    if pool is None:
+        return await loop.run_in_executor(None, search_data, data)
+    future, callback, error_callback = _bridge(loop)
+    pool.apply_async(search_data, (data,),
+                     callback=callback, error_callback=error_callback)
+    return await future
@@ -0,0 +1,195 @@
+import io
+import os
+import sys
+import zipfile
+from collections import deque
+from fnmatch import fnmatch
+from itertools import islice
+from multiprocessing import Pool
+
+"""
+Reading the members of zip archives, without asking which one.
+
+Members are decompressed in parallel by a pool of worker processes, and
+handed over in order as soon as each is ready. Only about as many members
+as there are workers are decompressed ahead of the one handed over, so
+the members waiting don't pile up in memory. Archives found inside the
+archive are followed, up to a depth limit. As a guard against zip bombs,
+the bytes decompressed are capped in total: the members decompressed at
+the same time split what's left between them, and a member going over its
+share is reported on stderr and skipped.
+"""
+
+# How many archives deep members are followed
+MAX_DEPTH = 3
+# The most bytes decompressed from one archive, members of nested
+# archives included
+MAX_BYTES = 1 << 30
+
+
+class Member(object):
+    """
+    A decompressed archive member.
+
+    Every member has the following fields:
+    * name (str) - The member's path, with the path within each nested
+      archive following the archive's own (e.g., "inner.zip/payload.bin")
+    * data (bytes) - The decompressed data
+    """
+    __slots__ = ('name', 'data')
+
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
+
+
+def _password(password):
+    return password.encode() if isinstance(password, str) else password
+
+
+def _read_member(source, info, password, limit):
+    """
+    Decompress a member, refusing to go over limit bytes (the size in
+    the archive's directory can't be trusted)
+    """
+    with source.open(info, pwd=_password(password)) as f:
+        data = f.read(limit + 1)
+    if len(data) > limit:
+        raise ValueError('"%s" decompresses to over %i bytes'
+                         % (info.filename, limit))
+    return data
+
+
+def _extract(args):
+    """
+    Pool entry point, decompressing one member of an archive file
+    Args:
+        args: A tuple(filename, member_name, password, limit)
+    Return:
+        The decompressed bytestring
+    """
+    filename, name, password, limit = args
+    with zipfile.ZipFile(filename) as source:
+        return _read_member(source, source.getinfo(name), password, limit)
+
+
+def _selected(infos, pattern):
+    return [info for info in infos if not info.is_dir() and
+            (pattern is None or fnmatch(info.filename, pattern) or
+             _is_archive_name(info.filename))]
+
+
+def _is_archive_name(name):
+    return name.lower().endswith('.zip')
+
+
+def _is_archive(data):
+    return data[:4] == b'PK\x03\x04' and \
+        zipfile.is_zipfile(io.BytesIO(data))
+
+
+class _Budget(object):
+    """
+    Keeps count of the bytes left to decompress from an archive
+    """
+
+    def __init__(self, limit):
+        self.left = limit
+
+    def reserve(self, shares):
+        """
+        Set aside a share of what's left for a member
+        Args:
+            shares: How many members the rest is split between
+        Return:
+            The most bytes the member may decompress to
+        """
+        size = self.left // shares
+        self.left -= size
+        return size
+
+    def refund(self, size):
+        self.left += size
+
+
+def _skip(name, error):
+    print('!! skipping "%s": %s' % (name, error), file=sys.stderr)
+
+
+def _nested(path, name, data, pattern, password, depth, budget):
+    """
+    Generate the member at path, or the members in it if it's an
+    archive, depth first
+    """
+    if depth <= 0 or not _is_archive(data):
+        if pattern is None or fnmatch(name, pattern):
+            yield Member(path, data)
+        return
+    with zipfile.ZipFile(io.BytesIO(data)) as source:
+        for info in _selected(source.infolist(), pattern):
+            try:
+                member = _read_member(source, info, password, budget.left)
+            except ValueError as e:
+                _skip('%s/%s' % (path, info.filename), e)
+                continue
+            budget.left -= len(member)
+            yield from _nested('%s/%s' % (path, info.filename),
+                               info.filename, member, pattern, password,
+                               depth - 1, budget)
+
+
+def iter_members(filename, pattern=None, password=None, max_depth=MAX_DEPTH,
+                 max_bytes=MAX_BYTES, processes=None):
+    """
+    Decompress every member of a zip file in parallel, generating them
+    in the archive's order as they're ready
+    Args:
+        filename: The location of the zip file
+        pattern: A glob the member names must match (default = all).
+            Nested archives are followed whatever their name
+        password: The zip's password if applicable (default = None)
+        max_depth: How many archives deep to follow (default = MAX_DEPTH)
+        max_bytes: The most bytes to decompress (default = MAX_BYTES).
+            Members going over their share of it are skipped
+        processes: How many worker processes to use (default = one
+            per CPU)
+    Return:
+        Generates Member
+    """
+    if not zipfile.is_zipfile(filename):
+        raise TypeError('\"%s\" is NOT a valid zip file! Try running a '
+                        'normal scan on it' % filename)
+    with zipfile.ZipFile(filename) as source:
+        infos = _selected(source.infolist(), pattern)
+
+    budget = _Budget(max_bytes)
+    workers = processes or os.cpu_count() or 1
+    pool = Pool(workers)
+    pending = deque()
+    infos = iter(infos)
+
+    def submit(count):
+        # Members in flight share what's left of the budget, so together
+        # they can't decompress to more
+        for info in islice(infos, count):
+            limit = budget.reserve(workers)
+            pending.append((info, limit, pool.apply_async(
+                _extract, ((filename, info.filename, password, limit),))))
+
+    try:
+        submit(workers)
+        while pending:
+            info, limit, result = pending.popleft()
+            try:
+                data = result.get()
+            except ValueError as e:
+                budget.refund(limit)
+                submit(1)
+                _skip(info.filename, e)
+                continue
+            budget.refund(limit - len(data))
+            submit(1)
+            yield from _nested(info.filename, info.filename, data, pattern,
+                               password, max_depth, budget)
+    finally:
+        pool.terminate()
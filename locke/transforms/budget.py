@@ -0,0 +1,260 @@
+import os
+import queue
+import time
+from collections import deque
+from functools import partial
+from itertools import count
+from multiprocessing.pool import ThreadPool
+
+"""
+Time budgets for the tasks of a stage, so a scan stuck on hostile data
+(e.g., a pattern backtracking over a huge run of bytes) can't hold the
+stage up for long.
+
+A stage given a budget (see Stage) allows each of its tasks that many
+seconds:
+* Pattern stages check the clock between patterns, and once over the
+  budget return what the patterns scanned so far found, as Truncated.
+* A task still running at OVERRUN times its budget (a single pattern
+  stuck on the data) is given up on: the task is scored 0 as Truncated,
+  the pool is replaced by a new one (stopping its workers is the only way
+  to stop the task), and the other tasks that were running are run again
+  on the new pool.
+
+Tasks are handed to the pool in small batches, one batch per worker at a
+time, so a batch's clock starts as a worker picks it up rather than while
+it waits behind others. A batch is given up on at OVERRUN times the
+budgets of all its tasks, and its tasks then run again one by one, so
+only the stuck one is given up on.
+
+A task whose worker dies (e.g., killed by the system running out of
+memory) would otherwise never return, budget or not. Process pools are
+checked on every POLL seconds; once a worker has died, the tasks that
+were running are run again one at a time on a new pool, and the one
+whose worker dies again is given up on.
+"""
+
+# How many times its budget a task may run before it's given up on
+OVERRUN = 2
+# The most tasks sent to a worker at once. A batch is only given up on
+# once each of its tasks could have run over, so the smaller it is the
+# sooner a stuck task is found
+BATCH_SIZE = 16
+UNBUDGETED_BATCH_SIZE = 256
+# How often (in seconds) a process pool's workers are checked on
+POLL = 0.5
+
+
+class Truncated(tuple):
+    """
+    A tuple(transform_instance, score, msgs) scored on part of the
+    patterns only (or none), as the task ran over its budget
+    """
+    __slots__ = ()
+
+
+def is_truncated(result):
+    """
+    Return:
+        Whether a result ran over its budget (see Truncated)
+    """
+    return isinstance(result, Truncated)
+
+
+def deadline(budget):
+    """
+    Return:
+        The time.monotonic() time a budget of seconds starting now runs
+        out at, or None if there is no budget
+    """
+    return None if budget is None else time.monotonic() + budget
+
+
+class BudgetRunner(object):
+    """
+    Runs the tasks of stages on a pool, replacing the pool whenever a
+    task overruns its stage's budget or a worker of the pool dies. It's
+    passed to _run_stage (and beam_search) in place of a pool.
+    """
+
+    def __init__(self, make_pool, pool=None, workers=None):
+        """
+        Args:
+            make_pool: Called to create a pool
+            pool: The pool to start with (default = make_pool())
+            workers: The size of the pools (default = one per CPU)
+        """
+        self.make_pool = make_pool
+        self.pool = pool if pool is not None else make_pool()
+        self.workers = workers or os.cpu_count() or 1
+        self.recycled = 0
+        self.pids = _worker_pids(self.pool)
+
+    def recycle(self):
+        """
+        Replace the pool with a new one, stopping the old one's workers.
+        Threads can't be stopped, so a thread pool's are left to finish
+        """
+        pool, self.pool = self.pool, self.make_pool()
+        if isinstance(pool, ThreadPool):
+            pool.close()
+        else:
+            pool.terminate()
+        self.pids = _worker_pids(self.pool)
+        self.recycled += 1
+
+    def died(self):
+        """
+        Return:
+            Whether a worker of the pool has died (never for threads)
+        """
+        if self.pids is None:
+            return False
+        # The pool replaces dead workers, but the tasks they held are lost
+        return _worker_pids(self.pool) != self.pids or \
+            any(worker.exitcode is not None for worker in self.pool._pool)
+
+    def run(self, worker, tasks, on_result=None):
+        """
+        Run the tasks, giving up on those running over OVERRUN times the
+        budget of their stage or killing their worker
+        Args:
+            worker: The function the pool's workers run
+            tasks: An iterable of tuple(trans_instance, stage, ...)
+            on_result: Called with each result as it comes in
+                (default = None)
+        Return:
+            The list of the tasks' results, in order
+        """
+        tasks = list(tasks)
+        results = [None] * len(tasks)
+        # Tasks without a budget are never given up on for time, so they
+        # can go in batches as large as imap would send
+        limit = BATCH_SIZE if any(getattr(task[1], 'budget', None)
+                                  is not None for task in tasks) \
+            else UNBUDGETED_BATCH_SIZE
+        size = max(1, min(limit, len(tasks) // (self.workers * 4)))
+        pending = deque(list(range(start, min(start + size, len(tasks))))
+                        for start in range(0, len(tasks), size))
+        # Tasks run one at a time, to find the one killing its worker
+        suspects = deque()
+        # The batch of task indexes each number sent stands for, and when
+        # the batch is given up on
+        running = {}
+        numbers = count()
+        finished = queue.Queue()
+
+        def send(batch):
+            number = next(numbers)
+            running[number] = (batch, _give_up_at([tasks[index]
+                                                   for index in batch]))
+            self.pool.apply_async(
+                _run_batch, (worker, [tasks[index] for index in batch]),
+                callback=partial(_put, finished, number, True),
+                error_callback=partial(_put, finished, number, False))
+
+        while pending or suspects or running:
+            if suspects:
+                if not running:
+                    send([suspects.popleft()])
+            else:
+                while pending and len(running) < self.workers:
+                    send(pending.popleft())
+
+            times = [at for _, at in running.values() if at is not None]
+            if self.pids is not None:
+                times.append(time.monotonic() + POLL)
+            timeout = max(0, min(times) - time.monotonic()) if times \
+                else None
+            try:
+                number, ok, value = finished.get(timeout=timeout)
+            except queue.Empty:
+                for index in self._check(tasks, results, running, pending,
+                                         suspects):
+                    if on_result is not None:
+                        on_result(results[index])
+                continue
+
+            if number not in running:
+                # The batch was put back when the pool was replaced
+                continue
+            if not ok:
+                raise value
+            batch, _ = running.pop(number)
+            for index, result in zip(batch, value):
+                results[index] = result
+                if on_result is not None:
+                    on_result(result)
+        return results
+
+    def _check(self, tasks, results, running, pending, suspects):
+        """
+        Give up on the batches running out of time or whose worker died,
+        and replace the pool. Batches of several tasks are run again a
+        task at a time, to find the task to give up on
+        Return:
+            The indexes of the tasks given up on
+        """
+        now = time.monotonic()
+        expired = [number for number, (_, at) in running.items()
+                   if at is not None and at <= now]
+        died = self.died()
+        if not expired and not died:
+            return []
+        given_up = []
+
+        def give_up(index):
+            transformer, stage = tasks[index][:2]
+            results[index] = stage.timed_out(transformer, *tasks[index][2:])
+            given_up.append(index)
+
+        again = []
+        for number in expired:
+            batch, _ = running.pop(number)
+            if len(batch) == 1:
+                give_up(batch[0])
+            else:
+                again.extend([index] for index in batch)
+        others = sorted(batch for batch, _ in running.values())
+        if died:
+            if not expired and len(others) == 1 and len(others[0]) == 1:
+                # The task was running alone, so it killed its worker
+                give_up(others[0][0])
+            else:
+                suspects.extend(index for batch in others for index in batch)
+        else:
+            # The others are run again first, in order
+            again.extend(others)
+        pending.extendleft(reversed(sorted(again)))
+        running.clear()
+        self.recycle()
+        return given_up
+
+
+def _give_up_at(batch):
+    budgets = [getattr(task[1], 'budget', None) for task in batch]
+    if None in budgets:
+        return None
+    return deadline(sum(budgets) * OVERRUN)
+
+
+def _worker_pids(pool):
+    """
+    Return:
+        The set of the process IDs of a process pool's workers, or None
+    """
+    workers = getattr(pool, '_pool', None)
+    if isinstance(pool, ThreadPool) or workers is None:
+        return None
+    return {worker.pid for worker in workers}
+
+
+def _run_batch(worker, batch):
+    """
+    Pool entry point, running a batch of tasks
+    """
+    return [worker(task) for task in batch]
+
+
+def _put(finished, index, ok, value):
+    finished.put((index, ok, value))
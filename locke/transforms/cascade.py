@@ -0,0 +1,327 @@
+import string
+from abc import ABC, abstractmethod
+from array import array
+import threading
+from bisect import bisect_right
+from functools import partial
+
+from locke.patterns import Manager, PatternSet
+from locke.patterns.utils import MatchList, pack_matches
+from locke.transforms.budget import Truncated, deadline
+from locke.transforms.shards import merge_shards, scan_shard, shard_messages
+
+"""
+The stages run_transformations() puts candidate transforms through.
+
+A cascade is a list of stages. The first stage scores every transform,
+and each stage after it only scores the transforms kept by the one before,
+so cheap stages can weed out most candidates before the expensive ones
+run. Each stage names how it scores a transform (its score method, and
+for a PatternStage the patterns used) and how many transforms it keeps.
+
+Stages are sent to pool workers along with each transform, so they must
+be picklable (e.g., patterns are given as plugin classes, not instances).
+
+Transforms write their output into a scratch buffer that each thread (and
+so each pool worker) keeps for the size of data it's scoring, rather
+than into a new bytestring per transform (see transform_into). Stages
+are done with the transformed data by the time they return, as the
+matches they keep are packed, so the next transform can reuse the buffer.
+
+Stages able to score part of the transformed data (see shards) are
+shardable: once there are fewer transforms left than workers, each
+transform is scored a shard at a time, and the shards merged.
+
+A stage may also be given a time budget for each of its tasks (see
+budget), past which it returns what it has found so far.
+"""
+
+# The bytes that make up most of any text (and little else)
+TEXT = (string.ascii_lowercase + ' ').encode()
+
+_scratch = threading.local()
+
+
+def scratch_buffer(size):
+    """
+    Return:
+        The calling thread's scratch buffer, a bytearray of the given size
+    """
+    buffer = getattr(_scratch, 'buffer', None)
+    if buffer is None or len(buffer) != size:
+        buffer = _scratch.buffer = bytearray(size)
+    return buffer
+
+
+def transform_scratch(transformer, data):
+    """
+    Transform the data, into the calling thread's scratch buffer if the
+    transform can
+    Return:
+        The transformed data, only valid until the next call
+    """
+    return transformer.transform_into(data, scratch_buffer(len(data)))
+
+
+class Stage(ABC):
+    """
+    The base of all stages. Subclasses implement score(), and the hooks
+    of what they're capable of:
+    * score_shard() and merge_shards() if shardable, to score the shards
+      of a transform (see PatternStage)
+    * block_scores() if blockwise, to score each block of the transformed
+      data on its own (see segments)
+    """
+    # Whether the stage can score a transform a shard at a time
+    shardable = False
+    # Whether the stage can score the blocks of the data on their own
+    blockwise = False
+
+    def __init__(self, keep=None, details=None, budget=None):
+        """
+        Args:
+            keep: How many transforms the stage keeps (default = all)
+            details: Whether to keep the matches along with the score
+                (default = only if being verbose or it's the last stage)
+            budget: How many seconds each transform (or shard of one) may
+                be scored for (default = no limit, see budget)
+        """
+        self.keep = keep
+        self.details = details
+        self.budget = budget
+
+    @abstractmethod
+    def score(self, transformer, data, details=True):
+        """
+        Score the transformed data
+        Args:
+            transformer: The transform instance to apply
+            data: The bytestring to transform
+            details: Whether the matches are needed, or only the score
+        Return:
+            A tuple(transform_instance, score, msgs), where msgs is
+            a list of [description, weight, MatchList] (empty if no
+            details were asked for)
+        """
+
+    def timed_out(self, transformer, bounds=None):
+        """
+        Args:
+            transformer: The transform instance whose task was given up on
+            bounds: The bounds of the shard scored, if only one was
+        Return:
+            The Truncated result of a task given up on, as score (or
+            score_shard) returns
+        """
+        return Truncated((transformer, 0, []))
+
+
+class PatternStage(Stage):
+    """
+    Scores a transform by the weighted number of matches of a
+    set of patterns.
+    """
+    shardable = True
+    blockwise = True
+
+    def __init__(self, patterns=1, keep=None, details=None, budget=None):
+        """
+        Args:
+            patterns: A pattern stage number (see PatternPlugin.Stage), or
+                a list of PatternPlugin classes (default = 1)
+        """
+        super().__init__(keep, details, budget)
+        self.patterns = patterns
+        # Compiled here, so the pool workers forked afterwards have it
+        self._pattern_set()
+
+    def _pattern_set(self):
+        if isinstance(self.patterns, int):
+            return PatternSet.get(stage=self.patterns)
+        return PatternSet.get(patterns=self.patterns)
+
+    def _manager(self, transformer, data):
+        # Imported here, as the transformer module imports this one
+        from locke.transforms.transformer import BaseTransform
+        lower = None
+        if type(transformer).transform_lower is not \
+                BaseTransform.transform_lower:
+            # The transform folds the lowercasing in. Otherwise, the
+            # transformed data is lowercased rather than transformed again
+            lower = partial(transformer.transform_lower, data)
+        return Manager(raw=transform_scratch(transformer, data), lower=lower,
+                       patterns=self._pattern_set())
+
+    def score(self, transformer, data, details=True):
+        until = deadline(self.budget)
+        mgr = self._manager(transformer, data)
+        score = 0
+        msgs = []
+        scanned = 0
+        if not details:
+            for pat, count in mgr.count(until):
+                score += pat.Weight * count
+                scanned += 1
+            return self._result(transformer, score, msgs, scanned)
+
+        for pat, matches in mgr.run(until):
+            scanned += 1
+            if not matches:
+                continue
+
+            # Packing lets go of the transformed data
+            msgs.append([pat.Description, pat.Weight, pack_matches(matches)])
+            score += pat.Weight * len(matches)
+        del mgr
+
+        return self._result(transformer, score, msgs, scanned)
+
+    def _result(self, transformer, score, found, scanned):
+        """
+        The result of a task, Truncated if the budget ran out before every
+        pattern was scanned
+        """
+        if scanned < len(self._pattern_set().pats):
+            return Truncated((transformer, score, found))
+        return transformer, score, found
+
+    def block_scores(self, transformer, data, bounds):
+        """
+        Score each block of the transformed data on its own
+        Args:
+            transformer: The transform instance to apply
+            data: The bytestring to transform
+            bounds: The sorted offsets each block starts at (from 0)
+        Return:
+            A dict of block index to score, leaving out blocks scoring 0
+        """
+        scores = {}
+        for pat, matches in self._manager(transformer, data).run():
+            if isinstance(matches, MatchList):
+                offsets = matches.offsets
+            else:
+                offsets = [match.offset for match in matches]
+            for offset in offsets:
+                block = bisect_right(bounds, offset) - 1
+                scores[block] = scores.get(block, 0) + pat.Weight
+        return scores
+
+    def score_shard(self, transformer, data, bounds):
+        """
+        Score a shard of the transformed data
+        Args:
+            transformer: The transform instance to apply
+            data: The bytestring to transform (all of it)
+            bounds: The shard's tuple(start, stop, end) (see shard_bounds)
+        Return:
+            A tuple(transform_instance, score, found), where score is the
+            shard's alone (only meant for progress) and found is what
+            merge_shards needs of the shard
+        """
+        until = deadline(self.budget)
+        start, _, end = bounds
+        pattern_set = self._pattern_set()
+        found = scan_shard(transformer.transform_range(data, start, end),
+                           bounds, pattern_set, until)
+        scanned = len(found)
+        score = sum(pat.Weight * len(matches)
+                    for pat, matches in zip(pattern_set.pats, found))
+        # The patterns left unscanned found nothing
+        found += [_empty() for _ in pattern_set.pats[scanned:]]
+        return self._result(transformer, score, (bounds, found), scanned)
+
+    def merge_shards(self, results, details=True):
+        """
+        Merge the scores of the shards of a transform
+        Args:
+            results: The tuple score_shard returned for each shard,
+                in order
+            details: Whether the matches are needed, or only the score
+        Return:
+            A tuple(transform_instance, score, msgs), as score returns
+        """
+        bounds = [shard[0] for _, _, shard in results]
+        pats = self._pattern_set().pats
+        merged = merge_shards([shard[1] for _, _, shard in results],
+                              bounds, pats)
+        score, msgs = shard_messages(pats, merged, details)
+        if any(isinstance(result, Truncated) for result in results):
+            return Truncated((results[0][0], score, msgs))
+        return results[0][0], score, msgs
+
+    def timed_out(self, transformer, bounds=None):
+        if bounds is None:
+            return super().timed_out(transformer)
+        found = [_empty() for _ in self._pattern_set().pats]
+        return Truncated((transformer, 0, (bounds, found)))
+
+
+class HistogramStage(Stage):
+    """
+    A cheap gate scoring a transform by how many bytes of its output are
+    in an alphabet (by default, lowercase letters and spaces, as all of
+    printable ASCII is too common in binary data to tell much). It finds
+    no matches.
+    """
+    blockwise = True
+
+    def __init__(self, keep=None, alphabet=TEXT, budget=None):
+        super().__init__(keep, False, budget)
+        self.alphabet = alphabet
+
+    def score(self, transformer, data, details=True):
+        trans_data = transform_scratch(transformer, data)
+        # Deleting the alphabet leaves the bytes outside of it
+        score = len(trans_data) - len(trans_data.translate(None,
+                                                           self.alphabet))
+        return transformer, score, []
+
+    def block_scores(self, transformer, data, bounds):
+        """
+        See PatternStage.block_scores
+        """
+        trans_data = transform_scratch(transformer, data)
+        scores = {}
+        for block, start in enumerate(bounds):
+            stop = bounds[block + 1] if block + 1 < len(bounds) else None
+            chunk = trans_data[start:stop]
+            score = len(chunk) - len(chunk.translate(None, self.alphabet))
+            if score:
+                scores[block] = score
+        return scores
+
+
+def _empty():
+    return MatchList(b'', starts=array('q'))
+
+
+def default_cascade(keep, budget=None):
+    """
+    The two stages Locke has always run: every transform scored by
+    the stage 1 patterns, then the top "keep" by the stage 2 patterns,
+    each given the time budget if any
+    """
+    return [PatternStage(1, keep, budget=budget),
+            PatternStage(2, budget=budget)]
+
+
+def parse_cascade(spec, budget=None):
+    """
+    Parse a cascade from a comma separated list of STAGE[:KEEP] items,
+    where STAGE is a pattern stage number or "histogram"
+    (e.g., "histogram:2000,1:20,2"), each stage given the time budget if
+    any
+    Return:
+        A list of stages
+    """
+    cascade = []
+    for item in spec.split(','):
+        name, _, keep = item.strip().partition(':')
+        keep = int(keep) if keep else None
+        if name == 'histogram':
+            cascade.append(HistogramStage(keep, budget=budget))
+        elif name.isdigit():
+            cascade.append(PatternStage(int(name), keep, budget=budget))
+        else:
+            raise ValueError('unknown cascade stage "%s"' % name)
+    return cascade
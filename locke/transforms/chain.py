@@ -0,0 +1,247 @@
+import threading
+from collections import OrderedDict
+
+from locke.transforms.transformer import BaseTransform, TransformChar, \
+    TransformString, TransformAllStage1, _run_stage, rank_results
+
+"""
+Cracking data encoded by more than one transform (e.g., a keystream
+over a byte substitution).
+
+Trying every chain of transforms is out of the question, so the layers
+are searched as a beam: every transform is scored on the data, then every
+transform is scored on the output of each of the best few (the beam), and
+so on for as many layers as asked for.
+"""
+
+# How many chain prefixes' outputs each worker keeps around. The tasks of
+# a layer come grouped by prefix, so only a few are needed at once
+PREFIX_CACHE_SIZE = 4
+# Kept per thread, as the workers of a thread pool share the module
+_prefixes = threading.local()
+
+
+def _prefix_cache():
+    """
+    Return:
+        The calling thread's cache of prefix outputs
+    """
+    cache = getattr(_prefixes, 'cache', None)
+    if cache is None:
+        cache = _prefixes.cache = OrderedDict()
+    return cache
+
+
+def _table(transformer):
+    """
+    Return:
+        The translation table of a byte-for-byte transformer, else None
+    """
+    if isinstance(transformer, TransformChar):
+        return transformer.generate_trans_table()
+    elif isinstance(transformer, TransformAllStage1):
+        return transformer.value[0]
+    return None
+
+
+class TransformChain(TransformString):
+    """
+    Name: TransformChain
+    Description: Apply several transforms, one after the other
+    """
+    description = 'Apply several transforms, one after the other'
+    params = 'A tuple of transform instances'
+
+    @staticmethod
+    def class_level():
+        # Never picked on its own, only built by beam_search
+        return 0
+
+    def name(self):
+        return ' > '.join(trans.name() for trans in self.value)
+
+    def shortname(self):
+        return '+'.join(trans.shortname() for trans in self.value)
+
+    def _apply(self, transformers, data):
+        """
+        Apply the transformers in order, translating runs of
+        byte-for-byte transformers in one go
+        """
+        table = None
+        for trans in transformers:
+            step = _table(trans)
+            if step is not None:
+                table = step if table is None else table.translate(step)
+                continue
+            if table is not None:
+                data = data.translate(table)
+                table = None
+            data = trans.transform(data)
+        return data if table is None else data.translate(table)
+
+    def _prefix(self, data):
+        """
+        The output of every transform but the last, cached as it's the
+        same for every chain a layer builds on the same prefix
+        """
+        key = (id(data), tuple((type(trans), trans.name())
+                               for trans in self.value[:-1]))
+        cache = _prefix_cache()
+        cached = cache.get(key)
+        if cached is not None and cached[0] is data:
+            cache.move_to_end(key)
+            return cached[1]
+        output = self._apply(self.value[:-1], data)
+        cache[key] = (data, output)
+        while len(cache) > PREFIX_CACHE_SIZE:
+            cache.popitem(last=False)
+        return output
+
+    def transform_string(self, data, encode=False):
+        if encode:
+            for trans in reversed(self.value):
+                data = trans.transform(data, True)
+            return data
+        return self.value[-1].transform(self._prefix(data))
+
+    def transform_lower(self, data, encode=False):
+        if encode:
+            return self.transform(data, True).lower()
+        return self.value[-1].transform_lower(self._prefix(data))
+
+    def transform_range(self, data, start, stop):
+        table = _composed_table(self)
+        if table is None:
+            return super().transform_range(data, start, stop)
+        return data[start:stop].translate(table)
+
+    @staticmethod
+    def all_iteration():
+        return iter(())
+
+
+def _composed_table(transformer):
+    """
+    Return:
+        The translation table of a transformer or a chain of them, if
+        it's byte-for-byte throughout, else None
+    """
+    steps = transformer.value if isinstance(transformer, TransformChain) \
+        else (transformer,)
+    table = bytes(range(256))
+    for trans in steps:
+        step = _table(trans)
+        if step is None:
+            return None
+        table = table.translate(step)
+    return table
+
+
+def _distinct(ranked, limit, seen=None):
+    """
+    Pick the best results up to limit, skipping those that transform the
+    data the same as one picked before (e.g., XOR 62 > XOR 20 and XOR 42)
+    Args:
+        ranked: A sorted list of tuple(trans_instance, score, msgs)
+        limit: How many results to pick (None for all)
+        seen: The tables of results picked before, updated as picked
+    Return:
+        A sorted list of tuple(trans_instance, score, msgs)
+    """
+    seen = set() if seen is None else seen
+    picked = []
+    for result in ranked:
+        if limit is not None and len(picked) >= limit:
+            break
+        table = _composed_table(result[0])
+        if table is not None:
+            if table in seen:
+                continue
+            seen.add(table)
+        picked.append(result)
+    return picked
+
+
+def _layer_tasks(beam, trans_list, stage, data=None):
+    """
+    Generate the tasks of one layer of the beam search
+    Args:
+        beam: The transformers to build on (None for the data itself)
+        trans_list: A list of transformer classes
+        stage: The Stage scoring the layer
+        data: The bytestring to evaluate, for transforms deriving their
+            iterations from it (default = None, all_iteration only)
+    Return:
+        Generates tuple(trans_instance, stage)
+    """
+    for prefix in beam:
+        output = None
+        if isinstance(prefix, TransformChain):
+            prefix = prefix.value
+        elif prefix is not None:
+            prefix = (prefix,)
+        for trans in trans_list:
+            if data is None or \
+                    trans.iterations.__func__ is \
+                    BaseTransform.iterations.__func__:
+                values = trans.all_iteration()
+            else:
+                # Their iterations depend on what the prefix outputs
+                if output is None:
+                    output = data if prefix is None else \
+                        TransformChain(prefix).transform(data)
+                values = trans.iterations(output)
+            for value in values:
+                if prefix is None:
+                    yield trans(value), stage
+                else:
+                    yield TransformChain(prefix + (trans(value),)), stage
+
+
+def beam_search(pool, worker, trans_list, stage, depth=2, width=None,
+                data=None, progress=None, state=None, on_layer=None):
+    """
+    Score chains of up to depth transforms with a beam search
+    Args:
+        pool: The pool to run the tasks on
+        worker: The function the pool's workers run
+        trans_list: A list of transformer classes for each layer
+        stage: The Stage scoring every layer
+        depth: How many layers of transforms to chain (default = 2)
+        width: How many chains of a layer the next builds on
+            (default = how many the stage keeps)
+        data: The bytestring to evaluate, for progress events and for
+            transforms deriving their iterations from it (default = None)
+        progress: A list of callables to send ProgressEvents to
+        state: The state on_layer was last called with, to resume the
+            search from (default = None, start with the first layer)
+        on_layer: Called with the search's state after each layer, as a
+            dict of the layers done and what's needed to carry on
+            (default = None)
+    Return:
+        A tuple(results, count), where results are the best transforms
+        and chains of any layer (up to what the stage keeps) and count is
+        how many were scored
+    """
+    width = stage.keep if width is None else width
+    if state is None:
+        # Chains equivalent to a shorter one aren't worth building on
+        state = {'layers': 0, 'beam': [None], 'found': [], 'count': 0,
+                 'seen': set()}
+    beam, seen = state['beam'], state['seen']
+    found, count = list(state['found']), state['count']
+    for layer in range(state['layers'], depth):
+        results = _run_stage(pool, worker,
+                             _layer_tasks(beam, trans_list, stage, data), 1,
+                             len(data or b''), progress)
+        count += len(results)
+        found.extend(results)
+        beam = [result[0] for result in
+                _distinct(rank_results(results), width, seen)]
+        if on_layer is not None:
+            # Only the results that could still be picked are kept
+            on_layer({'layers': layer + 1, 'beam': beam,
+                      'found': _distinct(rank_results(found), stage.keep),
+                      'count': count, 'seen': seen})
+    return _distinct(rank_results(found), stage.keep), count
@@ -0,0 +1,219 @@
+import hashlib
+import os
+import pickle
+import sys
+import time
+from stat import S_IWGRP, S_IWOTH
+
+from locke.transforms.differential import place_scored, score_families
+from locke.transforms.distributed import partition, shard_tasks
+from locke.transforms.events import ProgressTracker
+from locke.transforms.transformer import _run_stage, rank_results
+
+"""
+Checkpoints of a crack, so a crack that was stopped (killed, or the host
+restarted) can carry on where it was rather than start over.
+
+A checkpoint is saved to a file now and then as the crack runs, and
+holds only what the rest of the crack needs:
+* The results kept by the last stage completed
+* For a first stage running through the keyspace, the shards of it done
+  (see partition) and the best results of those so far
+* For a first stage chaining transforms, the layers done (see
+  beam_search)
+
+Checkpoints are tied to the data cracked and the options it's cracked
+with (the transforms, the cascade, the depth and width), and are only
+resumed from by a crack of the same. They're pickled, so only files owned
+by the user resuming (and writable by no one else) are resumed from.
+"""
+
+# Bumped whenever what a checkpoint holds changes
+FORMAT = 1
+# The fewest seconds between saves, other than at the end of a stage
+INTERVAL = 60.0
+
+
+def checkpoint_key(data, trans_list, cascade, depth=1, width=None):
+    """
+    Return:
+        A hex digest of the data and the options it's cracked with
+    """
+    digest = hashlib.sha256(data)
+    config = ([(trans.__module__, trans.__name__) for trans in trans_list],
+              [(type(stage).__name__, sorted(vars(stage).items()))
+               for stage in cascade], depth, width)
+    digest.update(repr(config).encode())
+    return digest.hexdigest()
+
+
+class Checkpoint(object):
+    """
+    The progress of a crack, saved to a file.
+
+    Every checkpoint has the following fields:
+    * stage (int) - The number of the first stage not completed
+    * results (list) - The results the stage before it kept
+    * keyspace (tuple) - For a first stage in progress, the set of the
+      indexes of the shards done, and the best results of those so far
+    * beam (dict) - For a first stage chaining transforms, the state of
+      the beam search after the layers done
+    """
+
+    def __init__(self, path, key, interval=INTERVAL):
+        """
+        Args:
+            path: The file the checkpoint is saved to
+            key: What the checkpoint is tied to (see checkpoint_key)
+            interval: The fewest seconds between saves (default = INTERVAL)
+        """
+        self.path = path
+        self.key = key
+        self.interval = interval
+        self.stage = 1
+        self.results = None
+        self.keyspace = None
+        self.beam = None
+        self.saved = time.time()
+
+    @classmethod
+    def open(cls, path, key, resume=False, interval=INTERVAL):
+        """
+        Start a checkpoint, resuming from the one saved to path if asked
+        to and it was saved by the same crack. Checkpoints are unpickled,
+        which runs whatever code the file asks for, so a file owned by
+        another user (or writable by others) is never resumed from
+        Return:
+            A Checkpoint
+        """
+        checkpoint = cls(path, key, interval)
+        if not resume:
+            return checkpoint
+        try:
+            with open(path, 'rb') as f:
+                if not _owned(f):
+                    print('The checkpoint at %s is not yours, starting over'
+                          % path, file=sys.stderr)
+                    return checkpoint
+                state = pickle.load(f)
+        except FileNotFoundError:
+            print('No checkpoint at %s, starting over' % path,
+                  file=sys.stderr)
+            return checkpoint
+        if state.get('format') != FORMAT or state.get('key') != key:
+            print('The checkpoint at %s is of another crack, starting over'
+                  % path, file=sys.stderr)
+            return checkpoint
+        checkpoint.stage = state['stage']
+        checkpoint.results = state['results']
+        checkpoint.keyspace = state['keyspace']
+        checkpoint.beam = state['beam']
+        return checkpoint
+
+    def save(self, force=True):
+        """
+        Write the checkpoint to its file, replacing the one before it
+        Args:
+            force: Save even if the last save was under the interval ago
+                (default = True)
+        """
+        if not force and time.time() - self.saved < self.interval:
+            return
+        state = {'format': FORMAT, 'key': self.key, 'stage': self.stage,
+                 'results': self.results, 'keyspace': self.keyspace,
+                 'beam': self.beam}
+        partial_path = self.path + '.part'
+        with open(partial_path, 'wb') as f:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        # A crash while writing leaves the previous checkpoint whole
+        os.replace(partial_path, self.path)
+        self.saved = time.time()
+
+    def finish_stage(self, number, results):
+        """
+        Record the results a stage kept, and save
+        """
+        self.stage = number + 1
+        self.results = results
+        self.keyspace = None
+        self.beam = None
+        self.save()
+
+    def save_beam(self, state):
+        """
+        Record the state of a beam search after a layer, and save
+        """
+        self.beam = state
+        self.save()
+
+    def remove(self):
+        """
+        Delete the checkpoint's file, once the crack is complete
+        """
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def _owned(f):
+    """
+    Return:
+        Whether the open file is owned by the user running this, and only
+        writable by them (always True where there are no owners)
+    """
+    if not hasattr(os, 'getuid'):
+        return True
+    stat = os.fstat(f.fileno())
+    return stat.st_uid == os.getuid() and \
+        not stat.st_mode & (S_IWGRP | S_IWOTH)
+
+
+def run_keyspace(pool, worker, trans_list, stage, data, checkpoint,
+                 progress=None, details=True):
+    """
+    Run the first stage of a cascade over the keyspace, a shard at a
+    time, recording the shards done and the best results in the
+    checkpoint (and skipping the shards it already has done)
+    Args:
+        pool: The pool to run the tasks on
+        worker: The function the pool's workers run
+        trans_list: A list of transformer classes
+        stage: The first Stage of the cascade
+        data: The bytestring to evaluate
+        checkpoint: The Checkpoint of the crack
+        progress: A list of callables to send ProgressEvents to
+        details: Whether the matches are needed, or only the score
+    Return:
+        A tuple(results, count), where results are the best results (up
+        to what the stage keeps) and count is how many were scored
+    """
+    shards = partition(trans_list, data=data)
+    done, top = checkpoint.keyspace or (set(), [])
+    if done:
+        print('Resuming with %i of %i shards done' % (len(done), len(shards)))
+    # One tracker for the whole stage, rather than one per shard
+    tracker = None
+    if progress:
+        tracker = ProgressTracker(
+            1, sum(stop - start for index, (_, start, stop)
+                   in enumerate(shards) if index not in done),
+            len(data), progress)
+    for index, shard in enumerate(shards):
+        if index in done:
+            continue
+        # XOR and ADD keys are scored a family at a time
+        tasks, scored = score_families(shard_tasks(shard, stage, data), data,
+                                       details)
+        if tracker is not None:
+            for result in scored.values():
+                tracker.update(result)
+        results = place_scored(_run_stage(pool, worker, tasks, 1, len(data),
+                                          tracker=tracker), scored)
+        top = rank_results(top + results, stage.keep)
+        done.add(index)
+        checkpoint.keyspace = (done, top)
+        checkpoint.save(force=False)
+    if tracker is not None:
+        tracker.finish()
+    return top, sum(stop - start for _, start, stop in shards)
@@ -0,0 +1,345 @@
+import re
+from abc import ABC, abstractmethod
+from array import array
+from copy import deepcopy
+from functools import lru_cache
+
+from locke.patterns.pattern_plugin import BytesListPatternPlugin, \
+    BytesPatternPlugin, PatternPlugin
+from locke.patterns.utils import MatchList
+from locke.transforms.cascade import PatternStage
+from locke.transforms.transformer import TransformAllStage1, \
+    TransformChar, add_table, xor_table
+
+"""
+Scoring every XOR and ADD key of a stage at once, rather than one task
+(one translation and scan of the data) per key.
+
+XORing or adding a key to every byte leaves the differences between
+neighbouring bytes as they were: out[i] ^ out[i + 1] == data[i] ^
+data[i + 1] for any XOR key, and likewise for the difference modulo 256
+of an ADD key. So the literals of the stage 1 patterns are searched for
+once, by their differences, in the differences of the data (its delta
+image). The key is worked out from the first byte of each hit, and the
+hit checked against the data transformed by it.
+
+The matches found for each key are those a scan of the transformed data
+would find (without overlaps, as bytes.count), so the scores are the same.
+Case-insensitive literals match any of the differences their letters'
+cases allow. Only stages of literal patterns (without filters) can be
+scored this way; the tasks of any other stage are left to the pool, as
+are families with fewer than MIN_KEYS keys to score.
+"""
+
+# Families with fewer keys are scanned key by key, as searching a delta
+# image for every literal costs about as much as scanning a dozen keys
+MIN_KEYS = 16
+
+
+class DeltaFamily(ABC):
+    """
+    Transforms of a byte key whose output differs from byte to byte as
+    their input does, whatever the key
+    """
+
+    def __init__(self, name, table, delta, key):
+        """
+        Args:
+            name: The name of the family
+            table: Returns the translation table of a key
+            delta: Returns the difference between two neighbouring bytes
+            key: Returns the key transforming a byte into another
+        """
+        self.name = name
+        self.table = table
+        self.delta = delta
+        self.key = key
+
+    @abstractmethod
+    def image(self, data):
+        """
+        Return:
+            The differences of each byte of the data and the next
+        """
+
+
+class XORFamily(DeltaFamily):
+    def __init__(self):
+        super().__init__('xor', xor_table, lambda x, y: x ^ y,
+                         lambda byte, out: byte ^ out)
+
+    def image(self, data):
+        # Every byte XORed with the one before, a whole int at a time
+        value = int.from_bytes(data, 'big')
+        return (value ^ (value >> 8)).to_bytes(len(data), 'big')[1:]
+
+
+class ADDFamily(DeltaFamily):
+    def __init__(self):
+        super().__init__('add', add_table, lambda x, y: (y - x) & 0xFF,
+                         lambda byte, out: (out - byte) & 0xFF)
+
+    def image(self, data):
+        if len(data) < 2:
+            return b''
+        size = len(data) - 1
+        after = int.from_bytes(data[1:], 'big')
+        before = int.from_bytes(data[:-1], 'big')
+        high = int.from_bytes(b'\x80' * size, 'big')
+        # Each byte subtracted without borrowing from the next: the top
+        # bits are set aside, so no byte goes below 0
+        diff = ((after | high) - (before & ~high)) ^ \
+            ((after ^ ~before) & high)
+        return diff.to_bytes(size, 'big')
+
+
+FAMILIES = (XORFamily(), ADDFamily())
+
+
+@lru_cache(maxsize=None)
+def _family_tables():
+    """
+    Return:
+        A dict of each family's key tables to tuple(family, key). A table
+        of both families (e.g., XOR 80 and ADD 80) goes to the first
+    """
+    tables = {}
+    for family in reversed(FAMILIES):
+        for key in range(0x100):
+            tables[family.table(key)] = (family, key)
+    return tables
+
+
+def family_key(transformer):
+    """
+    Return:
+        The tuple(family, key) of a transform translating by a family's
+        key table, or None
+    """
+    if isinstance(transformer, TransformAllStage1):
+        table = transformer.value[0]
+    elif isinstance(transformer, TransformChar):
+        table = transformer.generate_trans_table()
+    else:
+        return None
+    return _family_tables().get(table)
+
+
+def _literal_groups(pattern_set):
+    """
+    Return:
+        For each pattern of the set, the list of its literals, each as the
+        list of the variants (wide copies) matched along with it, or None
+        if a pattern isn't made of literals only
+    """
+    groups = []
+    for pat in pattern_set.pats:
+        if type(pat).filter is not PatternPlugin.filter:
+            return None
+        if isinstance(pat, BytesPatternPlugin):
+            literals = [pat.Pattern.lower() if pat.NoCase else pat.Pattern]
+        elif isinstance(pat, BytesListPatternPlugin):
+            literals = pat.Patterns
+        else:
+            return None
+        variants = [pat.variants(literal) if pat.wide else [literal]
+                    for literal in literals]
+        # The differences of a single byte are of nothing
+        if any(len(v) < 2 for group in variants for v in group):
+            return None
+        groups.append(variants)
+    return groups
+
+
+def _outputs(byte, nocase):
+    """
+    Return:
+        The transformed bytes matching a byte of a literal
+    """
+    if nocase and 0x61 <= byte <= 0x7A:
+        return byte, byte - 0x20
+    return byte,
+
+
+def _needle(family, literal, nocase):
+    """
+    Return:
+        What to search the delta image for: the differences of the
+        literal, or a regular expression of those its cases allow
+    """
+    allowed = [sorted({family.delta(x, y) for x in _outputs(first, nocase)
+                       for y in _outputs(second, nocase)})
+               for first, second in zip(literal, literal[1:])]
+    if all(len(deltas) == 1 for deltas in allowed):
+        return bytes(deltas[0] for deltas in allowed)
+    return re.compile(b''.join(
+        b'[' + b''.join(b'\\x%02x' % delta for delta in deltas) + b']'
+        for deltas in allowed))
+
+
+def _starts(image, needle):
+    """
+    Generate the offsets of every hit of the needle in the delta image,
+    overlapping ones included
+    """
+    if isinstance(needle, bytes):
+        i = image.find(needle)
+        while i != -1:
+            yield i
+            i = image.find(needle, i + 1)
+    else:
+        md = needle.search(image)
+        while md is not None:
+            yield md.start()
+            md = needle.search(image, md.start() + 1)
+
+
+def _literal_hits(family, image, data, literal, nocase, keys):
+    """
+    Return:
+        A dict of each of the keys to the offsets the literal matches the
+        data transformed by the key at
+    """
+    hits = {}
+    size = len(literal)
+    for i in _starts(image, _needle(family, literal, nocase)):
+        for out in _outputs(literal[0], nocase):
+            key = family.key(data[i], out)
+            if key not in keys:
+                continue
+            window = data[i:i + size].translate(family.table(key))
+            if (window.lower() if nocase else window) == literal:
+                hits.setdefault(key, []).append(i)
+    return hits
+
+
+def _select(hits):
+    """
+    Pick the matches a scan finds from the hits of a literal's variants:
+    from the start, the first variant matching at each offset, skipping
+    those overlapping a match picked
+    Args:
+        hits: A list of tuple(offset, variant index, length)
+    Return:
+        A list of tuple(offset, variant index)
+    """
+    picked = []
+    end = 0
+    for offset, variant, length in sorted(hits):
+        if offset >= end:
+            picked.append((offset, variant))
+            end = offset + length
+    return picked
+
+
+def score_keys(family, data, pattern_set, keys, details=True):
+    """
+    Score the data transformed by each key of a family
+    Args:
+        family: The DeltaFamily of the keys
+        data: The bytestring to evaluate
+        pattern_set: The PatternSet to score with, of literals only
+        keys: The keys to score
+        details: Whether the matches are needed, or only the score
+    Return:
+        A dict of each key to tuple(score, msgs), as PatternStage.score
+        returns
+    """
+    keys = set(keys)
+    image = family.image(data)
+    scored = {key: (0, []) for key in keys}
+    for pat, groups in zip(pattern_set.pats, _literal_groups(pattern_set)):
+        # The matches of each key, literal by literal as a scan lists them
+        found = {}
+        for variants in groups:
+            hits = {}
+            for index, variant in enumerate(variants):
+                for key, offsets in _literal_hits(family, image, data,
+                                                  variant, pat.NoCase,
+                                                  keys).items():
+                    hits.setdefault(key, []).extend(
+                        (offset, index, len(variant)) for offset in offsets)
+            for key, key_hits in hits.items():
+                found.setdefault(key, []).extend(
+                    (offset, variants[index])
+                    for offset, index in _select(key_hits))
+
+        for key, matches in found.items():
+            score, msgs = scored[key]
+            score += pat.Weight * len(matches)
+            if details:
+                msgs.append([pat.Description, pat.Weight,
+                             _match_list(matches)])
+            scored[key] = score, msgs
+    return scored
+
+
+def _match_list(matches):
+    """
+    Return:
+        A packed MatchList of tuple(offset, matched bytes)
+    """
+    offsets, lengths, starts = array('q'), array('q'), array('q')
+    pos = 0
+    for offset, literal in matches:
+        offsets.append(offset)
+        lengths.append(len(literal))
+        starts.append(pos)
+        pos += len(literal)
+    return MatchList(b''.join(literal for _, literal in matches), offsets,
+                     lengths, starts)
+
+
+def score_families(tasks, data, details=True):
+    """
+    Score the tasks of a stage whose transforms are XOR or ADD keys,
+    a family at a time (see score_keys), leaving the others to be run
+    Args:
+        tasks: An iterable of tuple(trans_instance, stage)
+        data: The bytestring to evaluate
+        details: Whether the matches are needed, or only the score
+    Return:
+        A tuple(tasks, scored), where tasks is the list of the tasks left
+        to run and scored a dict of the index of each task scored to its
+        result
+    """
+    tasks = list(tasks)
+    # The indexes of the tasks of each key, by stage and family
+    picked = {}
+    for index, task in enumerate(tasks):
+        if len(task) != 2 or not isinstance(task[1], PatternStage):
+            continue
+        found = family_key(task[0])
+        if found is not None:
+            family, key = found
+            picked.setdefault((task[1], family), {}).setdefault(
+                key, []).append(index)
+
+    scored = {}
+    for (stage, family), indexes in picked.items():
+        pattern_set = stage._pattern_set()
+        if len(indexes) < MIN_KEYS or _literal_groups(pattern_set) is None:
+            continue
+        for key, (score, msgs) in score_keys(family, data, pattern_set,
+                                             indexes, details).items():
+            for n, index in enumerate(indexes[key]):
+                # Matches are moved in place when remapped, so each task
+                # of the same key gets its own
+                scored[index] = (tasks[index][0], score,
+                                 msgs if n == 0 else deepcopy(msgs))
+    return [task for index, task in enumerate(tasks)
+            if index not in scored], scored
+
+
+def place_scored(results, scored):
+    """
+    Return:
+        The results of the tasks run, with those score_families scored
+        put back in between, in the order of the tasks
+    """
+    if not scored:
+        return results
+    count = len(results) + len(scored)
+    results = iter(results)
+    return [scored[index] if index in scored else next(results)
+            for index in range(count)]
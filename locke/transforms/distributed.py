@@ -0,0 +1,350 @@
+import os
+import socket
+import threading
+import time
+from functools import partial
+from itertools import islice
+from multiprocessing.connection import Client, Listener
+
+from locke.transforms.transformer import _make_pool, rank_results
+
+"""
+Stage 1 spread over several hosts.
+
+A coordinator splits the keyspace (the iterations of every transformer
+class) into shards, and hands out leases on them over TCP to any number
+of workers. Each worker transforms and scores its shard on its own pool,
+and sends back the shard's top results, which the coordinator merges.
+Leases that aren't renewed in time (e.g., the worker died) are handed
+out again.
+
+Connections are authenticated with a shared key, but not encrypted.
+"""
+
+# The calls workers can make on the coordinator
+CALLS = ('job', 'lease', 'renew', 'complete')
+
+
+def _iterations(trans, data=None):
+    return trans.all_iteration() if data is None else trans.iterations(data)
+
+
+def partition(trans_list, shard_size=4096, data=None):
+    """
+    Split the keyspace into shards
+    Args:
+        trans_list: A list of transformer classes
+        shard_size: The most iterations per shard
+        data: The bytestring to evaluate, for transforms deriving their
+            iterations from it (default = None, all_iteration only)
+    Return:
+        A list of tuple(trans_class, start, stop), where start and stop
+        index into trans_class.iterations(data)
+    """
+    shards = []
+    for trans in trans_list:
+        count = sum(1 for _ in _iterations(trans, data))
+        for start in range(0, count, shard_size):
+            shards.append((trans, start, min(start + shard_size, count)))
+    return shards
+
+
+def shard_tasks(shard, stage=1, data=None):
+    """
+    Generate the stage 1 tasks of a shard
+    Args:
+        shard: A tuple(trans_class, start, stop)
+        stage: The first Stage of the cascade (default = stage 1 patterns)
+        data: The bytestring the shard was partitioned for
+    Return:
+        Generates tuple(trans_instance, stage)
+    """
+    trans, start, stop = shard
+    for value in islice(_iterations(trans, data), start, stop):
+        yield trans(value), stage
+
+
+class Coordinator(object):
+    """
+    Keeps track of the shards of the keyspace: which are waiting, which
+    are leased to a worker (and until when), and the top results of those
+    that are complete. It's safe to use from several threads.
+    """
+
+    def __init__(self, data, shards, keep, lease_timeout=60.0,
+                 details=False, stage=1):
+        self.data = data
+        self.shards = shards
+        self.keep = keep
+        self.details = details
+        self.stage = stage
+        self.lease_timeout = lease_timeout
+        self.pending = list(range(len(shards)))
+        self.leases = {}
+        self.issued = {}
+        self.completed = {}
+        self.next_lease = 0
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        if not shards:
+            self.done.set()
+
+    def job(self):
+        """
+        Return:
+            A tuple(data, keep, details, stage) for workers to start from
+        """
+        return self.data, self.keep, self.details, self.stage
+
+    def _expire(self):
+        now = time.time()
+        for lease_id, (index, deadline, _) in list(self.leases.items()):
+            if deadline <= now:
+                del self.leases[lease_id]
+                if index not in self.completed:
+                    self.pending.append(index)
+
+    def lease(self, worker):
+        """
+        Lease a shard to a worker
+        Args:
+            worker: A name for the worker
+        Return:
+            A tuple(lease_id, shard), None once every shard is complete,
+            or False if every shard left is leased for now
+        """
+        with self.lock:
+            self._expire()
+            if self.done.is_set():
+                return None
+            if not self.pending:
+                return False
+            index = self.pending.pop(0)
+            lease_id = self.next_lease
+            self.next_lease += 1
+            self.leases[lease_id] = (index, time.time() + self.lease_timeout,
+                                     worker)
+            self.issued[lease_id] = index
+            return lease_id, self.shards[index]
+
+    def renew(self, lease_id):
+        """
+        Extend a lease
+        Return:
+            False if the lease has expired (the shard may have been handed
+            out again), else True
+        """
+        with self.lock:
+            self._expire()
+            if lease_id not in self.leases:
+                return False
+            index, _, worker = self.leases[lease_id]
+            self.leases[lease_id] = (index, time.time() + self.lease_timeout,
+                                     worker)
+            return True
+
+    def complete(self, lease_id, results):
+        """
+        Record the top results of a leased shard, even if the lease has
+        expired. If the shard was completed already (by whoever it was
+        handed out to next), the results are ignored.
+        """
+        with self.lock:
+            index = self.issued.get(lease_id)
+            for other, (shard, _, _) in list(self.leases.items()):
+                if shard == index:
+                    del self.leases[other]
+            if index is None or index in self.completed:
+                return
+            if index in self.pending:
+                self.pending.remove(index)
+            self.completed[index] = results
+            if len(self.completed) == len(self.shards):
+                self.done.set()
+
+    def results(self):
+        """
+        Return:
+            The top "keep" results over all shards, ranked as
+            run_transformations() would rank them
+        """
+        with self.lock:
+            merged = []
+            # In shard order, so ties rank as they would on one host
+            for index in sorted(self.completed):
+                merged.extend(self.completed[index])
+            return rank_results(merged, self.keep)
+
+
+class KeyspaceServer(object):
+    """
+    Serves a Coordinator to workers over TCP.
+    """
+
+    def __init__(self, coordinator, address, authkey):
+        self.coordinator = coordinator
+        self.authkey = authkey
+        self.listener = Listener(address, authkey=authkey)
+        self.address = self.listener.address
+        self.stopped = False
+
+    def start(self):
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+        return self.address
+
+    def _accept(self):
+        while not self.stopped:
+            try:
+                conn = self.listener.accept()
+            except Exception:
+                # e.g., a client failing to authenticate
+                continue
+            thread = threading.Thread(target=self._serve, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, conn):
+        with conn:
+            while not self.stopped:
+                try:
+                    message = conn.recv()
+                except Exception:
+                    # The worker went away, or sent something unreadable
+                    return
+                try:
+                    call, args = message
+                    if call not in CALLS:
+                        raise ValueError('unknown call "%s"' % call)
+                    result = getattr(self.coordinator, call)(*args)
+                except Exception as e:
+                    # Sent back for the worker to raise, rather than
+                    # ending the connection (and this thread) here
+                    result = e
+                try:
+                    conn.send(result)
+                except Exception:
+                    return
+
+    def wait(self, timeout=None):
+        """
+        Wait for every shard to complete
+        Return:
+            The merged results (see Coordinator.results)
+        """
+        if not self.coordinator.done.wait(timeout):
+            raise TimeoutError('the keyspace was not completed in time')
+        return self.coordinator.results()
+
+    def stop(self):
+        self.stopped = True
+        # Wake the accepting thread up so it notices
+        try:
+            Client(self.address, authkey=self.authkey).close()
+        except Exception:
+            pass
+        self.listener.close()
+
+
+def serve_keyspace(data, shards, keep, address, authkey,
+                   lease_timeout=60.0, details=False, stage=1):
+    """
+    Run stage 1 on the workers that connect to address, returning once
+    every shard is complete
+    Args:
+        data: The bytestring to evaluate
+        shards: The shards to hand out (see partition)
+        keep: How many results to keep
+        address: The tuple(host, port) to listen on
+        authkey: The bytestring workers must authenticate with
+        lease_timeout: Seconds before an unrenewed lease is handed out again
+        details: Have workers send back the matches of stage 1
+        stage: The first Stage of the cascade (default = stage 1 patterns)
+    Return:
+        A sorted list of tuples(trans_instance, score, msgs) up to
+        "keep" size
+    """
+    coordinator = Coordinator(data, shards, keep, lease_timeout, details,
+                              stage)
+    server = KeyspaceServer(coordinator, address, authkey)
+    print('Serving %i shards on %s:%i' % ((len(shards),) + server.address))
+    server.start()
+    try:
+        return server.wait()
+    finally:
+        server.stop()
+
+
+def run_worker(address, authkey, backend='process', renew_every=None):
+    """
+    Work on shards from the coordinator at address until there
+    are none left
+    Args:
+        address: The tuple(host, port) of the coordinator
+        authkey: The bytestring to authenticate with
+        backend: Run on a 'process' (default) or 'thread' pool
+        renew_every: Seconds between lease renewals, which should be well
+            under the coordinator's lease timeout (default = 10)
+    Return:
+        The number of shards completed
+    """
+    conn = Client(address, authkey=authkey)
+    worker_name = '%s:%i' % (socket.gethostname(), os.getpid())
+    renew_every = 10.0 if renew_every is None else renew_every
+    # Leases are renewed from another thread, over the same connection
+    lock = threading.Lock()
+
+    def call(name, *args):
+        with lock:
+            conn.send((name, args))
+            result = conn.recv()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def renew(lease_id, finished):
+        # On a timer rather than as results come in, so a slow task
+        # can't outlive the lease. Even if it expired, the results are
+        # still accepted
+        try:
+            while not finished.wait(renew_every):
+                call('renew', lease_id)
+        except (EOFError, OSError):
+            pass
+
+    data, keep, details, stage = call('job')
+    pool, worker = _make_pool(data, backend)
+    worker = partial(worker, details=details)
+    completed = 0
+    try:
+        while True:
+            lease = call('lease', worker_name)
+            if lease is None:
+                break
+            elif lease is False:
+                # Everything is leased, but a lease might expire
+                time.sleep(1)
+                continue
+
+            lease_id, shard = lease
+            finished = threading.Event()
+            renewer = threading.Thread(target=renew,
+                                       args=(lease_id, finished))
+            renewer.daemon = True
+            renewer.start()
+            try:
+                results = pool.map(worker, shard_tasks(shard, stage, data),
+                                   64)
+            finally:
+                finished.set()
+                renewer.join()
+            call('complete', lease_id, rank_results(results, keep))
+            completed += 1
+    except (EOFError, OSError):
+        # The coordinator went away
+        pass
+    finally:
+        pool.terminate()
+        conn.close()
+    return completed
@@ -0,0 +1,303 @@
+import os
+from functools import partial
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from multiprocessing.shared_memory import SharedMemory
+
+from locke.registry import load_transforms
+from locke.transforms.budget import BudgetRunner, is_truncated
+from locke.transforms.cascade import default_cascade
+from locke.transforms.differential import place_scored, score_families
+from locke.transforms.transformer import TransformChar, TransformString, \
+    _iteration_transformer, _merge_stage, _stage_tasks, _transform_data, \
+    rank_results, search_shards, select_transformers
+from locke.transforms.utils import DBFILE
+
+"""
+Cracking and searching buffers in memory, for programs embedding Locke.
+
+An Engine is set up once, with the transforms and patterns to use, and
+then called as many times as needed. Its pool is started on the first
+call and kept until the engine is closed. Nothing is printed or written
+to disk, and results are plain records rather than tuples.
+
+Unlike run_transformations(), whose pool workers are initialized with
+the one file they evaluate, the engine's workers outlive each buffer.
+On a process pool, crack() puts the buffer in shared memory for the
+length of the call instead, and each worker copies it out once, on the
+first task it's sent, rather than the buffer being sent along with each
+batch of tasks. Searches send each shard the slice of the buffer it
+covers.
+"""
+
+# The tuple(name, bytes) of the shared buffer a process worker read last
+_buffer = None
+
+
+class PatternHit(object):
+    """
+    The matches of a pattern.
+
+    Every hit has the following fields:
+    * description (str) - The pattern's description
+    * weight (int) - The pattern's weight
+    * matches (MatchList) - Where the pattern matched, and what
+    """
+    __slots__ = ('description', 'weight', 'matches')
+
+    def __init__(self, description, weight, matches):
+        self.description = description
+        self.weight = weight
+        self.matches = matches
+
+    def __repr__(self):
+        return '<PatternHit %s x%i>' % (self.description, len(self.matches))
+
+
+class CrackResult(object):
+    """
+    A transform that was found to decode the data.
+
+    Every result has the following fields:
+    * name (str) - The transform's name (e.g., "XOR 42")
+    * shortname (str) - The transform's short name, fit for file names
+    * score (int) - The score of the last stage
+    * hits (list) - The PatternHit of each pattern that matched the
+      decoded data in the last stage
+    * transform (BaseTransform) - The transform, to decode data with
+    * truncated (bool) - Whether the last stage ran over its time budget
+      scoring the transform, so the hits may be incomplete (see budget)
+    """
+    __slots__ = ('name', 'shortname', 'score', 'hits', 'transform',
+                 'truncated')
+
+    def __init__(self, transform, score, hits, truncated=False):
+        self.name = transform.name()
+        self.shortname = transform.shortname()
+        self.score = score
+        self.hits = hits
+        self.transform = transform
+        self.truncated = truncated
+
+    def decode(self, data):
+        """
+        Return:
+            The data, decoded with the result's transform
+        """
+        return self.transform.transform(data)
+
+    def __repr__(self):
+        return '<CrackResult %s (Score %i)>' % (self.name, self.score)
+
+
+def _hits(msgs):
+    return [PatternHit(desc, weight, matches)
+            for desc, weight, matches in msgs]
+
+
+def registered_transformers(level=1):
+    """
+    Return:
+        Every enabled transformer class of the given level and below
+    """
+    load_transforms(level)
+    return [trans for cls in (TransformChar, TransformString)
+            for trans in cls.__subclasses__()
+            if 0 < trans.class_level() <= level]
+
+
+def default_transformers(level=1):
+    """
+    Return:
+        The transformers crack runs at the given level: level 1 as the
+        distinct alphabets of the transforms database (see
+        TransformAllStage1), or as its classes if the database hasn't
+        been generated, and the classes of the levels above it
+    """
+    levels = ([], [], [])
+    for trans in registered_transformers(min(level, 3)):
+        levels[trans.class_level() - 1].append(trans)
+    if not os.path.exists(DBFILE):
+        return [trans for group in levels for trans in group]
+    return select_transformers(levels, level=min(level, 3))
+
+
+def _read_shared(name, size):
+    """
+    Return:
+        The bytestring in the named shared memory, copied out the first
+        time it's asked for, and kept until another one is
+    """
+    global _buffer
+    if _buffer is None or _buffer[0] != name:
+        memory = SharedMemory(name)
+        try:
+            _buffer = (name, bytes(memory.buf[:size]))
+        finally:
+            memory.close()
+    return _buffer[1]
+
+
+def _transform_shared(shared, transform_stage, details=True):
+    """
+    Process pool entry point of engines, scanning the buffer in shared
+    memory
+    Args:
+        shared: A tuple(name, size) of the shared memory holding the data
+        transform_stage: See _transform_data
+        details: Whether the matches are needed, or only the score
+    Return:
+        A tuple(transform_instance, score, msgs)
+    """
+    return _transform_data(_read_shared(*shared), transform_stage, details)
+
+
+class Engine(object):
+    """
+    Cracks and searches bytestrings, reusing one pool across calls.
+
+    An engine is used from one thread at a time. Close it (or use it as
+    a context manager) to stop its pool:
+
+        with Engine(level=2) as engine:
+            for result in engine.crack(data):
+                print(result.name, result.score)
+    """
+
+    def __init__(self, transforms=None, level=1, cascade=None, keep=20,
+                 save=10, patterns=None, backend='process',
+                 processes=None, budget=None):
+        """
+        Args:
+            transforms: A list of transformer classes (default = those
+                crack runs at the given level, see default_transformers)
+            level: The highest level of transformer used when none are
+                given (default = 1)
+            cascade: A list of the stages crack() runs (default = stage 1
+                and 2 patterns, see default_cascade)
+            keep: How many results stage 1 of the default cascade keeps
+                (default = 20)
+            save: How many results crack() returns (default = 10)
+            patterns: A list of pattern plugin classes search() looks
+                for (default = stage 2 patterns)
+            backend: Run on a 'process' (default) or 'thread' pool
+            processes: The size of the pool (default = one per CPU)
+            budget: How many seconds each transform may be scored for by
+                each stage of the default cascade (default = no limit).
+                The stages of a cascade given have their own budgets
+        """
+        if backend not in ('process', 'thread'):
+            raise ValueError('unknown pool backend "%s"' % backend)
+        self.transforms = list(transforms) if transforms is not None \
+            else default_transformers(level)
+        self.cascade = cascade if cascade is not None \
+            else default_cascade(keep, budget)
+        self.save = save
+        self.patterns = patterns
+        self.backend = backend
+        self.processes = processes
+        self._pool = None
+
+    def _new_pool(self):
+        cls = ThreadPool if self.backend == 'thread' else Pool
+        return cls(self.processes)
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = self._new_pool()
+        return self._pool
+
+    def crack(self, data):
+        """
+        Run the transforms on the data through each stage of the cascade
+        Args:
+            data: The bytestring to evaluate
+        Return:
+            A list of CrackResult, best first, up to "save" size
+        """
+        data = bytes(data)
+        if self.backend == 'thread':
+            return self._crack(data, partial(_transform_data, data))
+        memory = SharedMemory(create=True, size=max(len(data), 1))
+        try:
+            memory.buf[:len(data)] = data
+            return self._crack(data, partial(_transform_shared,
+                                             (memory.name, len(data))))
+        finally:
+            memory.close()
+            memory.unlink()
+
+    def _crack(self, data, worker):
+        pool = self._get_pool()
+        runner = None
+        if self.backend == 'process' or \
+                any(stage.budget is not None for stage in self.cascade):
+            # Tasks running over budget (or whose worker died) are given
+            # up on by replacing the pool
+            runner = BudgetRunner(self._new_pool, pool, self.processes)
+        results = []
+        for number, stage in enumerate(self.cascade, 1):
+            last = number == len(self.cascade)
+            details = last if stage.details is None else stage.details
+            scored = {}
+            if number == 1:
+                # XOR and ADD keys are scored a family at a time
+                tasks, scored = score_families(_iteration_transformer(
+                    [(trans, stage) for trans in self.transforms], data),
+                    data, details)
+                chunksize = None
+                shards = 1
+            else:
+                tasks, shards = _stage_tasks(
+                    [result[0] for result in results], stage, len(data),
+                    self.processes)
+                chunksize = 1
+            if runner is not None:
+                results = runner.run(partial(worker, details=details), tasks)
+                # The pool is replaced if a task ran over budget
+                self._pool = runner.pool
+            else:
+                results = pool.map(partial(worker, details=details), tasks,
+                                   chunksize)
+            results = rank_results(_merge_stage(
+                place_scored(results, scored), stage, shards, details),
+                stage.keep)
+        return [CrackResult(result[0], result[1], _hits(result[2]),
+                            is_truncated(result))
+                for result in results[:self.save]]
+
+    def search(self, data):
+        """
+        Search the data for patterns, without transforming it
+        Args:
+            data: The bytestring to search
+        Return:
+            A list of PatternHit for each pattern that matched
+        """
+        msgs = search_shards(bytes(data), self._get_pool(),
+                             patterns=self.patterns, workers=self.processes)
+        return _hits(msgs)
+
+    def close(self):
+        """
+        Stop the pool, waiting for its workers to exit. The engine starts
+        a new pool if called again
+        """
+        if self._pool is not None:
+            pool, self._pool = self._pool, None
+            pool.close()
+            pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is not None and self._pool is not None:
+            # Don't wait on tasks left over from a failed call
+            self._pool.terminate()
+            self._pool = None
+        self.close()
+
+    def __del__(self):
+        if self._pool is not None:
+            self._pool.terminate()
@@ -0,0 +1,133 @@
+import json
+import sys
+import time
+
+"""
+Progress events emitted while run_transformations() works through a stage.
+
+Anything callable with a ProgressEvent can listen. TerminalProgress renders
+them as a status line, and JSONEventWriter writes them as JSON lines for
+other programs to follow.
+"""
+
+
+class ProgressEvent(object):
+    """
+    A snapshot of how a stage is going.
+
+    Every event has the following fields:
+    * kind (str) - 'start', 'progress' or 'end'
+    * stage (int) - The stage number
+    * done (int) - How many tasks of the stage have completed
+    * total (int) - How many tasks the stage has
+    * elapsed (float) - Seconds since the stage started
+    * rate (float) - Transforms per second
+    * byte_rate (float) - Bytes of input transformed per second
+    * eta (float) - Estimated seconds left (None until known)
+    * best (int) - The best score so far (None until known)
+    """
+    __slots__ = ('kind', 'stage', 'done', 'total', 'elapsed', 'rate',
+                 'byte_rate', 'eta', 'best')
+
+    def __init__(self, kind, stage, done, total, elapsed, rate, byte_rate,
+                 eta, best):
+        self.kind = kind
+        self.stage = stage
+        self.done = done
+        self.total = total
+        self.elapsed = elapsed
+        self.rate = rate
+        self.byte_rate = byte_rate
+        self.eta = eta
+        self.best = best
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+
+class ProgressTracker(object):
+    """
+    Follows the results of one stage as they come in, emitting
+    ProgressEvents to the listeners. Progress events are emitted at most
+    once per interval (in seconds), while start and end events always are.
+    """
+
+    def __init__(self, stage, total, size, listeners, interval=0.5):
+        self.stage = stage
+        self.total = total
+        self.size = size
+        self.listeners = listeners
+        self.interval = interval
+        self.done = 0
+        self.best = None
+        self.started = time.time()
+        self.emitted = self.started
+        self.emit('start')
+
+    def emit(self, kind):
+        now = time.time()
+        self.emitted = now
+        elapsed = now - self.started
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        eta = (self.total - self.done) / rate if rate else None
+        event = ProgressEvent(kind, self.stage, self.done, self.total,
+                              elapsed, rate, rate * self.size, eta, self.best)
+        for listener in self.listeners:
+            listener(event)
+
+    def update(self, result):
+        """
+        Count a tuple(trans_instance, score, msgs) as done
+        """
+        self.done += 1
+        if self.best is None or result[1] > self.best:
+            self.best = result[1]
+        if time.time() - self.emitted >= self.interval:
+            self.emit('progress')
+
+    def finish(self):
+        self.emit('end')
+
+
+def _human(value, unit):
+    for prefix in ('', 'K', 'M', 'G'):
+        if value < 1000:
+            break
+        value /= 1000.0
+    return '%.1f%s%s' % (value, prefix, unit)
+
+
+class TerminalProgress(object):
+    """
+    Renders progress events as a single status line that is
+    rewritten in place.
+    """
+
+    def __init__(self, stream=sys.stderr):
+        self.stream = stream
+
+    def __call__(self, event):
+        percent = 100.0 * event.done / event.total if event.total else 100.0
+        eta = '--:--' if event.eta is None else \
+            '%02d:%02d' % divmod(int(event.eta), 60)
+        line = 'Stage %i: %i/%i (%5.1f%%) %s %s ETA %s best %s' % (
+            event.stage, event.done, event.total, percent,
+            _human(event.rate, ' t/s'), _human(event.byte_rate, 'B/s'), eta,
+            '-' if event.best is None else event.best)
+        self.stream.write('\r' + line.ljust(79))
+        if event.kind == 'end':
+            self.stream.write('\n')
+        self.stream.flush()
+
+
+class JSONEventWriter(object):
+    """
+    Writes each progress event to a stream as one line of JSON.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def __call__(self, event):
+        self.stream.write(json.dumps(event.as_dict()) + '\n')
+        self.stream.flush()
@@ -0,0 +1,167 @@
+import math
+import string
+from collections import Counter
+
+"""
+Finding repeating XOR keys from the statistics of the data, rather than
+trying every key.
+
+The key length is estimated with the index of coincidence: split into
+columns by the right length (or a multiple of it), each column is XORed
+with a single key byte, so its bytes repeat as often as the plaintext's
+do. Each column is then solved on its own, as single byte XOR, by
+finding the key byte that makes it look the most like plaintext. All of
+this is O(N x key lengths tried), where brute force would be 256^length.
+"""
+
+# Only this much of the data is looked at
+SAMPLE_SIZE = 1 << 16
+# The longest key looked for
+MAX_KEY_LENGTH = 32
+# How many key lengths are solved for
+KEY_LENGTHS = 3
+# How close (as a ratio) to the best length's index of coincidence
+# another length must be to be solved for as well
+LENGTH_RATIO = 0.9
+# The fewest bytes a column needs for its statistics to mean anything
+MIN_COLUMN = 16
+
+# Relative frequencies of English letters, in percent
+_LETTERS = {
+    'e': 12.7, 't': 9.1, 'a': 8.2, 'o': 7.5, 'i': 7.0, 'n': 6.7, 's': 6.3,
+    'h': 6.1, 'r': 6.0, 'd': 4.3, 'l': 4.0, 'c': 2.8, 'u': 2.8, 'm': 2.4,
+    'w': 2.4, 'f': 2.2, 'g': 2.0, 'y': 2.0, 'p': 1.9, 'b': 1.5, 'v': 1.0,
+    'k': 0.8, 'j': 0.15, 'x': 0.15, 'q': 0.1, 'z': 0.07,
+}
+
+
+def _profile(weights, floor):
+    """
+    Turn weights for some bytes into the log probabilities of every byte
+    """
+    table = [floor] * 256
+    for byte, weight in weights.items():
+        table[byte] = weight
+    total = sum(table)
+    return [math.log(weight / total) for weight in table]
+
+
+def _text_weights():
+    weights = {ord(c): f for c, f in _LETTERS.items()}
+    weights.update({ord(c.upper()): f * 0.1 for c, f in _LETTERS.items()})
+    weights.update({ord(c): 0.5 for c in string.digits})
+    weights.update({ord(c): 0.3 for c in string.punctuation})
+    weights.update({ord(c): 1.5 for c in '.,\r\n'})
+    weights[ord(' ')] = 18.0
+    return weights
+
+
+def _binary_weights():
+    weights = {byte: weight * 0.2 for byte, weight in _text_weights().items()}
+    weights[0x00] = 40.0
+    weights[0xFF] = 3.0
+    return weights
+
+
+# Log probabilities of each byte in text, and in binaries (e.g., a PE
+# file), which are mostly zeros with some text
+PROFILES = (_profile(_text_weights(), 0.01), _profile(_binary_weights(), 0.1))
+
+
+def coincidence(column):
+    """
+    Return:
+        The index of coincidence of a bytestring: the chance of two of
+        its bytes picked at random being the same
+    """
+    size = len(column)
+    if size < 2:
+        return 0.0
+    pairs = sum(count * (count - 1) for count in Counter(column).values())
+    return pairs / (size * (size - 1))
+
+
+def key_lengths(data, max_length=MAX_KEY_LENGTH):
+    """
+    Estimate the length of a repeating XOR key
+    Args:
+        data: The bytestring to look at
+        max_length: The longest key length to try
+    Return:
+        A list of up to KEY_LENGTHS likely key lengths (over 1), most
+        likely first
+    """
+    max_length = min(max_length, len(data) // MIN_COLUMN)
+    scores = {}
+    for length in range(2, max_length + 1):
+        scores[length] = sum(coincidence(data[i::length])
+                             for i in range(length)) / length
+    if not scores:
+        return []
+
+    best = max(scores.values())
+    lengths = []
+    # Multiples of the key length score as well as it, so the shortest
+    # of the lengths scoring close to the best are taken
+    for length in sorted(scores):
+        if scores[length] < best * LENGTH_RATIO:
+            continue
+        if any(length % found == 0 for found in lengths):
+            continue
+        lengths.append(length)
+    lengths.sort(key=lambda length: scores[length], reverse=True)
+    return lengths[:KEY_LENGTHS]
+
+
+def solve_column(column, profile):
+    """
+    Find the single byte XOR key making a column look the most like
+    the plaintext profile
+    Args:
+        column: The bytestring of every key length-th byte
+        profile: A list of the log probability of each plaintext byte
+    Return:
+        The key byte
+    """
+    counts = Counter(column).most_common()
+    common = sorted(range(256), key=profile.__getitem__, reverse=True)[:4]
+    # The key byte almost always maps one of the most common bytes of
+    # the column onto one of the most common bytes of plaintext
+    candidates = {byte ^ plain for byte, _ in counts[:4] for plain in common}
+    return max(sorted(candidates),
+               key=lambda key: sum(count * profile[byte ^ key]
+                                   for byte, count in counts))
+
+
+def _period(key):
+    """
+    Return:
+        The shortest key that repeats to key
+    """
+    for length in range(1, len(key)):
+        if len(key) % length == 0 and \
+                key[:length] * (len(key) // length) == key:
+            return key[:length]
+    return key
+
+
+def solve_keys(data, max_length=MAX_KEY_LENGTH):
+    """
+    Find the repeating XOR keys the data is most likely encoded with
+    Args:
+        data: The bytestring to look at
+        max_length: The longest key length to try
+    Return:
+        A list of keys (bytestrings of 2 bytes or more), most likely first
+    """
+    sample = data[:SAMPLE_SIZE]
+    keys = []
+    for length in key_lengths(sample, max_length):
+        columns = [sample[i::length] for i in range(length)]
+        for profile in PROFILES:
+            key = _period(bytes(solve_column(column, profile)
+                                for column in columns))
+            # Single byte keys are left to TransformXOR
+            if len(key) > 1 and key not in keys:
+                keys.append(key)
+    return keys
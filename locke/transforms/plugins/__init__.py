@@ -1,2 +1 @@
-from locke.transforms.plugins import level1_transformers, \
-    level2_transformers, level3_transformers
+# Plugin modules are imported when needed, see locke.registry
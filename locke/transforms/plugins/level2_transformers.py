@@ -1,4 +1,6 @@
-from ..transformer import TransformString
+from ..keysolver import solve_keys
+from ..transformer import TransformString, add_table, xor_chained, \
+    xor_table
 
 """
 These are all Level 2 Transformers
@@ -9,6 +11,7 @@ String Transformers
     TransformSubInc
     TransformXORLChained
     TransformXORRChained
+    TransformXORKey
 """
 
 
@@ -32,12 +35,11 @@ class TransformXORInc(TransformString):
 
     def transform_string(self, data, encode=False):
         # TODO: encode
-        result = bytearray()
-        append = result.append
-        for i in range(0, len(data)):
-            xor_key = (self.value + i) & 0xFF
-            append(data[i] ^ xor_key)
-        return bytes(result)
+        return bytes(self.transform_into(data, bytearray(len(data))))
+
+    def key_tables(self):
+        # The key cycles after 256 bytes
+        return [xor_table((self.value + i) & 0xFF) for i in range(0x100)]
 
     @staticmethod
     def all_iteration():
@@ -64,12 +66,11 @@ class TransformXORDec(TransformString):
 
     def transform_string(self, data, encode=False):
         # TODO: encode
-        result = bytearray()
-        append = result.append
-        for i in range(0, len(data)):
-            xor_key = (self.value + 0xFF - i) & 0xFF
-            append(data[i] ^ xor_key)
-        return bytes(result)
+        return bytes(self.transform_into(data, bytearray(len(data))))
+
+    def key_tables(self):
+        return [xor_table((self.value + 0xFF - i) & 0xFF)
+                for i in range(0x100)]
 
     @staticmethod
     def all_iteration():
@@ -96,12 +97,10 @@ class TransformSubInc(TransformString):
 
     def transform_string(self, data):
         # TODO: encode
-        result = bytearray()
-        append = result.append
-        for i in range(0, len(data)):
-            key = (self.value + i) & 0xFF
-            append((data[i] - key) & 0xFF)
-        return bytes(result)
+        return bytes(self.transform_into(data, bytearray(len(data))))
+
+    def key_tables(self):
+        return [add_table(-(self.value + i) & 0xFF) for i in range(0x100)]
 
     @staticmethod
     def all_iteration():
@@ -128,12 +127,10 @@ class TransformXORLChained(TransformString):
 
     def transform_string(self, data, encode=False):
         # TODO: encode
-        result = bytearray()
-        append = result.append
-        append(data[0] ^ self.value)
-        for i in range(1, len(data)):
-            append(data[i] ^ self.value ^ data[i - 1])
-        return bytes(result)
+        return bytes(self.transform_into(data, bytearray(len(data))))
+
+    def transform_into(self, data, out):
+        return xor_chained(data, out, self.value, -1)
 
     @staticmethod
     def all_iteration():
@@ -160,13 +157,45 @@ class TransformXORRChained(TransformString):
 
     def transform_string(self, data, encode=False):
         # TODO: encode
-        result = bytearray()
-        append = result.append
-        for i in range(0, len(data) - 1):
-            append(data[i] ^ self.value ^ data[i + 1])
-        append(data[-1] ^ self.value)
-        return bytes(result)
+        return bytes(self.transform_into(data, bytearray(len(data))))
+
+    def transform_into(self, data, out):
+        return xor_chained(data, out, self.value, 1)
 
     @staticmethod
     def all_iteration():
         return range(0, 0x100)
+
+
+class TransformXORKey(TransformString):
+    """
+    Name: TransformXORKey
+    Description: XOR with a repeating multi-byte key
+    """
+    description = 'XOR with a repeating multi-byte key'
+    params = 'A: keys solved for from the data'
+
+    @staticmethod
+    def class_level():
+        return 2
+
+    def name(self):
+        return "XOR Key %s" % self.value.hex().upper()
+
+    def shortname(self):
+        return "xorkey%s" % self.value.hex()
+
+    def transform_string(self, data, encode=False):
+        size = len(data)
+        stream = (self.value * (size // len(self.value) + 1))[:size]
+        return (int.from_bytes(data, 'big') ^
+                int.from_bytes(stream, 'big')).to_bytes(size, 'big')
+
+    @classmethod
+    def iterations(cls, data):
+        return solve_keys(data)
+
+    @staticmethod
+    def all_iteration():
+        # The keys can only be found from the data
+        return iter(())
@@ -1,4 +1,5 @@
-from ..transformer import rol, TransformString
+from ..transformer import TransformString, rol_table, xor_chained, \
+    xor_table
 
 """
 These are all Level 3 Transformers
@@ -28,13 +29,13 @@ class TransformXORInc_ROL(TransformString):
 
     def transform_string(self, data, encode=False):
         # TODO: encode
+        return bytes(self.transform_into(data, bytearray(len(data))))
+
+    def key_tables(self):
         xor_key, roll = self.value
-        result = bytearray()
-        append = result.append
-        for i in range(0, len(data)):
-            key = (xor_key + i) & 0xFF
-            append(rol(data[i] ^ key, roll))
-        return bytes(result)
+        rotate = rol_table(roll)
+        return [xor_table((xor_key + i) & 0xFF).translate(rotate)
+                for i in range(0x100)]
 
     @staticmethod
     def all_iteration():
@@ -63,11 +64,14 @@ class TransformXORRChainedAll(TransformString):
 
     def transform_string(self, data, encode=False):
         # TODO: encode
-        result = bytearray(len(data))
-        for i in range(len(data) - 1, 1, -1):
-            result[i - 1] = data[i - 1] ^ self.value ^ data[i]
-        result[-1] = data[-1] ^ self.value
-        return bytes(result)
+        return bytes(self.transform_into(data, bytearray(len(data))))
+
+    def transform_into(self, data, out):
+        xor_chained(data, out, self.value, 1)
+        # The first byte has always been left as 0
+        if len(out) > 1:
+            out[0] = 0
+        return out
 
     @staticmethod
     def all_iteration():
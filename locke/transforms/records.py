@@ -0,0 +1,126 @@
+import json
+
+from locke.transforms.budget import is_truncated
+
+"""
+Results written as newline delimited JSON (NDJSON), for other programs to
+index rather than parse terminal text.
+
+Each record is a JSON object on its own line, with a "type" field:
+* match - A match of a pattern, in a file or in a decoded file
+* transform - A transform ranked by crack, with a count per pattern
+  (and "truncated": true if it ran over its time budget, see budget)
+* segment - A segment of the file a transform won (see segments)
+
+Records are buffered and written out as soon as the buffer fills, and
+the commands flush them once each file is done. Writes block while the
+reader falls behind (e.g., a full pipe), which holds up whatever produces
+the records, so they never pile up in memory.
+"""
+
+# How many bytes of records are buffered before being written out
+BUFFER_SIZE = 1 << 16
+
+
+class RecordWriter(object):
+    """
+    Writes records to a text stream as NDJSON, buffered.
+    """
+
+    def __init__(self, stream, buffer_size=BUFFER_SIZE):
+        self.stream = stream
+        self.buffer_size = buffer_size
+        self._lines = []
+        self._size = 0
+
+    def write(self, record):
+        """
+        Add a record (a dict) to the buffer, writing the buffer out
+        once it's full
+        """
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        self._lines.append(line)
+        self._size += len(line)
+        if self._size >= self.buffer_size:
+            self.flush()
+
+    def write_all(self, records):
+        for record in records:
+            self.write(record)
+
+    def flush(self):
+        if self._lines:
+            self.stream.write(''.join(self._lines))
+            self._lines = []
+            self._size = 0
+        self.stream.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+
+def match_records(filename, msgs, transform=None):
+    """
+    Generate a record for each match
+    Args:
+        filename: The name of the file searched
+        msgs: A list of [description, weight, MatchList]
+        transform: The name of the transform the file was decoded
+            with, if any (default = None)
+    Return:
+        Generates dict
+    """
+    for desc, weight, matches in msgs:
+        for offset, data in matches.items():
+            record = {'type': 'match', 'file': filename}
+            if transform is not None:
+                record['transform'] = transform
+            record.update({'offset': offset, 'pattern': desc,
+                           'weight': weight, 'length': len(data),
+                           'data': data.hex()})
+            yield record
+
+
+def transform_records(filename, results, matches=False):
+    """
+    Generate a record for each ranked transform
+    Args:
+        filename: The name of the file cracked
+        results: A sorted list of tuple(trans_instance, score, msgs)
+        matches: Whether to follow each transform's record with the
+            records of its matches (default = False)
+    Return:
+        Generates dict
+    """
+    for rank, result in enumerate(results):
+        trans, score, msgs = result
+        record = {'type': 'transform', 'file': filename, 'rank': rank,
+                  'name': trans.name(), 'shortname': trans.shortname(),
+                  'score': score,
+                  'patterns': [{'pattern': desc, 'weight': weight,
+                                'count': len(hits)}
+                               for desc, weight, hits in msgs]}
+        if is_truncated(result):
+            record['truncated'] = True
+        yield record
+        if matches:
+            yield from match_records(filename, msgs, trans.name())
+
+
+def segment_records(filename, segments):
+    """
+    Generate a record for each segment a transform won
+    Args:
+        filename: The name of the file cracked
+        segments: A list of tuple(start, stop, trans_instance, score)
+    Return:
+        Generates dict
+    """
+    for start, stop, trans, score in segments:
+        if trans is not None:
+            yield {'type': 'segment', 'file': filename, 'start': start,
+                   'stop': stop, 'name': trans.name(),
+                   'shortname': trans.shortname(), 'score': score}
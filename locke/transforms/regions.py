@@ -0,0 +1,171 @@
+import csv
+import math
+from array import array
+from bisect import bisect_right
+from collections import Counter
+
+"""
+Finding the regions of a file worth cracking.
+
+Encoded payloads usually sit inside a larger container, and most of a
+container is either compressed (or encrypted) data, which no transform
+in Locke decodes, or zero padding. The file is split into blocks, the
+byte distribution of each is measured once, and runs of blocks that are
+neither are the regions cracked.
+"""
+
+# The size of the blocks the file is measured in
+BLOCK_SIZE = 1024
+# Blocks with more bits of entropy per byte than this are taken to be
+# compressed or encrypted. XOR and other substitutions keep the entropy
+# of what they encode, which is well under this for code and text
+RANDOM_ENTROPY = 7.2
+# Candidate blocks at most this many blocks apart are merged
+MERGE_GAP = 1
+# If the regions cover more than this share of the file, all of it
+# is cracked
+MAX_COVERAGE = 0.9
+
+_PRINTABLE = bytes(range(0x20, 0x7F)) + b'\t\r\n'
+
+
+class BlockStats(object):
+    """
+    The byte distribution of a block of the file.
+
+    Every block has the following fields:
+    * offset (int) - Where the block starts in the file
+    * length (int) - The size of the block
+    * entropy (float) - Bits of entropy per byte
+    * printable (float) - The share of printable ASCII bytes
+    * zeros (float) - The share of zero bytes
+    * candidate (bool) - Whether the block may hold encoded data
+    """
+    __slots__ = ('offset', 'length', 'entropy', 'printable', 'zeros',
+                 'candidate')
+
+    def __init__(self, offset, block):
+        self.offset = offset
+        self.length = len(block)
+        counts = Counter(block).values()
+        self.entropy = sum(count / self.length *
+                           math.log2(self.length / count)
+                           for count in counts)
+        self.printable = 1 - len(block.translate(None, _PRINTABLE)) / \
+            self.length
+        self.zeros = block.count(0) / self.length
+        # A short block (e.g., the last one) can't reach 8 bits
+        # of entropy, however random it is
+        bound = min(8.0, math.log2(self.length))
+        self.candidate = self.entropy < RANDOM_ENTROPY * bound / 8 and \
+            self.zeros < 1
+
+
+def entropy_map(data, block_size=BLOCK_SIZE):
+    """
+    Measure the byte distribution of each block of the data
+    Args:
+        data: The bytestring to measure
+        block_size: The size of the blocks (default = BLOCK_SIZE)
+    Return:
+        A list of BlockStats
+    """
+    return [BlockStats(offset, data[offset:offset + block_size])
+            for offset in range(0, len(data), block_size)]
+
+
+def find_regions(blocks):
+    """
+    Merge runs of candidate blocks into regions
+    Args:
+        blocks: A list of BlockStats (see entropy_map)
+    Return:
+        A list of tuple(start, stop) offsets
+    """
+    regions = []
+    gap = 0
+    for block in blocks:
+        if not block.candidate:
+            gap += 1
+            continue
+        stop = block.offset + block.length
+        if regions and gap <= MERGE_GAP:
+            regions[-1] = (regions[-1][0], stop)
+        else:
+            regions.append((block.offset, stop))
+        gap = 0
+    return regions
+
+
+def write_entropy_map(blocks, stream):
+    """
+    Write the entropy map as CSV, for analysts to look at
+    Args:
+        blocks: A list of BlockStats (see entropy_map)
+        stream: The text file to write to
+    """
+    writer = csv.writer(stream)
+    writer.writerow(['Offset', 'Length', 'Entropy', 'Printable', 'Zeros',
+                     'Candidate'])
+    for block in blocks:
+        writer.writerow(['0x%08X' % block.offset, block.length,
+                         '%.3f' % block.entropy, '%.3f' % block.printable,
+                         '%.3f' % block.zeros, int(block.candidate)])
+
+
+class RegionMap(object):
+    """
+    The regions of a file being cracked, joined together into the data
+    the transforms run on, along with the way back from offsets in that
+    data to offsets in the file.
+    """
+
+    def __init__(self, data, regions):
+        self.regions = regions
+        self.data = b''.join(data[start:stop] for start, stop in regions)
+        # Where each region starts in the joined data
+        self.starts = []
+        pos = 0
+        for start, stop in regions:
+            self.starts.append(pos)
+            pos += stop - start
+
+    @classmethod
+    def locate(cls, data, blocks=None):
+        """
+        Find the regions of the data worth cracking
+        Args:
+            data: The bytestring of the whole file
+            blocks: The entropy map of the data, if already measured
+        Return:
+            A RegionMap, covering the whole data if no regions stand out
+        """
+        if blocks is None:
+            blocks = entropy_map(data)
+        regions = find_regions(blocks)
+        covered = sum(stop - start for start, stop in regions)
+        if not regions or covered > len(data) * MAX_COVERAGE:
+            regions = [(0, len(data))]
+        return cls(data, regions)
+
+    def to_file(self, offset):
+        """
+        Translate an offset in the joined data into the file
+        """
+        i = bisect_right(self.starts, offset) - 1
+        return self.regions[i][0] + offset - self.starts[i]
+
+    def remap(self, results):
+        """
+        Translate the offsets of the matches of results into the file,
+        in place
+        Args:
+            results: A list of tuple(trans_instance, score, msgs)
+        """
+        if self.regions == [(0, len(self.data))]:
+            return
+        for _, _, msgs in results:
+            for msg in msgs:
+                matches = msg[2]
+                matches.offsets = array('q', map(self.to_file,
+                                                 matches.offsets))
@@ -0,0 +1,168 @@
+import os
+from functools import partial
+
+from locke.transforms import transformer as _transformer
+from locke.transforms.cascade import PatternStage
+from locke.transforms.events import ProgressTracker
+from locke.transforms.regions import entropy_map
+from locke.transforms.transformer import _chunksize, \
+    _iteration_transformer, _make_pool
+
+"""
+Finding the best transform for each block of the data, for files holding
+several payloads encoded differently.
+
+Each transform is still only run over the data once: its matches are
+credited to the blocks they're found in, and each block keeps the best
+transform seen so far. Neighbouring blocks won by the same transform are
+then merged into segments.
+"""
+
+# The size of fixed blocks
+BLOCK_SIZE = 4096
+
+
+def fixed_bounds(size, block_size=BLOCK_SIZE):
+    """
+    Return:
+        The offsets of blocks of block_size bytes covering size bytes
+    """
+    if block_size < 1:
+        raise ValueError('blocks must be at least a byte')
+    return list(range(0, max(size, 1), block_size))
+
+
+def adaptive_bounds(data):
+    """
+    Split the data where its entropy map (see regions.entropy_map)
+    changes from looking encoded to not, or back
+    Return:
+        The offsets each block starts at
+    """
+    bounds = []
+    previous = None
+    for block in entropy_map(data):
+        if block.candidate != previous:
+            bounds.append(block.offset)
+            previous = block.candidate
+    return bounds or [0]
+
+
+def _score_blocks(bounds, transform_stage, data=None):
+    """
+        Pool entry point, scoring each block of the transformed data
+
+        Args:
+            bounds: The offsets each block starts at
+            transform_stage: A tuple(transformer, stage)
+            data: The bytestring to transform (default = the data the
+                process pool worker was initialized with)
+        Return:
+            A tuple(transform_instance, {block_index: score})
+        """
+    transformer, stage = transform_stage
+    if data is None:
+        data = _transformer.worker_data
+    return transformer, stage.block_scores(transformer, data, bounds)
+
+
+def best_per_block(trans_list, data, bounds, stage=None, backend='process',
+                   progress=None):
+    """
+    Find the best transform of each block in one pass over the keyspace
+    Args:
+        trans_list: A list of transformer classes
+        data: The bytestring to evaluate
+        bounds: The offsets each block starts at (see fixed_bounds and
+            adaptive_bounds)
+        stage: The Stage scoring the blocks (default = stage 1 patterns)
+        backend: Run on a 'process' (default) or 'thread' pool
+        progress: A list of callables to send ProgressEvents to
+    Return:
+        A list of tuple(trans_instance, score) for each block, where
+        trans_instance is None for blocks no transform scored on
+    """
+    stage = PatternStage(1) if stage is None else stage
+    if not stage.blockwise:
+        raise ValueError('%s can not score blocks on their own'
+                         % type(stage).__name__)
+    pool, _ = _make_pool(data, backend)
+    if backend == 'thread':
+        worker = partial(_score_blocks, bounds, data=data)
+    else:
+        worker = partial(_score_blocks, bounds)
+
+    tasks = list(_iteration_transformer(
+        [(trans, stage) for trans in trans_list], data))
+    tracker = ProgressTracker(1, len(tasks), len(data), progress) \
+        if progress else None
+    best = [(None, 0)] * len(bounds)
+    try:
+        for trans, scores in pool.imap(worker, tasks,
+                                       _chunksize(len(tasks))):
+            for block, score in scores.items():
+                # Ties go to the transform tried first
+                if score > best[block][1]:
+                    best[block] = (trans, score)
+            if tracker:
+                tracker.update((trans, max(scores.values(), default=0)))
+    finally:
+        pool.terminate()
+    if tracker:
+        tracker.finish()
+    return best
+
+
+def merge_blocks(best, bounds, size):
+    """
+    Merge neighbouring blocks won by the same transform
+    Args:
+        best: The best transform of each block (see best_per_block)
+        bounds: The offsets each block starts at
+        size: The size of the data
+    Return:
+        A list of tuple(start, stop, trans_instance, score), where score
+        is the total over the merged blocks
+    """
+    segments = []
+    for block, (trans, score) in enumerate(best):
+        stop = bounds[block + 1] if block + 1 < len(bounds) else size
+        if segments and _same(segments[-1][2], trans):
+            start, _, _, total = segments[-1]
+            segments[-1] = (start, stop, segments[-1][2], total + score)
+        else:
+            segments.append((bounds[block], stop, trans, score))
+    return segments
+
+
+def _same(first, second):
+    if first is None or second is None:
+        return first is second
+    return type(first) is type(second) and first.name() == second.name()
+
+
+def print_segments(segments):
+    for start, stop, trans, score in segments:
+        name = '-' if trans is None else trans.name()
+        print('%08X-%08X: %s (Score %i)' % (start, stop, name, score))
+
+
+def write_segments(segments, output, filename, data):
+    """
+    Write each segment a transform won to disk, transformed
+    Args:
+        segments: A list of tuple(start, stop, trans_instance, score)
+        output: Output directory to write the transformed files
+        filename: The file name of the original file
+        data: The bytestring that was evaluated
+    """
+    print("Writing segments to disk")
+    base, ext = os.path.splitext(os.path.basename(filename))
+    for start, stop, trans, score in segments:
+        if trans is None:
+            continue
+        t_name = "%s_%08X_%s%s" % (base, start, trans.shortname(), ext)
+        with open(os.path.join(output, t_name), "wb") as out:
+            # Transforms may depend on the position in the data
+            out.write(trans.transform(data)[start:stop])
+        print("Wrote %s to file %s" % (trans.name(), t_name))
@@ -0,0 +1,187 @@
+import os
+from array import array
+
+from locke.patterns import Manager
+from locke.patterns.pattern_plugin import BytesListPatternPlugin, \
+    REPatternPlugin
+from locke.patterns.utils import MatchList, narrow, pack_matches
+
+"""
+Scanning one buffer for patterns in shards, so the scan of a single
+transform (or a search) is spread over every worker of a pool rather
+than holding up one while the others idle.
+
+Each shard owns the matches starting between its start and its stop,
+but is scanned a little further (up to its end, OVERLAP bytes on), so
+matches crossing into the next shard are found whole. The shards' matches
+are then merged: a match of the next shard starting inside a match that
+crossed into it is dropped, as a scan of the whole buffer wouldn't have
+found it (only matches that don't overlap are found). Unless the match
+crossing ran up to its shard's end and the pattern is a regular
+expression: the match was then cut short, and the rest of it found by
+the next shard is joined on. The literals of a list are each matched on
+their own, so only matches of the same literal are dropped.
+
+Merged, the matches are those of a scan of the whole buffer, but for
+matches running more than OVERLAP bytes into the next shard. Those are
+only whole if the pattern matched up to the shard's end, and picks up
+again from where the next shard starts (e.g., not a sentence cut in the
+middle of a very long word). A pattern matching several literals lists
+its matches shard by shard rather than literal by literal.
+"""
+
+# Shards are at least this big, so each is worth a task
+MIN_SHARD_SIZE = 1 << 18
+# How far past its stop each shard is scanned
+OVERLAP = 1 << 12
+
+
+def shard_count(size, tasks=1, workers=None):
+    """
+    Args:
+        size: The size of the buffer scanned
+        tasks: How many scans of it there are (e.g., one per transform)
+        workers: How many workers share the scans (default = one per CPU)
+    Return:
+        How many shards to split each scan into, so there are at least as
+        many tasks as workers (1 if the buffer is too small to split)
+    """
+    workers = workers or os.cpu_count() or 1
+    wanted = -(-workers // max(tasks, 1))
+    return max(1, min(wanted, size // MIN_SHARD_SIZE))
+
+
+def shard_bounds(size, count, overlap=OVERLAP):
+    """
+    Args:
+        size: The size of the buffer scanned
+        count: How many shards to split it into
+        overlap: How far past its stop each shard is scanned
+    Return:
+        A list of tuple(start, stop, end) for each shard, in order
+    """
+    step = max(1, -(-size // count))
+    return [(start, min(start + step, size),
+             min(start + step + overlap, size))
+            for start in range(0, size, step)]
+
+
+def scan_shard(data, bounds, patterns, deadline=None):
+    """
+    Scan a shard for patterns
+    Args:
+        data: The bytestring of the shard, from its start to its end
+        bounds: The shard's tuple(start, stop, end)
+        patterns: The PatternSet to scan for
+        deadline: The time.monotonic() time after which no more patterns
+            are scanned (default = None, see Manager.run)
+    Return:
+        A list of a packed MatchList for each pattern of the set scanned
+        (empty if it didn't match), holding the matches the shard owns at
+        their offsets in the whole buffer
+    """
+    start, stop, _ = bounds
+    found = []
+    mgr = Manager(raw=data, patterns=patterns)
+    for _, matches in mgr.run(deadline):
+        found.append(_owned(pack_matches(matches), start, stop))
+    return found
+
+
+def _owned(matches, start, stop):
+    """
+    Return:
+        The matches starting before the shard's stop, moved to their
+        offsets in the whole buffer
+    """
+    owned = MatchList(matches.source, starts=array('q'))
+    for i, offset in enumerate(matches.offsets):
+        if offset + start < stop:
+            owned.append(offset + start, matches.lengths[i])
+            owned.starts.append(matches.starts[i])
+    return owned
+
+
+def merge_shards(parts, bounds, pats):
+    """
+    Merge the matches of the shards of a buffer
+    Args:
+        parts: The list scan_shard returned for each shard, in order
+        bounds: The tuple(start, stop, end) of each shard
+        pats: The pattern instances of the set scanned
+    Return:
+        A list of a packed MatchList for each pattern
+    """
+    return [_merge_pattern([part[i] for part in parts], bounds,
+                           isinstance(pat, REPatternPlugin),
+                           isinstance(pat, BytesListPatternPlugin))
+            for i, pat in enumerate(pats)]
+
+
+def _merge_pattern(lists, bounds, joins=True, literals=False):
+    """
+    Args:
+        lists: The MatchList of the pattern for each shard
+        bounds: The tuple(start, stop, end) of each shard
+        joins: Whether a match cut short by its shard's end is joined to
+            the rest of it the next shard found (only for a regular
+            expression; a literal is never found cut)
+        literals: Whether the pattern's literals are each matched on
+            their own, so the matches of different literals may overlap
+    Return:
+        A packed MatchList
+    """
+    offsets, lengths, chunks = array('q'), array('q'), []
+    # The furthest match crossing into the shard of each literal (or of
+    # the whole pattern): tuple(how far it reaches, its index, whether
+    # its shard's end cut it short)
+    crossing = {}
+    for matches, (_, stop, end) in zip(lists, bounds):
+        next_crossing = {}
+        for offset, data in matches.items():
+            match_end = offset + len(data)
+            # Wide copies of a literal are matched along with it
+            literal = narrow(bytes(data)) if literals else None
+            reach, index, cut = crossing.get(literal, (0, None, False))
+            if offset < reach:
+                if match_end <= reach or not (joins and cut):
+                    # A scan of the whole buffer wouldn't have found it
+                    continue
+                # The match crossing was cut short by its shard's end
+                chunks[index] += data[reach - offset:]
+                lengths[index] = match_end - offsets[index]
+            else:
+                index = len(offsets)
+                offsets.append(offset)
+                lengths.append(len(data))
+                chunks.append(data)
+            if match_end > max(stop, next_crossing.get(literal, (0,))[0]):
+                next_crossing[literal] = (match_end, index, match_end == end)
+        crossing = next_crossing
+
+    starts = array('q')
+    pos = 0
+    for length in lengths:
+        starts.append(pos)
+        pos += length
+    return MatchList(b''.join(chunks), offsets, lengths, starts)
+
+
+def shard_messages(pats, merged, details=True):
+    """
+    Args:
+        pats: The pattern instances of the set scanned
+        merged: The list merge_shards returned
+        details: Whether the matches are needed, or only the score
+    Return:
+        A tuple(score, msgs), as a Stage scores a transform
+    """
+    score = 0
+    msgs = []
+    for pat, matches in zip(pats, merged):
+        if not matches:
+            continue
+        score += pat.Weight * len(matches)
+        if details:
+            msgs.append([pat.Description, pat.Weight, matches])
+    return score, msgs
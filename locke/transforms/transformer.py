@@ -4,11 +4,23 @@ import sys
 import time
 import zipfile
 from abc import ABC, abstractmethod
+from functools import lru_cache, partial
 from multiprocessing import Pool, Array
-
-from locke.patterns import Manager
+from multiprocessing.pool import ThreadPool
+
+from locke.patterns import Manager, PatternSet
+from locke.patterns.utils import pack_matches
+from locke.transforms.budget import BudgetRunner, is_truncated
+from locke.transforms.cascade import PatternStage, default_cascade
+from locke.transforms.events import ProgressTracker
+from locke.transforms.shards import merge_shards, scan_shard, shard_bounds, \
+    shard_count, shard_messages
 from locke.transforms.utils import prettyhex, get_alphabets
 
+# Translation table lowercasing ASCII letters, for folding case into
+# other translation tables
+LOWER_TABLE = bytes(range(256)).lower()
+
 
 class BaseTransform(ABC):
     description = 'This is the base class for a Transform'
@@ -68,6 +80,46 @@ class BaseTransform(ABC):
         """
         pass
 
+    def transform_lower(self, data, encode=False):
+        """
+        Called by the workers when the lowercased transformed data is
+        needed. Transforms able to fold the case conversion into the
+        transformation itself should override this
+        """
+        return self.transform(data, encode).lower()
+
+    def transform_into(self, data, out):
+        """
+        Called by the workers to transform the data into out, a writable
+        buffer (a bytearray) the size of the data that they reuse from one
+        transform to the next. Transforms able to write their output into
+        it should override this; by default, a new bytestring is returned
+
+        Args:
+            data: The bytestring to transform
+            out: The bytearray to write the transformed data into
+        Return:
+            out, or a bytestring holding the transformed data
+        """
+        return self.transform(data)
+
+    def transform_range(self, data, start, stop):
+        """
+        Called by the workers scanning the transformed data in shards
+        (see shards), for the transformed bytes from start to stop.
+        Transforms able to transform part of the data on its own (e.g.,
+        a byte at a time) should override this; by default, the whole
+        data is transformed and sliced
+
+        Args:
+            data: The bytestring to transform
+            start: The offset of the first byte wanted
+            stop: The offset after the last byte wanted
+        Return:
+            A bytestring of stop - start bytes
+        """
+        return self.transform(data)[start:stop]
+
     @staticmethod
     @abstractmethod
     def all_iteration():
@@ -87,6 +139,20 @@ class BaseTransform(ABC):
         """
         yield None
 
+    @classmethod
+    def iterations(cls, data):
+        """
+        The iterations to try on the data. This is all_iteration(), unless
+        overridden by transforms able to derive their iterations from the
+        data (e.g., by solving for a key)
+
+        Args:
+            data: The bytestring that will be transformed
+        Return:
+            An iterable of the iteration values
+        """
+        return cls.all_iteration()
+
 
 class TransformString(BaseTransform):
     """
@@ -112,6 +178,35 @@ class TransformString(BaseTransform):
 
         return self.transform_string(data)
 
+    def key_tables(self):
+        """
+        Transforms translating each byte with a table picked by its offset
+        in the data, cycling (e.g., XOR with a key incremented after each
+        byte), should return the tables here, so the data is translated
+        a table at a time (see translate_periodic) both into the workers'
+        buffers and in shards
+
+        Returns:
+            The list of translation tables of a cycle, or None
+        """
+        return None
+
+    def transform_into(self, data, out):
+        tables = self.key_tables()
+        if tables is None:
+            return self.transform(data)
+        return translate_periodic(data, out, tables)
+
+    def transform_range(self, data, start, stop):
+        tables = self.key_tables()
+        if tables is None:
+            return super().transform_range(data, start, stop)
+        # The cycle is picked up where it is at the start
+        shift = start % len(tables)
+        return bytes(translate_periodic(data[start:stop],
+                                        bytearray(len(data[start:stop])),
+                                        tables[shift:] + tables[:shift]))
+
     @abstractmethod
     def transform_string(self, data, encode=False):
         """
@@ -156,7 +251,35 @@ class TransformChar(BaseTransform):
             raise TypeError('Data (%s) needs to be a bytestring type'
                             % type(data))
 
-        return data.translate(self.generate_trans_table(encode))
+        return data.translate(self._table(encode))
+
+    def transform_range(self, data, start, stop):
+        return data[start:stop].translate(self._table())
+
+    def transform_lower(self, data, encode=False):
+        """
+        Same as transform, but with the lowercasing composed into the
+        translation table so only one translation is done
+        """
+        if not isinstance(data, bytes):
+            raise TypeError('Data (%s) needs to be a bytestring type'
+                            % type(data))
+
+        return data.translate(self._table(encode, lower=True))
+
+    def _table(self, encode=False, lower=False):
+        """
+        The translation table, generated once per instance, and composed
+        with LOWER_TABLE if lower is set
+        """
+        tables = self.__dict__.setdefault('_tables', {})
+        key = (encode, lower)
+        if key not in tables:
+            if lower:
+                tables[key] = self._table(encode).translate(LOWER_TABLE)
+            else:
+                tables[key] = self.generate_trans_table(encode)
+        return tables[key]
 
     def generate_trans_table(self, encode=False):
         trans_table = b''
@@ -200,11 +323,96 @@ class TransformAllStage1(TransformString):
         # TODO: encode
         return data.translate(self.value[0])
 
+    def transform_lower(self, data, encode=False):
+        return data.translate(self.value[0].translate(LOWER_TABLE))
+
+    def transform_range(self, data, start, stop):
+        return data[start:stop].translate(self.value[0])
+
     @staticmethod
     def all_iteration():
         return get_alphabets()
 
 
+@lru_cache(maxsize=None)
+def xor_table(key):
+    """
+    Return:
+        The translation table XORing each byte with key
+    """
+    return bytes(byte ^ key for byte in range(256))
+
+
+@lru_cache(maxsize=None)
+def add_table(key):
+    """
+    Return:
+        The translation table adding key to each byte (modulo 256)
+    """
+    return bytes((byte + key) & 0xFF for byte in range(256))
+
+
+@lru_cache(maxsize=None)
+def rol_table(count):
+    """
+    Return:
+        The translation table rotating each byte left by count
+    """
+    return bytes(rol(byte, count) for byte in range(256))
+
+
+def translate_periodic(data, out, tables):
+    """
+    Translate the data into out, a bytearray the size of the data, with
+    a table that changes after each byte and cycles (e.g., for a key
+    incremented after each byte, which wraps after 256). The bytes of each
+    table are translated at once, with strided slices, instead of one
+    byte at a time
+    Args:
+        data: The bytestring to translate
+        out: The bytearray to write the translated data into
+        tables: The translation table of each byte of a cycle
+    Return:
+        out
+    """
+    period = len(tables)
+    for phase, table in enumerate(tables[:len(data)]):
+        out[phase::period] = data[phase::period].translate(table)
+    return out
+
+
+def xor_chained(data, out, key, step, block=0x10000):
+    """
+    XOR each byte of the data with the key and its neighbour into out,
+    a bytearray the size of the data. The data is XORed as big integers
+    a block at a time, so they stay small whatever the size of the data
+    Args:
+        data: The bytestring to transform
+        out: The bytearray to write the transformed data into
+        key: The byte to XOR with
+        step: -1 for the byte before (0 before the first byte), or 1 for
+            the byte after (0 after the last byte)
+        block: How many bytes to XOR at a time
+    Return:
+        out
+    """
+    size = len(data)
+    table = xor_table(key)
+    for start in range(0, size, block):
+        stop = min(start + block, size)
+        value = int.from_bytes(data[start:stop].translate(table), 'big')
+        if step < 0:
+            # Before the first byte, the slice is a byte short, which
+            # leaves a 0 at the top
+            other = int.from_bytes(data[max(start - 1, 0):stop - 1], 'big')
+        else:
+            other = int.from_bytes(data[start + 1:stop + 1], 'big')
+            if stop == size:
+                other <<= 8
+        out[start:stop] = (value ^ other).to_bytes(stop - start, 'big')
+    return out
+
+
 def to_bytes(value):
     """
     Convert int to a byte
@@ -356,11 +564,12 @@ def select_transformers(trans_list, name_list=None, select=None,
 
 
 def print_results(results, verbose=False):
-    for trans, score, msgs in sorted(results,
-                                     key=lambda k: k[1],
-                                     reverse=True):
+    for result in sorted(results, key=lambda k: k[1], reverse=True):
+        trans, score, msgs = result
         print('-' * 50)
-        print('Transform: %s (Score %i)' % (trans.name(), score))
+        print('Transform: %s (Score %i)%s'
+              % (trans.name(), score, ' (truncated: over its time budget)'
+                 if is_truncated(result) else ''))
         for desc, weight, hsh in sorted(msgs,
                                         key=lambda k: len(k[2]),
                                         reverse=True):
@@ -374,36 +583,32 @@ def print_results(results, verbose=False):
                     print('at %08X: %s - %s' % (offset, desc, mstr))
 
 
-def _read_zip(filename, password=None):
+def _read_zip(filename, password=None, member=None):
     """
-    Read a zip file and get the byte data from it. If there are multiple
-    files inside the zip, it will ask which on to evaluate
+    Read a zip file and get the byte data of one of its members, without
+    asking which. To evaluate every member, see archive.iter_members
     Args:
         filename: The location of the file
         password: Defaults to None. The zip's password if applicable
+        member: The name of the member to read (default = the only one)
     Return:
-        Either a list of bytestring or a single bytestring
+        The bytestring of the member
     """
     if not zipfile.is_zipfile(filename):
         raise TypeError('\"%s\" is NOT a valid zip file! Try running a '
                         'normal scan on it' % filename)
 
-    zfile = zipfile.ZipFile(filename, 'r')
-
-    print('What file do you want to evaluate:')
-    for i in range(0, len(zfile.namelist())):
-        print('%i: %s' % (i + 1, zfile.namelist()[i]))
-    answer = int(
-        input('1 - %i: '
-              % len(zfile.namelist())
-              )
-    )
-
-    if answer in range(1, len(zfile.namelist())):
-        data = zfile.read(zfile.infolist()[answer - 1], password)
-    else:
-        raise IndexError('Range %i is out of bound' % answer)
-    return data
+    if isinstance(password, str):
+        password = password.encode()
+    with zipfile.ZipFile(filename, 'r') as zfile:
+        names = [info.filename for info in zfile.infolist()
+                 if not info.is_dir()]
+        if member is None and len(names) == 1:
+            member = names[0]
+        if member not in names:
+            raise ValueError('Pick one of the files in \"%s\": %s'
+                             % (filename, ', '.join(names)))
+        return zfile.read(member, password)
 
 
 def _read_file(filename):
@@ -420,54 +625,182 @@ def _read_file(filename):
     return data
 
 
-def _transform(transform_stage):
+def scan_transform(transformer, stage, data, details=True, bounds=None):
     """
-        Process the data using the transformer provided
-        Upon receiving the results store it in a
-        list of tuple(transform_instance, score)
+        Process the data using the transformer provided, and score
+        the result as the given stage of a cascade does
 
         Args:
-            transform_stage: A tuple(transformer, stage_number)
+            transformer: The transform instance to apply
+            stage: A Stage, or the stage number of the patterns to use
+            data: The bytestring to transform
+            details: Whether the matches are needed, or only the score
+            bounds: The tuple(start, stop, end) of the shard to score,
+                rather than all of the data, if the stage is shardable
+                (default = None, see PatternStage.score_shard)
         Return:
-            A list of tuple(transform_instance, score)
+            A tuple(transform_instance, score, msgs), where msgs is
+            a list of [description, weight, MatchList] (empty if no
+            details were asked for)
         """
-    transformer, stage = transform_stage
+    if isinstance(stage, int):
+        stage = PatternStage(stage)
+    if bounds is not None:
+        return stage.score_shard(transformer, data, bounds)
+    return stage.score(transformer, data, details)
 
-    trans_data = transformer.transform(data)
-    score = 0
-    mgr = Manager(raw=trans_data, stage=stage)
-    msgs = []
-    for pat, matches in mgr.run():
-        if not matches:
-            continue
 
-        match_hash = {}
-        for match in matches:
-            match_hash[match.offset] = match.data
+def _transform(transform_stage, details=True):
+    """
+        Process pool entry point, scanning the data the worker
+        was initialized with (see init_pool)
 
-        msgs.append([pat.Description, pat.Weight, match_hash])
-        score += pat.Weight * len(matches)
-    del mgr
+        Args:
+            transform_stage: A tuple(transformer, stage), where stage is
+                a Stage or a pattern stage number, along with the bounds
+                of a shard if scoring one (see _stage_tasks)
+            details: Whether the matches are needed, or only the score
+        Return:
+            A tuple(transform_instance, score, msgs)
+        """
+    return scan_transform(*transform_stage[:2], worker_data, details,
+                          *transform_stage[2:])
 
-    results = (transformer, score, msgs)
 
-    return results
+def _transform_data(data, transform_stage, details=True):
+    """
+        Thread pool entry point. Threads share memory, so the
+        data is handed over directly
 
+        Args:
+            data: The bytestring to transform
+            transform_stage: A tuple(transformer, stage), where stage is
+                a Stage or a pattern stage number, along with the bounds
+                of a shard if scoring one (see _stage_tasks)
+            details: Whether the matches are needed, or only the score
+        Return:
+            A tuple(transform_instance, score, msgs)
+        """
+    return scan_transform(*transform_stage[:2], data, details,
+                          *transform_stage[2:])
 
-def _error_raise(msg):
-    sys.exit(msg)
+
+def _stage_tasks(transformers, stage, size, workers=None):
+    """
+    The tasks of a stage after the first: a tuple(transformer, stage) for
+    each transform kept, or when there are fewer of them than workers and
+    the stage is shardable, a tuple(transformer, stage, bounds) for each
+    shard of each (see shards)
+    Args:
+        transformers: The transform instances kept by the previous stage
+        stage: The Stage to run
+        size: The size of the data being transformed
+        workers: The size of the pool (default = one per CPU)
+    Return:
+        A tuple(tasks, shards per transform)
+    """
+    count = shard_count(size, len(transformers), workers) \
+        if stage.shardable else 1
+    if count == 1:
+        return [(trans, stage) for trans in transformers], 1
+    bounds = shard_bounds(size, count)
+    return [(trans, stage, shard) for trans in transformers
+            for shard in bounds], len(bounds)
+
+
+def _merge_stage(results, stage, shards, details=True):
+    """
+    Merge the results of the tasks _stage_tasks made into one
+    tuple(trans_instance, score, msgs) per transform
+    """
+    if shards == 1:
+        return results
+    return [stage.merge_shards(results[i:i + shards], details)
+            for i in range(0, len(results), shards)]
+
+
+def search_data(data, stage=2, patterns=None):
+    """
+    Search the data for patterns, without transforming it
+    Args:
+        data: The bytestring to search
+        stage: The stage number of the patterns to use (default = 2)
+        patterns: A list of pattern plugin classes to use instead of
+            the stage's (default = None)
+    Return:
+        A list of [description, weight, MatchList] for each pattern
+        that matched
+    """
+    mgr = Manager(raw=data, stage=stage, patterns=patterns)
+    return [[pat.Description, pat.Weight, pack_matches(matches)]
+            for pat, matches in mgr.run() if matches]
+
+
+def _search_shard(shard, stage=2, patterns=None):
+    """
+    Pool entry point for search_shards
+    Args:
+        shard: A tuple(bytestring of the shard, bounds of the shard)
+    Return:
+        The list scan_shard returns
+    """
+    data, bounds = shard
+    return scan_shard(data, bounds, PatternSet.get(stage, patterns))
+
+
+def search_shards(data, pool, stage=2, patterns=None, workers=None):
+    """
+    Search the data for patterns like search_data, with the search split
+    into shards run across the pool (see shards) if the data is big
+    enough to
+    Args:
+        data: The bytestring to search
+        pool: The pool to search on
+        stage: The stage number of the patterns to use (default = 2)
+        patterns: A list of pattern plugin classes to use instead of
+            the stage's (default = None)
+        workers: The size of the pool (default = one per CPU)
+    Return:
+        A list of [description, weight, MatchList] for each pattern
+        that matched
+    """
+    count = shard_count(len(data), 1, workers)
+    if count == 1:
+        return pool.apply(search_data, (data, stage, patterns))
+    bounds = shard_bounds(len(data), count)
+    parts = pool.map(partial(_search_shard, stage=stage, patterns=patterns),
+                     [(data[start:end], (start, stop, end))
+                      for start, stop, end in bounds], 1)
+    pats = PatternSet.get(stage, patterns).pats
+    return shard_messages(pats, merge_shards(parts, bounds, pats))[1]
+
+
+def rank_results(results, keep=None):
+    """
+    Sort results by score, best first
+    Args:
+        results: A list of tuple(trans_instance, score, msgs)
+        keep: How many results to keep (default = all)
+    Return:
+        The sorted list of results, up to "keep" size
+    """
+    return sorted(results, key=lambda r: r[1], reverse=True)[:keep]
 
 
-def _iteration_transformer(stage_data):
+def _iteration_transformer(stage_data, data=None):
     """
     Create a generate tuples to be used with Transform method
     Args:
         stage_data: A tuple(trans_name, stage_num)
+        data: The bytestring to be transformed, for transforms deriving
+            their iterations from it (default = None, all_iteration only)
     Return:
         Generates tuple(trans_instance, stage_num)
     """
     for part in stage_data:
-        for value in part[0].all_iteration():
+        values = part[0].all_iteration() if data is None else \
+            part[0].iterations(data)
+        for value in values:
             yield (part[0](value), part[1])
 
 
@@ -484,92 +817,260 @@ def _display_elapse(start_time, iter_count):
     print("%i iterations in %iD:%02iH:%02iM:%02iS" % (iter_count, d, h, m, s))
 
 
+# Only set inside pool worker processes (see init_pool)
+worker_data = None
+
+
 def init_pool(init_data):
     """
     Need initializer for Windows since it doesn't fork
     :param init_data: raw data
     :return: None
     """
-    global data
-    data = bytes(init_data)
+    global worker_data
+    worker_data = bytes(init_data)
+
+
+def read_data(filename, zip_file=False, password=None, member=None):
+    """
+    Read the data to evaluate from a file or a zip
+    Args:
+        filename: The file to read
+        zip_file: Mark the file as a zip (default = False)
+        password: Set the password for the zip (default = None)
+        member: The member of the zip to read (default = the only one)
+    Return:
+        The bytestring to evaluate
+    """
+    return (_read_file(filename) if not zip_file else
+            _read_zip(filename, password, member))
+
+
+def _make_pool(data, backend='process'):
+    """
+    Create the pool the transformations run on, along with the
+    function its workers run
+    Args:
+        data: The bytestring to evaluate
+        backend: Either 'process' or 'thread'
+    Return:
+        A tuple(pool, worker_function)
+    """
+    if backend == 'thread':
+        return ThreadPool(), partial(_transform_data, data)
+    elif backend == 'process':
+        pool = Pool(initializer=init_pool,
+                    initargs=(Array(ctypes.c_char, data, lock=False),))
+        return pool, _transform
+    raise ValueError('unknown pool backend "%s"' % backend)
+
+
+def _chunksize(count):
+    """
+    Return:
+        How many of count tasks to send to a pool worker at once when
+        imap-ing them: smaller chunks than map would use, so progress
+        stays current
+    """
+    return min(256, max(1, count // ((os.cpu_count() or 1) * 4)))
+
+
+def _run_stage(pool, worker, tasks, stage, size, progress=None,
+               tracker=None):
+    """
+    Run the tasks of a stage on the pool, in order. An error raised by
+    a task is raised here
+    Args:
+        pool: The pool to run the tasks on, or a BudgetRunner to hold
+            the tasks to the budget of their stage
+        worker: The function the pool's workers run
+        tasks: An iterable of tuple(trans_instance, stage_num)
+        stage: The stage number
+        size: The size of the data being transformed
+        progress: A list of callables to send ProgressEvents to
+        tracker: The ProgressTracker of a stage run in several parts, to
+            count the results with and leave running (default = one for
+            these tasks alone, if there is progress to send)
+    Return:
+        A list of tuple(trans_instance, score, msgs)
+    """
+    own = tracker is None and bool(progress)
+    if own:
+        tasks = list(tasks)
+        tracker = ProgressTracker(stage, len(tasks), size, progress)
+
+    if isinstance(pool, BudgetRunner):
+        results = pool.run(worker, tasks,
+                           None if tracker is None else tracker.update)
+    elif tracker is None:
+        return pool.map(worker, tasks)
+    else:
+        tasks = list(tasks)
+        results = []
+        for result in pool.imap(worker, tasks, _chunksize(len(tasks))):
+            results.append(result)
+            tracker.update(result)
+    if own:
+        tracker.finish()
+    return results
 
 
 def run_transformations(trans_list, filename, keep,
-                        zip_file=False, password=None, verbose=0):
+                        zip_file=False, password=None, verbose=0,
+                        data=None, backend='process', progress=None,
+                        serve=None, authkey=None, cascade=None, depth=1,
+                        width=None, region_map=None, checkpoint=None,
+                        resume=False):
     """
-    Using a process pool, run all transformation on the file and return
-    only the top few resutls
+    Using a process (or thread) pool, run all transformation on the file
+    and return only the top few resutls
     Args:
         trans_list: A list of tuples(trans_name, trans_class)
         filename: The file to read and evaluate
-        keep: How many results to keep
+        keep: How many results to keep after stage 1 of the default
+            cascade
         zip_file: Mark the file as a zip (default = False)
         password: Set the password for the zip (default = None)
         verbose: Specify whether you want verbose output
+        data: The bytestring to evaluate, if already read (default = None)
+        backend: Run on a 'process' (default) or 'thread' pool
+        progress: A list of callables to send ProgressEvents to
+        serve: A tuple(host, port) to hand stage 1 out to workers
+            from, rather than running it here (default = None)
+        authkey: The bytestring workers must authenticate with
+        cascade: A list of the stages to run (default = stage 1 and 2
+            patterns, see default_cascade)
+        depth: How many layers of transforms the first stage chains
+            (default = 1, no chaining; see beam_search)
+        width: How many chains of a layer the next builds on
+            (default = how many the first stage keeps)
+        region_map: The RegionMap the data was joined from, to report
+            match offsets in the file (default = None)
+        checkpoint: The file to save the progress of the crack to now and
+            then, deleted once complete (default = None, see Checkpoint)
+        resume: Carry on from the progress saved to the checkpoint file,
+            if of a crack of the same data and options (default = False)
     Return:
-        A sorted list of tuples(trans_instance, score) up to "keep" size
+        A sorted list of tuples(trans_instance, score) up to the size the
+        last stage keeps
     """
-    global data
-    data = (_read_file(filename) if not zip_file else
-            _read_zip(filename, password))
-
-    # ----------------------#
-    # Stage 1 #
-    # ----------------------#
-    print('=' * 20, 'Starting Stage 1', '=' * 20)
-    start = time.time()
-    stage1 = list(zip(trans_list, (1,) * len(trans_list)))
+    if data is None:
+        data = read_data(filename, zip_file, password)
+    if cascade is None:
+        cascade = default_cascade(keep)
+    if checkpoint is not None:
+        # Imported here, as the checkpoint module builds on this one
+        from locke.transforms.checkpoint import Checkpoint, \
+            checkpoint_key, run_keyspace
+        checkpoint = Checkpoint.open(
+            checkpoint, checkpoint_key(data, trans_list, cascade, depth,
+                                       width), resume)
 
     # What is faster? A pool of transformer instances or a pool of
     # transformer to create instances of? Both have roughly the same speed
     # on smaller files... but what about the more complex transformers and
     # bigger files? Pool of instances should be faster?
-    pool = Pool(initializer=init_pool,
-                initargs=(Array(ctypes.c_char, data, lock=False),))
-    '''
-    result_list = []
-    for trans in _iteration_transformer(stage1):
-        result_list.append(_transform(trans))
-    '''
-    # TODO: Make sure there is safe execution.
-    # If this throws an error it hangs
-    result_list = pool.map_async(_transform,
-                                 _iteration_transformer(stage1),
-                                 error_callback=_error_raise).get()
-    ''''''
-    # sort the data and keep only the top few
-    stage1iters = len(result_list)
-    result_list = sorted(result_list, key=lambda r: r[1], reverse=True)[:keep]
-    if verbose > 0:
-        print_results(result_list, True if verbose > 1 else False)
-    _display_elapse(start, stage1iters)
-    print('=' * 20, 'Stage1 Completed', '=' * 20)
-    print('=' * 20, 'Starting Stage 2', '=' * 20)
-    start = time.time()
-
-    # extract the wanted transformer and group it with 2 (mark as stage 2)
-    stage2 = [(trans[0], 2) for trans in result_list]
-    result_list = pool.map_async(_transform,
-                                 stage2,
-                                 error_callback=_error_raise).get()
-
-    print_results(result_list, True if verbose > 0 else False)
-    _display_elapse(start, len(result_list))
-    print('=' * 20, 'Stage2 Completed', '=' * 20)
-
-    return sorted(result_list, key=lambda r: r[1], reverse=True)
+    pool, worker = _make_pool(data, backend)
+    if backend == 'process' or \
+            any(stage.budget is not None for stage in cascade):
+        # Tasks running over budget (or whose worker died) are given up on
+        # by replacing the pool
+        pool = BudgetRunner(lambda: _make_pool(data, backend)[0], pool)
+    for number, stage in enumerate(cascade, 1):
+        restored = checkpoint is not None and number < checkpoint.stage
+        if restored and number < checkpoint.stage - 1:
+            # Only the results of the last stage completed are needed
+            continue
+        last = number == len(cascade)
+        # Matches are only ever looked at after the last stage,
+        # or when being verbose
+        details = last or verbose > 0
+        if stage.details is not None:
+            details = stage.details
+        print('=' * 20, 'Starting Stage %i' % number, '=' * 20)
+        start = time.time()
+
+        if restored:
+            print('Restored from the checkpoint')
+            result_list = checkpoint.results
+            iters = len(result_list)
+        elif number == 1 and depth > 1:
+            # Imported here, as the chain module builds on this one
+            from locke.transforms.chain import beam_search
+            result_list, iters = beam_search(
+                pool, partial(worker, details=details), trans_list, stage,
+                depth, width, data, progress,
+                state=checkpoint.beam if checkpoint else None,
+                on_layer=checkpoint.save_beam if checkpoint else None)
+        elif number == 1 and serve is not None:
+            # Imported here, as the distributed module builds on this one
+            from locke.transforms.distributed import partition, \
+                serve_keyspace
+            shards = partition(trans_list, data=data)
+            iters = sum(stop - begin for _, begin, stop in shards)
+            result_list = serve_keyspace(data, shards, stage.keep, serve,
+                                         authkey, details=details,
+                                         stage=stage)
+        elif number == 1 and checkpoint is not None:
+            # Run shard by shard, so the shards done can be saved
+            result_list, iters = run_keyspace(
+                pool, partial(worker, details=details), trans_list, stage,
+                data, checkpoint, progress, details)
+        else:
+            # Imported here, as the differential module builds on this one
+            from locke.transforms.differential import place_scored, \
+                score_families
+            scored = {}
+            if number == 1:
+                # XOR and ADD keys are scored a family at a time
+                tasks, scored = score_families(_iteration_transformer(
+                    [(trans, stage) for trans in trans_list], data), data,
+                    details)
+                shards = 1
+            else:
+                # only the transformers kept by the previous stage,
+                # split into shards if too few to keep the pool busy
+                tasks, shards = _stage_tasks(
+                    [trans[0] for trans in result_list], stage, len(data))
+            result_list = _merge_stage(place_scored(
+                _run_stage(pool, partial(worker, details=details), tasks,
+                           number, len(data), progress), scored),
+                stage, shards, details)
+            iters = len(result_list)
+        # sort the data and keep only the top few, the last stage
+        # included, so what's printed is what's returned
+        result_list = rank_results(result_list, stage.keep)
+
+        if checkpoint is not None and not restored:
+            # Saved before remapping, as remapping moves the matches
+            checkpoint.finish_stage(number, result_list)
+        if region_map is not None:
+            region_map.remap(result_list)
+        if last:
+            print_results(result_list, True if verbose > 0 else False)
+        elif verbose > 0:
+            print_results(result_list, True if verbose > 1 else False)
+        _display_elapse(start, iters)
+        print('=' * 20, 'Stage%i Completed' % number, '=' * 20)
+
+    if checkpoint is not None:
+        checkpoint.remove()
+    return result_list
 
 
 # TODO
 # Call on save to disk here? or Make locke.py call write to disk?
-def write_to_disk(results, output, filename):
+def write_to_disk(results, output, filename, data=None):
     """
     Write a list of results to disk
     Args:
         results: A list of tuple(trans_instance, score)
         output: Output directory to write the transformed files
         filename: The file name of the original file
+        data: The bytestring that was evaluated (default = read filename)
     """
+    if data is None:
+        data = _read_file(filename)
     print("Writing results to disk")
     for i in range(0, len(results)):
         # B/C we multiprocessed, we have to re-transform the data
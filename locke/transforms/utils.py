@@ -1,9 +1,10 @@
 import os
-import sqlite3
-from sqlite3 import Error
 
 DBFILE = os.path.join(os.path.dirname(__file__), 'data', 'transforms.db')
 
+# sqlite3 is imported by the functions using the database, as listing
+# patterns or printing tables shouldn't pay for it at startup
+
 
 def create_db(cursor):
     cursor.execute("""
@@ -14,6 +15,7 @@ def create_db(cursor):
 
 
 def insert_translations(conn, cursor, trans_list):
+    import sqlite3
     for trans in trans_list:
         cursor.execute("""
         INSERT INTO translations (translation, algsstr) VALUES(?, ?)""",
@@ -50,6 +52,7 @@ def select_translations(conn, cursor):
 
 def generate_database(trans_list,
                       db_file=DBFILE):
+    import sqlite3
     try:
         os.remove(db_file)
         conn = sqlite3.connect(db_file)
@@ -57,18 +60,19 @@ def generate_database(trans_list,
         create_db(cursor)
         insert_translations(conn, cursor, get_translations(trans_list))
         conn.commit()
-    except Error as e:
+    except sqlite3.Error as e:
         print(e)
     finally:
         conn.close()
 
 
 def get_alphabets(db_file=DBFILE):
+    import sqlite3
     try:
         conn = sqlite3.connect(db_file)
         cursor = conn.cursor()
         return select_translations(conn, cursor)
-    except Error as e:
+    except sqlite3.Error as e:
         print(e)
         conn.close()
 